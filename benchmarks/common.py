@@ -0,0 +1,73 @@
+"""Shared setup for the benchmark scripts in this directory.
+
+The scripts are run directly (``python benchmarks/<name>.py``) from the
+repository root. They configure Django against a throwaway test database
+and a temporary MEDIA_ROOT, so they never touch ``db.sqlite3`` or
+``media/``.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def scratch_environment(scratch):
+    """Environment for a process that uses ``settings.py`` with its data under ``scratch``."""
+    return {
+        **os.environ,
+        'DJANGO_SETTINGS_MODULE': 'benchmarks.settings',
+        'BENCH_DIR': scratch,
+        'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+    }
+
+
+def setup_django(**overrides):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    from django.conf import settings
+
+    # Applied before setup so DATABASES overrides are in place before any connection exists.
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='bench-media-')
+    settings.SHARE_DOWNLOAD_LOG = {'MODE': 'off'}
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    """Create the test database (and ALLOWED_HOSTS/email test setup) for the duration of the block."""
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def logged_in_cookie(user):
+    """Return a ``Cookie`` header value carrying a session for ``user``."""
+    from django.conf import settings
+    from django.test import Client
+
+    client = Client()
+    client.force_login(user)
+    return f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
@@ -0,0 +1,75 @@
+"""Compare two ``loadtest.py`` result files, endpoint by endpoint.
+
+The command exits with status 1 if any endpoint's p95 latency got worse
+by more than ``--threshold`` percent, if it now runs more queries on
+average, or if it has new errors. A CI job can therefore fail on a
+regression.
+
+    python benchmarks/compare.py benchmarks/results/abc1234.json benchmarks/results/def5678.json
+"""
+import argparse
+import json
+import sys
+
+METRICS = ['per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_mean', 'errors']
+
+
+def change(base, head):
+    if base is None or head is None:
+        return ''
+    if base == 0:
+        return '' if head == 0 else 'new'
+    return f'{(head - base) / base * 100:+.1f}%'
+
+
+def regressions(base, head, threshold):
+    found = []
+    for name, b in base['endpoints'].items():
+        h = head['endpoints'].get(name)
+        if h is None or not b['requests'] or not h['requests']:
+            continue
+        if b['p95_ms'] and (h['p95_ms'] - b['p95_ms']) / b['p95_ms'] * 100 > threshold:
+            found.append(f"{name}: p95 {b['p95_ms']:.1f} -> {h['p95_ms']:.1f} ms")
+        if b['queries_mean'] is not None and h['queries_mean'] is not None and h['queries_mean'] > b['queries_mean']:
+            found.append(f"{name}: queries {b['queries_mean']:.1f} -> {h['queries_mean']:.1f}")
+        if h['errors'] > b['errors']:
+            found.append(f"{name}: errors {b['errors']} -> {h['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('base', help='Results of the baseline run.')
+    parser.add_argument('head', help='Results of the run to check.')
+    parser.add_argument('--threshold', type=float, default=10, help='Allowed p95 slowdown, in percent.')
+    args = parser.parse_args()
+
+    with open(args.base) as fh:
+        base = json.load(fh)
+    with open(args.head) as fh:
+        head = json.load(fh)
+    if base['meta']['args'] != head['meta']['args']:
+        print('Warning: the runs used different arguments; the comparison may not be meaningful.')
+
+    print(f"base {base['meta']['commit']} ({base['meta']['started_at']}) vs head {head['meta']['commit']} ({head['meta']['started_at']})")
+    print(f"{'endpoint':<10} {'metric':<13} {'base':>10} {'head':>10} {'change':>9}")
+    for name, b in base['endpoints'].items():
+        h = head['endpoints'].get(name, {})
+        for metric in METRICS:
+            before, after = b.get(metric), h.get(metric)
+            print(
+                f"{name:<10} {metric:<13} {'-' if before is None else before:>10} "
+                f"{'-' if after is None else after:>10} {change(before, after):>9}"
+            )
+
+    found = regressions(base, head, args.threshold)
+    if found:
+        print('\nRegressions:')
+        for line in found:
+            print(f'  {line}')
+        sys.exit(1)
+    print('\nNo regressions.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Load test the share app over HTTP and record per-endpoint latency and query counts.
+
+The run seeds a scratch database with ``seed.py`` and starts
+``manage.py runserver`` on it, using ``settings.py``. It then drives the
+server from ``--clients`` concurrent virtual users. Each user logs in
+once, then loops over a weighted mix of scenarios until the time is up:
+
+* list (40%): the first page of their files.
+* dashboard (20%): their storage and download summary.
+* download (30%): one of their seeded files, read to the end.
+* upload (10%): a new 16 KiB text file through the upload form.
+
+Every request uses a fresh connection, and its latency covers the
+connect and the whole response body. Requests made during ``--warmup``
+are not counted, except the logins. SQL query counts come from the
+server's ``X-Bench-Queries`` header.
+
+The results are written as JSON (``--output``, by default
+``benchmarks/results/<commit>.json``). Use ``compare.py`` to compare two
+runs.
+
+    python benchmarks/loadtest.py --clients 8 --seconds 30
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+import django
+
+from common import ROOT, percentile, scratch_environment
+
+SCENARIOS = [('list', 40), ('dashboard', 20), ('download', 30), ('upload', 10)]
+ENDPOINTS = ['login', *(name for name, _ in SCENARIOS)]
+UPLOAD_BYTES = 16 * 1024
+QUERY_HEADER = 'X-Bench-Queries'
+
+
+class Browser:
+    """A virtual user: one cookie jar, one new connection per request."""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookies = {}
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        started = time.perf_counter()
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        elapsed = time.perf_counter() - started
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        queries = response.headers.get(QUERY_HEADER)
+        return response.status, response.headers, content, elapsed, int(queries) if queries else None
+
+    def csrf_post(self, path, fields=(), files=()):
+        fields = [('csrfmiddlewaretoken', self.cookies.get('csrftoken', '')), *fields]
+        if not files:
+            body = urlencode(fields).encode()
+            content_type = 'application/x-www-form-urlencoded'
+        else:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for name, value in fields:
+                parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+            for name, filename, data in files:
+                parts.append(
+                    f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                    f'Content-Type: text/plain\r\n\r\n'.encode() + data + b'\r\n'
+                )
+            parts.append(f'--{boundary}--\r\n'.encode())
+            body = b''.join(parts)
+            content_type = f'multipart/form-data; boundary={boundary}'
+        return self.request('POST', path, body=body, headers={'Content-Type': content_type})
+
+
+class Recorder:
+    def __init__(self, record_after):
+        self.record_after = record_after
+        self.lock = threading.Lock()
+        self.samples = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+
+    def add(self, endpoint, ok, elapsed, queries):
+        # Each user logs in once, at the start, so logins are kept even during the warmup.
+        if endpoint != 'login' and time.perf_counter() < self.record_after:
+            return
+        with self.lock:
+            if ok:
+                self.samples[endpoint].append((elapsed, queries))
+            else:
+                self.errors[endpoint] += 1
+
+
+def virtual_user(port, account, password, deadline, recorder, rng):
+    browser = Browser(port)
+    browser.request('GET', '/share/login/')
+    status, headers, _, elapsed, queries = browser.csrf_post(
+        '/share/login/', [('username', account['username']), ('password', password)]
+    )
+    recorder.add('login', status == 302, elapsed, queries)
+    if status != 302:
+        return
+
+    names = [name for name, _ in SCENARIOS]
+    weights = [weight for _, weight in SCENARIOS]
+    while time.perf_counter() < deadline:
+        scenario = rng.choices(names, weights)[0]
+        try:
+            if scenario == 'list':
+                status, _, _, elapsed, queries = browser.request('GET', '/share/files/')
+                ok = status == 200
+            elif scenario == 'dashboard':
+                status, _, _, elapsed, queries = browser.request('GET', '/share/dashboard/')
+                ok = status == 200
+            elif scenario == 'download':
+                file_id = rng.choice(account['files'])
+                status, _, _, elapsed, queries = browser.request('GET', f'/share/files/{file_id}/download/')
+                ok = status == 200
+            else:
+                data = (f'load test upload {uuid.uuid4().hex}\n' * UPLOAD_BYTES)[:UPLOAD_BYTES].encode()
+                status, headers, _, elapsed, queries = browser.csrf_post(
+                    '/share/upload/', files=[('file', 'loadtest.txt', data)]
+                )
+                ok = status == 302 and headers.get('Location', '').endswith('/share/files/')
+        except (OSError, http.client.HTTPException):
+            ok, elapsed, queries = False, 0.0, None
+        recorder.add(scenario, ok, elapsed, queries)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(port, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('The server exited during startup; see server.log in the scratch directory.')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'The server did not start listening within {timeout}s.')
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True, capture_output=True, text=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{commit}-dirty' if dirty else commit
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for name in ENDPOINTS:
+        latencies = [latency for latency, _ in recorder.samples[name]]
+        queries = [count for _, count in recorder.samples[name] if count is not None]
+        endpoints[name] = {
+            'requests': len(latencies),
+            'errors': recorder.errors[name],
+            'per_second': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'queries_mean': round(sum(queries) / len(queries), 2) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+    requests = sum(e['requests'] for e in endpoints.values())
+    return endpoints, {
+        'requests': requests,
+        'errors': sum(e['errors'] for e in endpoints.values()),
+        'per_second': round(requests / elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent virtual users.')
+    parser.add_argument('--seconds', type=float, default=30, help='Measured duration.')
+    parser.add_argument('--warmup', type=float, default=3, help='Unmeasured seconds before the measurement.')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--downloads', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/<commit>.json).')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory for inspection.')
+    args = parser.parse_args()
+    if args.clients > args.users:
+        parser.error('--clients cannot exceed --users: each virtual user logs in as its own account.')
+
+    scratch = tempfile.mkdtemp(prefix='bench-load-')
+    env = scratch_environment(scratch)
+    manage = os.path.join(ROOT, 'manage.py')
+    subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'benchmarks', 'seed.py'), '--users', str(args.users),
+         '--files', str(args.files), '--downloads', str(args.downloads), '--seed', str(args.seed)],
+        env=env, cwd=ROOT, check=True,
+    )
+    with open(os.path.join(scratch, 'manifest.json')) as fh:
+        manifest = json.load(fh)
+
+    port = free_port()
+    with open(os.path.join(scratch, 'server.log'), 'wb') as log:
+        server = subprocess.Popen(
+            [sys.executable, manage, 'runserver', '--noreload', f'127.0.0.1:{port}'],
+            env=env, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT,
+        )
+    try:
+        wait_until_up(port, server)
+        started = time.perf_counter()
+        recorder = Recorder(record_after=started + args.warmup)
+        deadline = started + args.warmup + args.seconds
+        rng = random.Random(args.seed)
+        accounts = rng.sample(manifest['users'], args.clients)
+        threads = [
+            threading.Thread(
+                target=virtual_user,
+                args=(port, account, manifest['password'], deadline, recorder, random.Random(rng.random())),
+            )
+            for account in accounts
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        measured = time.perf_counter() - recorder.record_after
+    finally:
+        server.terminate()
+        server.wait()
+
+    endpoints, total = summarize(recorder, measured)
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'keep')},
+        },
+        'endpoints': endpoints,
+        'total': total,
+    }
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{results['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fh:
+        json.dump(results, fh, indent=2)
+
+    print(f'{args.clients} clients for {args.seconds}s against {args.users} users / {args.files} files')
+    print(f"{'endpoint':<10} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'errors':>7}")
+    for name, e in endpoints.items():
+        queries = '-' if e['queries_mean'] is None else f"{e['queries_mean']:.1f}"
+        print(
+            f"{name:<10} {e['per_second']:>8.1f} {e['p50_ms']:>9.1f} {e['p95_ms']:>9.1f} {e['p99_ms']:>9.1f} "
+            f"{queries:>8} {e['errors']:>7}"
+        )
+    print(f"total: {total['per_second']:.1f} req/s, {total['errors']} errors. Results written to {output}")
+    if args.keep:
+        print(f'Scratch directory kept at {scratch}')
+    else:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+"""Middleware used only by the load-test server (see ``settings.py``).
+
+It counts the SQL statements a request executes on any database alias and
+returns the count in ``X-Bench-Queries``. Statements run while a
+streaming body is sent, or in the download-log flush thread, are not
+counted.
+"""
+from contextlib import ExitStack
+
+from django.db import connections
+
+HEADER = 'X-Bench-Queries'
+
+
+class QueryCountMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        count = 0
+
+        def counter(execute, sql, params, many, context):
+            nonlocal count
+            count += 1
+            return execute(sql, params, many, context)
+
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(counter))
+            response = self.get_response(request)
+        response[HEADER] = count
+        return response
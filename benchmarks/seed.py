@@ -0,0 +1,139 @@
+"""Seed a scratch database with users, files and download logs.
+
+Rows are written with ``bulk_create``, not through views or signals, so
+even large datasets are seeded in seconds. The derived data (storage
+counters, daily rollups, the search index) is rebuilt afterwards by the
+project's own management commands. The same ``--seed`` always produces
+the same data.
+
+``loadtest.py`` runs this script itself. To seed a directory by hand:
+
+    BENCH_DIR=/tmp/bench python benchmarks/seed.py --users 50 --files 2000 --downloads 20000
+
+It migrates ``$BENCH_DIR/db.sqlite3`` and writes ``$BENCH_DIR/manifest.json``
+with the shared password and each user's file ids.
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import timedelta
+
+from common import scratch_environment
+
+PASSWORD = 'bench-password-123'
+WORDS = (
+    'lecture notes exam syllabus lab report thesis draft campus library '
+    'physics chemistry biology history assignment reading week seminar'
+).split()
+
+
+def text_body(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size].encode()
+
+
+def seed(users, files, downloads, distinct, rng):
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+    from django.core.files.base import ContentFile
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from share import blobs
+    from share.models import DownloadLog, UploadedFile
+
+    call_command('migrate', verbosity=0)
+
+    # Hashing is deliberately slow; every seeded user shares one hash.
+    password = make_password(PASSWORD)
+    people = User.objects.bulk_create(
+        [User(username=f'bench{i:05d}', email=f'bench{i:05d}@example.edu', password=password) for i in range(users)],
+        batch_size=1000,
+    )
+
+    # A few distinct contents shared by many rows, as deduplicated uploads are.
+    contents = {}
+    for i in range(distinct):
+        data = text_body(rng, rng.choice([2, 8, 32, 128, 512]) * 1024)
+        contents[blobs.file_digest(ContentFile(data))] = ContentFile(data, name=f'seed{i}.txt')
+    digests = list(contents)
+    picks = [rng.choice(digests) for _ in range(files)]
+    stored = blobs.acquire_many(contents, picks, blobs.stage_many(contents))
+
+    uploads = UploadedFile.objects.bulk_create(
+        [
+            UploadedFile(
+                user=people[i % users],
+                blob=stored[digest],
+                file=stored[digest].file.name,
+                name=f'{rng.choice(WORDS)}-{rng.choice(WORDS)}-{i}.txt',
+                size=stored[digest].size,
+                content_type='text/plain',
+            )
+            for i, digest in enumerate(picks)
+        ],
+        batch_size=1000,
+    )
+
+    now = timezone.now()
+    DownloadLog.objects.bulk_create(
+        [
+            DownloadLog(
+                user=rng.choice(people),
+                file=rng.choice(uploads),
+                timestamp=now - timedelta(seconds=rng.randrange(30 * 24 * 3600)),
+            )
+            for _ in range(downloads)
+        ],
+        batch_size=1000,
+    )
+
+    call_command('reconcile_storage_stats', verbosity=0)
+    call_command('rollup_downloads', verbosity=0)
+    call_command('rebuild_search_index', workers=1, verbosity=0)
+
+    files_by_user = {person.id: [] for person in people}
+    for upload in uploads:
+        files_by_user[upload.user_id].append(upload.id)
+    return {
+        'password': PASSWORD,
+        'users': [{'username': person.username, 'files': files_by_user[person.id]} for person in people],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--downloads', type=int, default=20000)
+    parser.add_argument('--distinct', type=int, default=40, help='Distinct file contents (blobs).')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    scratch = os.environ.get('BENCH_DIR')
+    if not scratch:
+        parser.error('Set BENCH_DIR to the scratch directory to seed.')
+    os.environ.update(scratch_environment(scratch))
+    import django
+
+    django.setup()
+
+    started = time.perf_counter()
+    manifest = seed(args.users, args.files, args.downloads, args.distinct, random.Random(args.seed))
+    with open(os.path.join(scratch, 'manifest.json'), 'w') as fh:
+        json.dump(manifest, fh)
+    print(
+        f'Seeded {args.users} users, {args.files} files and {args.downloads} download logs '
+        f'in {time.perf_counter() - started:.1f}s.'
+    )
+
+
+if __name__ == '__main__':
+    main()
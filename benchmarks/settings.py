@@ -0,0 +1,28 @@
+"""Settings for the server process started by ``loadtest.py``.
+
+They are the project settings, with every writable path (the database,
+MEDIA_ROOT, previews and partial uploads) moved into the scratch
+directory named by ``BENCH_DIR``. There is also one extra middleware that
+reports each request's SQL query count in a response header.
+"""
+import os
+
+from config.settings import *  # noqa: F401,F403
+from config.settings import DATABASES, MIDDLEWARE
+
+BENCH_DIR = os.environ['BENCH_DIR']
+
+DEBUG = False
+ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
+
+for _alias in DATABASES.values():
+    _alias['NAME'] = os.path.join(BENCH_DIR, 'db.sqlite3')
+
+MEDIA_ROOT = os.path.join(BENCH_DIR, 'media')
+SHARE_PREVIEW_DIR = os.path.join(BENCH_DIR, 'previews')
+SHARE_CHUNKED_UPLOAD_DIR = os.path.join(BENCH_DIR, 'chunked_uploads')
+SHARE_GC_EXTRA_ROOTS = []
+# Every virtual user connects from 127.0.0.1 and would share one IP bucket.
+SHARE_THROTTLE = {'ENABLED': False}
+
+MIDDLEWARE = ['benchmarks.querycount.QueryCountMiddleware', *MIDDLEWARE]
@@ -0,0 +1,182 @@
+"""Concurrent slow-client downloads: sync WSGI view vs async ASGI view.
+
+Each simulated client downloads the same file and sleeps for every
+64 KiB it receives, like a phone on weak campus Wi-Fi. The WSGI run drives
+``config.wsgi.application`` from a fixed pool of worker threads, as a
+threaded WSGI server would; a worker is held for the whole slow transfer.
+The ASGI run drives ``config.asgi.application`` with every client as a
+coroutine on one event loop.
+
+    python benchmarks/slow_clients.py --clients 64 --workers 8 --size-kb 1024 --delay 0.02
+"""
+import argparse
+import asyncio
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import logged_in_cookie, percentile, setup_django, test_database
+
+# The client's pace: it sleeps ``--delay`` for every CHUNK bytes it receives.
+CHUNK = 64 * 1024
+
+
+def make_file(user, size):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    from share import blobs
+
+    return blobs.store_upload(user, SimpleUploadedFile('bench.txt', b'x' * size), content_type='text/plain')
+
+
+class ThreadSampler:
+    """Records the peak number of live threads while the benchmark runs."""
+
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(0.005):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_wsgi(path, cookie, clients, workers, delay):
+    from config.wsgi import application
+
+    def one_client(submitted):
+        # Latency includes time spent queued for a free worker thread.
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80', 'HTTP_HOST': 'testserver', 'HTTP_COOKIE': cookie, 'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(), 'wsgi.errors': io.StringIO(), 'wsgi.multithread': True, 'wsgi.multiprocess': False,
+            'wsgi.run_once': False, 'wsgi.version': (1, 0),
+        }
+        status = []
+        result = application(environ, lambda s, headers, exc_info=None: status.append(s))
+        received = 0
+        try:
+            for chunk in result:
+                received += len(chunk)
+                time.sleep(delay * len(chunk) / CHUNK)
+        finally:
+            result.close()
+        assert status[0].startswith('200'), status
+        return time.perf_counter() - submitted, received
+
+    with ThreadSampler() as sampler, ThreadPoolExecutor(max_workers=workers) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(one_client, [started] * clients))
+        elapsed = time.perf_counter() - started
+    return summarize('wsgi', results, elapsed, sampler.peak)
+
+
+def run_asgi(path, cookie, clients, delay):
+    from config.asgi import application
+
+    async def one_client():
+        started = time.perf_counter()
+        done = asyncio.Event()
+        request_sent = False
+        status, received = [], 0
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal received
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+            elif message['type'] == 'http.response.body':
+                if message.get('body'):
+                    received += len(message['body'])
+                    await asyncio.sleep(delay * len(message['body']) / CHUNK)
+                if not message.get('more_body'):
+                    done.set()
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        await application(scope, receive, send)
+        assert status == [200], status
+        return time.perf_counter() - started, received
+
+    async def main():
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one_client() for _ in range(clients)))
+        return results, time.perf_counter() - started
+
+    with ThreadSampler() as sampler:
+        results, elapsed = asyncio.run(main())
+    return summarize('asgi', results, elapsed, sampler.peak)
+
+
+def summarize(mode, results, elapsed, peak_threads):
+    latencies = [latency for latency, _ in results]
+    return {
+        'mode': mode,
+        'clients': len(results),
+        'wall_seconds': round(elapsed, 3),
+        'downloads_per_second': round(len(results) / elapsed, 2),
+        'mb_per_second': round(sum(size for _, size in results) / elapsed / 1024 / 1024, 2),
+        'p50_seconds': round(percentile(latencies, 50), 3),
+        'p95_seconds': round(percentile(latencies, 95), 3),
+        'p99_seconds': round(percentile(latencies, 99), 3),
+        'peak_threads': peak_threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=64, help='Concurrent slow clients.')
+    parser.add_argument('--workers', type=int, default=8, help='WSGI worker threads.')
+    parser.add_argument('--size-kb', type=int, default=1024, help='Size of the downloaded file.')
+    parser.add_argument('--delay', type=float, default=0.02, help='Client sleep per 64 KiB received, in seconds.')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results.')
+    args = parser.parse_args()
+
+    setup_django()
+    with test_database():
+        from django.contrib.auth.models import User
+
+        user = User.objects.create_user('bench', password='bench-password')
+        upload = make_file(user, args.size_kb * 1024)
+        cookie = logged_in_cookie(user)
+        results = [
+            run_wsgi(f'/share/files/{upload.id}/download/', cookie, args.clients, args.workers, args.delay),
+            run_asgi(f'/share/async/files/{upload.id}/download/', cookie, args.clients, args.delay),
+        ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{args.clients} clients, {args.size_kb} KiB file, {args.delay}s per 64 KiB received, {args.workers} WSGI threads')
+    for r in results:
+        print(
+            f"{r['mode']}: {r['wall_seconds']:.2f}s wall, {r['downloads_per_second']:.1f} downloads/s, "
+            f"p50 {r['p50_seconds']:.2f}s p95 {r['p95_seconds']:.2f}s p99 {r['p99_seconds']:.2f}s, "
+            f"peak threads {r['peak_threads']}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""SQLite under concurrent uploads, logins and listings: default vs tuned settings.
+
+Each configuration runs in its own process against a fresh database file.
+Worker threads act like a threaded WSGI server. Every operation is one
+"request" and ends with ``close_old_connections()``, as Django's
+request_finished handler does. The mix is:
+
+* upload (20%): in one transaction, look up the blob by digest, then
+  insert an ``UploadedFile``, which updates ``StorageStats`` through its
+  signal. This is the same read-then-write shape as ``blobs.store_upload``.
+* login (10%): create a session and update ``last_login``.
+* list (70%): one keyset file-list page plus the user's counters. In the
+  tuned run it goes through ``read_replica``.
+
+``default`` is the plain backend: rollback journal, DEFERRED
+transactions, the 5 s driver timeout and a new connection per request.
+``tuned`` uses ``settings.DATABASES`` (WAL, busy_timeout, IMMEDIATE,
+CONN_MAX_AGE and the read replica alias).
+
+    python benchmarks/sqlite_concurrency.py --threads 16 --seconds 10
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import percentile, setup_django
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def database_settings(config, name):
+    if config == 'default':
+        return {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name}}
+    from config import settings as project_settings
+
+    databases = copy.deepcopy(project_settings.DATABASES)
+    for alias in databases.values():
+        alias['NAME'] = name
+    return databases
+
+
+def run(config, threads, seconds, users):
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-sqlite-'), 'db.sqlite3')
+    setup_django(DATABASES=database_settings(config, path))
+
+    from django.contrib.auth.models import User
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.core.management import call_command
+    from django.db import OperationalError, close_old_connections, connection, transaction
+    from django.db.backends.signals import connection_created
+    from django.utils import timezone
+
+    from config.dbrouter import read_replica
+    from share import pagination, stats
+    from share.models import StoredBlob, UploadedFile
+
+    call_command('migrate', verbosity=0)
+    user_ids = [User.objects.create_user(f'bench{i}').id for i in range(users)]
+    connection.close()
+
+    opened = [0]
+    connection_created.connect(lambda **kwargs: opened.__setitem__(0, opened[0] + 1), weak=False)
+
+    def upload(user_id):
+        with transaction.atomic():
+            digest = '%064x' % random.getrandbits(256)
+            StoredBlob.objects.filter(digest=digest).first()
+            UploadedFile.objects.create(user_id=user_id, file=f'blobs/{digest}', name=f'{digest[:8]}.txt', size=1024)
+
+    def login(user_id):
+        session = SessionStore()
+        session['_auth_user_id'] = str(user_id)
+        session.create()
+        User.objects.filter(pk=user_id).update(last_login=timezone.now())
+
+    def list_files(user_id):
+        def page():
+            list(pagination.paginate(UploadedFile.objects.filter(user_id=user_id), limit=25)[0])
+            stats.StorageStats.objects.filter(user_id=user_id).first()
+        if config == 'default':
+            page()
+        else:
+            with read_replica():
+                page()
+
+    operations = [(upload, 20), (login, 10), (list_files, 70)]
+    results = {op.__name__: {'ok': 0, 'locked': 0, 'latencies': []} for op, _ in operations}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        rng = random.Random()
+        while time.perf_counter() < deadline:
+            op = rng.choices([op for op, _ in operations], weights=[w for _, w in operations])[0]
+            started = time.perf_counter()
+            try:
+                op(rng.choice(user_ids))
+                outcome = 'ok'
+            except OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                outcome = 'locked'
+            finally:
+                close_old_connections()
+            elapsed = time.perf_counter() - started
+            with lock:
+                results[op.__name__][outcome] += 1
+                if outcome == 'ok':
+                    results[op.__name__]['latencies'].append(elapsed)
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    summary = {'config': config, 'threads': threads, 'seconds': round(elapsed, 2), 'connections_opened': opened[0]}
+    for name, r in results.items():
+        summary[name] = {
+            'ok': r['ok'],
+            'locked': r['locked'],
+            'per_second': round(r['ok'] / elapsed, 1),
+            'p95_ms': round(percentile(r['latencies'], 95) * 1000, 1),
+        }
+    summary['total_ok_per_second'] = round(sum(r['ok'] for r in results.values()) / elapsed, 1)
+    summary['total_locked'] = sum(r['locked'] for r in results.values())
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--config', choices=['default', 'tuned'], help='Run one configuration in this process.')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results.')
+    args = parser.parse_args()
+
+    if args.config:
+        print(json.dumps(run(args.config, args.threads, args.seconds, args.users)))
+        return
+
+    summaries = []
+    for config in ('default', 'tuned'):
+        # Separate processes: Django's connection settings can't be swapped once in use.
+        output = subprocess.run(
+            [sys.executable, os.path.join(HERE, 'sqlite_concurrency.py'), '--config', config,
+             '--threads', str(args.threads), '--seconds', str(args.seconds), '--users', str(args.users)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        summaries.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+        return
+    print(f'{args.threads} threads for {args.seconds}s, {args.users} users')
+    for s in summaries:
+        print(
+            f"{s['config']:>8}: {s['total_ok_per_second']:.0f} ops/s, {s['total_locked']} 'database is locked', "
+            f"{s['connections_opened']} connections opened"
+        )
+        for name in ('upload', 'login', 'list_files'):
+            r = s[name]
+            print(f"          {name:<10} {r['per_second']:>7.1f}/s  p95 {r['p95_ms']:>7.1f} ms  locked {r['locked']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Read/write routing between the ``default`` and ``replica`` database aliases.
+
+Both aliases open the same SQLite file. In WAL mode readers never wait for
+the writer, so the ``replica`` alias gives read-heavy pages (file listing,
+dashboard, reports) their own persistent, ``query_only`` connection that
+is never queued behind a write transaction.
+
+Routing is opt-in. Only code running under ``read_replica`` (a view
+decorator and context manager) sends reads to ``replica``. Everything
+else, including any read made inside ``transaction.atomic()``, uses
+``default``.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+REPLICA = 'replica'
+
+_use_replica = ContextVar('use_replica', default=False)
+
+
+@contextmanager
+def _replica_reads():
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def read_replica(view_func=None):
+    """Send the ORM reads of a view (or a ``with`` block) to the ``replica`` alias.
+
+    Use it as ``@read_replica`` on a view, or as ``with read_replica():``.
+    """
+    if view_func is None:
+        return _replica_reads()
+
+    if iscoroutinefunction(view_func):
+        async def wrapper(*args, **kwargs):
+            with _replica_reads():
+                return await view_func(*args, **kwargs)
+        markcoroutinefunction(wrapper)
+    else:
+        def wrapper(*args, **kwargs):
+            with _replica_reads():
+                return view_func(*args, **kwargs)
+    return wraps(view_func)(wrapper)
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if (
+            _use_replica.get()
+            and REPLICA in settings.DATABASES
+            # Reads inside a transaction must see its own uncommitted writes.
+            and not connections['default'].in_atomic_block
+        ):
+            return REPLICA
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases are the same database.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
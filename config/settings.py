@@ -29,9 +29,15 @@ INSTALLED_APPS = [
 
 # ✅ Middleware
 MIDDLEWARE = [
+    # First, so its timings and query counts cover every other middleware.
+    'share.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    # Serves /s/<token> share links without sessions or auth, so it sits above them.
+    'share.links.ShareLinkMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    # Before CSRF, whose token check parses the body of POSTs that would be rejected anyway.
+    'share.throttle.ThrottleMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -59,13 +65,74 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
-# ✅ Database (SQLite for development)
+# ✅ Database (SQLite)
+# Every new connection switches to WAL (readers don't block the writer), waits up to
+# busy_timeout ms for a lock instead of failing with "database is locked", and starts
+# transactions IMMEDIATE so two of them can never deadlock upgrading a read lock to a
+# write lock. Connections are reused across requests for CONN_MAX_AGE seconds.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',     # fsync at checkpoints only; safe with WAL
+    'PRAGMA busy_timeout=20000',     # ms
+    'PRAGMA cache_size=-20000',      # KiB (negative) per connection
+    'PRAGMA mmap_size=268435456',    # bytes
+    'PRAGMA temp_store=MEMORY',
+]
+SQLITE_DATABASE = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': BASE_DIR / 'db.sqlite3',
+    'CONN_MAX_AGE': 600,
+    'CONN_HEALTH_CHECKS': True,
+    'OPTIONS': {
+        'init_command': ';'.join(SQLITE_PRAGMAS),
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': 20,
+    },
+}
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    'default': SQLITE_DATABASE,
+    # Same file, separate read-only connections for views wrapped in
+    # config.dbrouter.read_replica (file list, dashboard, reports).
+    'replica': {
+        **SQLITE_DATABASE,
+        'OPTIONS': {
+            'init_command': ';'.join(SQLITE_PRAGMAS + ['PRAGMA query_only=ON']),
+            'timeout': 20,
+        },
+        'TEST': {'MIRROR': 'default'},
+    },
 }
+DATABASE_ROUTERS = ['config.dbrouter.ReadReplicaRouter']
+
+# ✅ Cache (per-user versioned page data and fragments, see share/cache.py)
+# Local memory is private to each process. To share one cache between several
+# worker processes, set SECURECAMPUS_REDIS_URL (redis://host:6379/0, needs the
+# redis package) or SECURECAMPUS_CACHE_DIR to use the file-based backend.
+if os.environ.get('SECURECAMPUS_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['SECURECAMPUS_REDIS_URL'],
+        }
+    }
+elif os.environ.get('SECURECAMPUS_CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ['SECURECAMPUS_CACHE_DIR'],
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'securecampus',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+SHARED_CACHE = CACHES['default']['BACKEND'] != 'django.core.cache.backends.locmem.LocMemCache'
+SHARE_CACHE_TIMEOUT = 600  # seconds; stale entries are never read, this only bounds their lifetime
 
 # ✅ Password validation
 AUTH_PASSWORD_VALIDATORS = [
@@ -90,9 +157,122 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# ✅ Compression at rest for deduplicated blobs (see share/storage.py): text and
+# legacy Office files are gzipped unless it saves less than MIN_SAVING
+SHARE_BLOB_COMPRESSION = {
+    'ENABLED': True,
+    'LEVEL': 6,
+    'MIN_SIZE': 1024,     # bytes; smaller files are stored as-is
+    'MIN_SAVING': 0.1,    # fraction of the original size
+}
+
+# ✅ Upload handlers (hash uploads while they stream in for content-addressed storage)
+FILE_UPLOAD_HANDLERS = [
+    'share.uploadhandlers.HashingMemoryFileUploadHandler',
+    'share.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# ✅ Bulk uploads: files per request and validation/hashing threads
+SHARE_BULK_UPLOAD_MAX_FILES = 100
+SHARE_BULK_UPLOAD_WORKERS = 4
+DATA_UPLOAD_MAX_NUMBER_FILES = SHARE_BULK_UPLOAD_MAX_FILES
+
+# ✅ Resumable (chunked) uploads: partial files live outside MEDIA_ROOT until finalized
+SHARE_CHUNKED_UPLOAD_DIR = os.path.join(BASE_DIR, 'tmp', 'chunked_uploads')
+SHARE_CHUNKED_UPLOAD_MAX_AGE = 24 * 60 * 60  # seconds before an idle session is purged
+
+# ✅ gc_uploads: files younger than the grace period are never collected, and these
+# directories (from before MEDIA_ROOT was set) are swept along with MEDIA_ROOT
+SHARE_GC_GRACE_PERIOD = 24 * 60 * 60  # seconds
+SHARE_GC_EXTRA_ROOTS = [os.path.join(BASE_DIR, 'uploads')]
+
+# ✅ Per-user storage quota in bytes (None = unlimited)
+SHARE_USER_QUOTA_BYTES = 500 * 1024 * 1024
+
+# ✅ File list page size (keyset pagination)
+SHARE_FILE_LIST_PAGE_SIZE = 25
+
+# ✅ Previews: rendered on first request in a process pool, cached on disk by content
+# digest and evicted least-recently-used past SHARE_PREVIEW_CACHE_BYTES
+SHARE_PREVIEW_DIR = os.path.join(BASE_DIR, 'tmp', 'previews')
+SHARE_PREVIEW_CACHE_BYTES = 512 * 1024 * 1024
+SHARE_PREVIEW_WORKERS = 2
+SHARE_PREVIEW_SIZE = 256       # px, longest side
+SHARE_PREVIEW_TIMEOUT = 10     # seconds a request waits for a render
+SHARE_PREVIEW_PDFTOPPM = 'pdftoppm'  # poppler-utils; PDFs get no preview without it
+
+# ✅ Full-text search results per page (SQLite FTS5, see share/search.py)
+SHARE_SEARCH_PAGE_SIZE = 20
+
+# ✅ Most files that can be bundled into one ZIP download
+SHARE_ZIP_MAX_FILES = 500
+
+# ✅ Download logging: 'buffered' batches inserts in a background thread,
+# 'sync' writes each row immediately (tests), 'off' disables logging
+SHARE_DOWNLOAD_LOG = {
+    'MODE': 'buffered',
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 5.0,   # seconds
+    'MAX_PENDING': 10000,
+    'OVERFLOW': 'drop',      # or 'block'
+}
+
+# ✅ Download offload: None (Django streams the file), 'x-sendfile' (Apache/lighttpd)
+# or 'x-accel-redirect' (nginx, with an internal location mapped to MEDIA_ROOT)
+SHARE_SENDFILE = None
+SHARE_SENDFILE_URL_PREFIX = '/protected/'
+
+# ✅ Rate limits: sliding-window counters per client IP and per user, kept in the default
+# cache (see share/throttle.py). Each limit is (requests, per this many seconds); the
+# cache must be shared (Redis, memcached) for the limits to cover every worker
+SHARE_THROTTLE = {
+    'ENABLED': True,
+    'RATES': {
+        'login': {'user': (5, 300), 'ip': (20, 60)},    # the user limit is the submitted username
+        'upload': {'user': (30, 60), 'ip': (60, 60)},
+        'download': {'user': (120, 60), 'ip': (300, 60)},
+        'link': {'ip': (120, 60)},                      # anonymous share-link downloads
+    },
+    # Proxies whose X-Forwarded-For is believed, e.g. ['127.0.0.1'] behind a local
+    # nginx; without this every client behind the proxy shares one ip limit
+    'TRUSTED_PROXIES': [],
+}
+
+# ✅ Share links: signed, expiring /s/<token> URLs (see share/links.py)
+SHARE_LINKS = {
+    'DEFAULT_AGE': 7 * 24 * 60 * 60,    # seconds
+    'MAX_AGE': 30 * 24 * 60 * 60,
+    'REVOCATION_REFRESH': 60,           # seconds a process trusts its cached revocation list
+}
+
+# ✅ Request metrics served at /metrics in the Prometheus text format (see share/metrics.py);
+# set SLOW_REQUEST_SECONDS to log slower requests with their slowest queries
+SHARE_METRICS = {
+    'ENABLED': True,
+    # Client addresses that may scrape without logging in; staff always can. Behind a
+    # proxy, list it in SHARE_THROTTLE['TRUSTED_PROXIES'] so the real client is checked.
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+    'TOKEN': os.environ.get('SECURECAMPUS_METRICS_TOKEN'),  # or send "Authorization: Bearer <token>"
+    'SLOW_REQUEST_SECONDS': None,
+    'SLOW_REQUEST_TOP_QUERIES': 5,
+}
+
 # ✅ Default primary key field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# ✅ With a cache shared by every worker, sessions and the logged-in user are read
+# from it and session writes go through to the database (see share/auth.py). A
+# per-process cache would keep serving a session or user another worker has
+# logged out or deactivated, so without one both come straight from the database
+# (`manage.py check` reports the unsafe combination). ModelBackend stays listed
+# so sessions stored under either backend keep working when this switches.
+if SHARED_CACHE:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+    AUTHENTICATION_BACKENDS = ['share.auth.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend']
+else:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+    AUTHENTICATION_BACKENDS = ['django.contrib.auth.backends.ModelBackend']
+
 # ✅ Authentication redirects
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard'
@@ -2,7 +2,4 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'main'
-
-    def ready(self):
-        import main.signals
\ No newline at end of file
+    name = 'main'
\ No newline at end of file
@@ -1,24 +1,79 @@
 from django.contrib import admin
-from .models import UploadedFile, DownloadLog
+from .models import UploadedFile, DownloadLog, StoredBlob, DailyFileDownloads, DailyUserDownloads, RollupWatermark, OutboxEmail, ShareLink
+from django.urls import reverse
 from django.utils.html import format_html
+from config.dbrouter import read_replica
+
+
+class ReplicaChangeListMixin:
+    # Report-style changelists only read, so GETs are served from the replica connection.
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with read_replica():
+            response = super().changelist_view(request, extra_context)
+            # TemplateResponse evaluates the querysets while rendering.
+            if hasattr(response, 'render'):
+                response.render()
+            return response
 
 @admin.register(UploadedFile)
 class UploadedFileAdmin(admin.ModelAdmin):
-    list_display = ('file', 'user', 'uploaded_at', 'download_link')
+    list_display = ('display_name', 'user', 'size', 'uploaded_at', 'download_link')
+    list_select_related = ('user',)
 
     def download_link(self, obj):
         return format_html(
             '<a href="{}" download>📥 Download</a>',
-            obj.file.url
+            # Through the view, not MEDIA_URL: compressed blobs must be decoded on the way out.
+            reverse('share:download_file', args=[obj.pk])
         )
     download_link.short_description = 'Download File'
 
+@admin.register(StoredBlob)
+class StoredBlobAdmin(admin.ModelAdmin):
+    list_display = ('digest', 'size', 'stored_size', 'encoding', 'ref_count', 'created_at')
+    search_fields = ('digest',)
+    readonly_fields = ('digest', 'file', 'size', 'stored_size', 'encoding', 'ref_count', 'created_at')
+
 @admin.register(DownloadLog)
-class DownloadLogAdmin(admin.ModelAdmin):
+class DownloadLogAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     list_display = ('user', 'file_name', 'timestamp')
     list_filter = ('timestamp',)
-    search_fields = ('user_username', 'file_file')
+    search_fields = ('user__username', 'file__name', 'file__file')
 
     def file_name(self, obj):
-        return obj.file.file.name.split('/')[-1]
-    file_name.short_description = 'File'
\ No newline at end of file
+        return obj.file.display_name
+    file_name.short_description = 'File'
+
+@admin.register(DailyFileDownloads)
+class DailyFileDownloadsAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ('date', 'file', 'owner', 'downloads')
+    list_filter = ('date',)
+    list_select_related = ('file', 'owner')
+    date_hierarchy = 'date'
+
+@admin.register(DailyUserDownloads)
+class DailyUserDownloadsAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    list_display = ('date', 'user', 'downloads')
+    list_filter = ('date',)
+    list_select_related = ('user',)
+    date_hierarchy = 'date'
+
+@admin.register(RollupWatermark)
+class RollupWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('name', 'last_id', 'updated_at')
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('subject',)
+
+@admin.register(ShareLink)
+class ShareLinkAdmin(admin.ModelAdmin):
+    list_display = ('jti', 'file', 'created_by', 'permissions', 'expires_at', 'revoked_at')
+    list_filter = ('revoked_at',)
+    list_select_related = ('file', 'created_by')
+    search_fields = ('jti',)
+    readonly_fields = ('jti', 'file', 'created_by', 'permissions', 'created_at')
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ShareConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'share'
+
+    def ready(self):
+        import share.signals
@@ -0,0 +1,108 @@
+"""Async variants of the download, upload and file list views for ASGI deployments.
+
+Under WSGI a slow client holds a worker thread for the whole transfer;
+here it only holds a coroutine. Auth and ORM access use the async APIs
+(``request.auser()``, ``aget``, ``afirst``, ``async for``), and blocking
+work (disk reads, multipart parsing, blob writes inside a transaction) is
+pushed to worker threads with ``sync_to_async``.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
+from django.http import Http404
+from django.shortcuts import redirect, render
+
+from config.dbrouter import read_replica
+
+from . import blobs, cache, downloads, logbuffer, pagination, stats
+from .forms import UploadFileForm
+from .models import UploadedFile
+from .throttle import throttle
+
+
+# DOWNLOAD FILE
+@login_required
+@throttle('download')
+async def download_file(request, file_id):
+    user = await request.auser()
+    try:
+        file = await UploadedFile.objects.select_related('blob').aget(id=file_id)
+    except UploadedFile.DoesNotExist:
+        raise Http404('No UploadedFile matches the given query.')
+    if user.id != file.user_id and not user.is_staff:
+        messages.error(request, "Unauthorized access")
+        return redirect('share:file_list_async')
+    # Opening and stat()ing the file happen in a thread; the body is streamed by an async iterator.
+    response = await sync_to_async(downloads.serve_upload, thread_sensitive=False)(request, file, asynchronous=True)
+    if downloads.counts_as_download(request, response):
+        await sync_to_async(logbuffer.record_download)(user, file)
+    return response
+
+
+# FILE UPLOAD
+def _validated_upload_form(request):
+    # Parsing the multipart body reads the spooled request file.
+    form = UploadFileForm(request.POST, request.FILES)
+    form.is_valid()
+    return form
+
+@login_required
+@throttle('upload', methods=('POST',))
+async def upload_file(request):
+    if request.method == 'POST':
+        user = await request.auser()
+        form = await sync_to_async(_validated_upload_form)(request)
+        if not form.errors:
+            uploaded_file = form.cleaned_data['file']
+            try:
+                await stats.acheck_quota(user, uploaded_file.size)
+            except ValidationError as e:
+                messages.error(request, e.messages[0])
+                return redirect('share:upload_file_async')
+            await sync_to_async(blobs.store_upload)(user, uploaded_file, content_type=uploaded_file.detected_type)
+            messages.success(request, '✅ File uploaded successfully.')
+            return redirect('share:file_list_async')
+        for error in form.errors.get('file', []):
+            messages.error(request, error)
+    return await sync_to_async(render)(request, 'share/upload.html')
+
+
+# FILE LIST
+@login_required
+@read_replica
+async def file_list(request):
+    user = await request.auser()
+    try:
+        limit = min(max(int(request.GET.get('limit', settings.SHARE_FILE_LIST_PAGE_SIZE)), 1), 100)
+    except ValueError:
+        limit = settings.SHARE_FILE_LIST_PAGE_SIZE
+    sort = request.GET.get('sort', pagination.DEFAULT_SORT)
+    after, before = request.GET.get('after'), request.GET.get('before')
+
+    async def compute():
+        files, next_cursor, previous_cursor = await pagination.apaginate(
+            UploadedFile.objects.filter(user=user),
+            sort=sort,
+            after=after,
+            before=before,
+            limit=limit,
+        )
+        return {
+            'files': files,
+            'sort': sort if sort in pagination.SORTS else pagination.DEFAULT_SORT,
+            'next_cursor': next_cursor,
+            'previous_cursor': previous_cursor,
+            'total': (await stats.afor_user(user)).file_count,
+        }
+
+    user_version = await cache.aversion(user.id)
+    try:
+        page = await cache.aget_or_compute(
+            user.id, 'file_page', (sort, after, before, limit), compute, user_version=user_version
+        )
+    except pagination.InvalidCursor:
+        return redirect('share:file_list_async')
+    context = {**page, **cache.fragment_context(user_version)}
+    return await sync_to_async(render)(request, 'share/file_list.html', context)
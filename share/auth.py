@@ -0,0 +1,97 @@
+"""Resolve the logged-in user from the cache instead of the database.
+
+Sessions use the ``cached_db`` engine: reads come from the cache, and
+writes go through to the database. ``CachedModelBackend`` does the same
+for the ``User`` row that ``AuthenticationMiddleware`` loads on every
+request. With a warm cache, an authenticated page view runs no auth
+queries at all.
+
+Cached users are keyed by id and a per-user version, as in ``cache``.
+Saving or deleting a ``User`` replaces the version, so a password
+change, a deactivation or ``verify_email`` activating an account takes
+effect on the next request. Bulk ``update()`` calls skip signals; call
+``invalidate`` after them.
+
+Both only stay correct when every worker process sees the same cache:
+with a per-process one, a logout or deactivation in one worker never
+reaches the copies held by the others. ``check_shared_cache`` makes
+``manage.py check`` (and ``runserver``/``migrate``) fail for that
+combination; the settings only enable this mode with a shared cache
+(``SECURECAMPUS_REDIS_URL`` or ``SECURECAMPUS_CACHE_DIR``).
+
+Sessions remember the backend that authenticated them, so
+``ModelBackend`` stays in ``AUTHENTICATION_BACKENDS`` after this one;
+sessions from either side survive turning the cache on or off.
+"""
+import secrets
+
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+
+BACKEND_PATH = 'share.auth.CachedModelBackend'
+CACHED_SESSION_ENGINES = {'django.contrib.sessions.backends.cache', 'django.contrib.sessions.backends.cached_db'}
+# Backends whose contents are private to one process (or absent).
+PROCESS_LOCAL_CACHES = {'django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache'}
+
+
+def _version_key(user_id):
+    return f'share:auth:user:{user_id}:version'
+
+
+def _bump(user_id):
+    cache.set(_version_key(user_id), secrets.randbits(63), timeout=None)
+
+
+def invalidate(user_id):
+    """Stop serving the cached copy of the user, now and again once the transaction commits."""
+    # Now, so the rest of this request sees the change; after commit, because a
+    # concurrent request may have cached the old row before the commit.
+    _bump(user_id)
+    transaction.on_commit(lambda: _bump(user_id))
+
+
+def _user_key(user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        cache.add(_version_key(user_id), secrets.randbits(63), timeout=None)
+        version = cache.get(_version_key(user_id))
+    return f'share:auth:user:{user_id}:{version}'
+
+
+class CachedModelBackend(ModelBackend):
+    """``ModelBackend`` whose ``get_user`` reads through the cache."""
+
+    def get_user(self, user_id):
+        key = _user_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            # Inactive users come back as None and are never cached.
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.SHARE_CACHE_TIMEOUT)
+        return user
+
+
+def _process_local(alias):
+    return settings.CACHES.get(alias, {}).get('BACKEND') in PROCESS_LOCAL_CACHES
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs=None, **kwargs):
+    errors = []
+    if settings.SESSION_ENGINE in CACHED_SESSION_ENGINES and _process_local(settings.SESSION_CACHE_ALIAS):
+        errors.append(checks.Error(
+            f'SESSION_ENGINE {settings.SESSION_ENGINE!r} needs a cache shared by every worker process.',
+            hint="Configure Redis or memcached, or use 'django.contrib.sessions.backends.db'.",
+            id='share.E001',
+        ))
+    if BACKEND_PATH in settings.AUTHENTICATION_BACKENDS and _process_local('default'):
+        errors.append(checks.Error(
+            f'{BACKEND_PATH} needs a cache shared by every worker process.',
+            hint="Configure Redis or memcached, or use 'django.contrib.auth.backends.ModelBackend'.",
+            id='share.E002',
+        ))
+    return errors
@@ -0,0 +1,210 @@
+"""Content-addressed storage for uploaded files.
+
+Every distinct upload is stored once under its SHA-256 digest and shared
+by all ``UploadedFile`` rows with the same bytes. ``StoredBlob.ref_count``
+tracks how many rows point at a blob; the file on disk is removed when the
+last reference is released.
+
+Storing is split in two. ``stage`` writes (and maybe gzips) the bytes to a
+temporary name and must run before the transaction: SQLite transactions
+start ``IMMEDIATE``, so anything inside one holds the database-wide write
+lock. ``acquire`` then runs inside the transaction and only takes the
+reference or inserts the row, renaming the staged file into place.
+``discard`` removes whatever was staged but not used.
+"""
+import hashlib
+import os
+import uuid
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+
+from . import layout, storage
+from .models import StoredBlob, UploadedFile
+from .storage import blob_storage
+
+BLOB_PREFIX = 'blobs'
+# Staged files are swept by gc_uploads like any other unreferenced file.
+STAGING_PREFIX = f'{BLOB_PREFIX}/staging'
+
+
+def blob_name(digest):
+    return f'{BLOB_PREFIX}/{layout.shard(digest)}'
+
+
+def file_digest(uploaded_file):
+    """Return the hex SHA-256 of an upload, reusing the digest computed while it streamed in."""
+    digest = getattr(uploaded_file, 'sha256', None)
+    if digest:
+        return digest
+    hasher = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        hasher.update(chunk)
+    uploaded_file.seek(0)
+    return hasher.hexdigest()
+
+
+def _take_reference(digest, count=1):
+    if StoredBlob.objects.filter(digest=digest).update(ref_count=F('ref_count') + count):
+        return StoredBlob.objects.get(digest=digest)
+    return None
+
+
+def _write(uploaded_file):
+    """Save the bytes under a fresh staging name; return the blob's storage fields.
+
+    The storage may gzip them, in which case the name gets a ``.gz`` suffix.
+    """
+    # Read the size up front: saving may move a temporary file out from under us.
+    size = uploaded_file.size
+    name = blob_storage.save(f'{STAGING_PREFIX}/{uuid.uuid4().hex}', uploaded_file)
+    return {'file': name, 'size': size, 'encoding': storage.encoding_for(name), 'stored_size': blob_storage.size(name)}
+
+
+def stage(uploaded_file, digest):
+    """Write ``uploaded_file`` for ``acquire`` unless a blob with ``digest`` already exists.
+
+    Call this outside any transaction. Returns the staged fields, or ``None``.
+    """
+    if StoredBlob.objects.filter(digest=digest).exists():
+        return None
+    return _write(uploaded_file)
+
+
+def stage_many(files_by_digest):
+    """``stage`` for several files, with one query for the digests already stored."""
+    existing = set(StoredBlob.objects.filter(digest__in=files_by_digest).values_list('digest', flat=True))
+    return {
+        digest: None if digest in existing else _write(uploaded_file)
+        for digest, uploaded_file in files_by_digest.items()
+    }
+
+
+def discard(staged):
+    """Delete a staged file that ``acquire`` did not move into place."""
+    if staged is not None and staged['file'].startswith(STAGING_PREFIX + '/'):
+        blob_storage.delete(staged['file'])
+
+
+def _publish(digest, staged):
+    # A rename within one filesystem: cheap enough to do while holding the lock.
+    name = blob_name(digest) + (storage.SUFFIX if staged['encoding'] == storage.GZIP else '')
+    if staged['file'] != name:
+        path = blob_storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(blob_storage.path(staged['file']), path)
+        staged['file'] = name
+    return name
+
+
+def _acquire(uploaded_file, digest, staged, count):
+    blob = _take_reference(digest, count)
+    if blob is not None:
+        return blob
+    if staged is None:
+        # The blob was released between stage() and this transaction; write the bytes now.
+        staged = _write(uploaded_file)
+    name = _publish(digest, staged)
+    fields = {key: staged[key] for key in ('size', 'encoding', 'stored_size')}
+    try:
+        with transaction.atomic():
+            return StoredBlob.objects.create(digest=digest, ref_count=count, file=name, **fields)
+    except IntegrityError:
+        # A concurrent upload of the same bytes created the row first
+        # (only possible where transactions don't take the write lock up front).
+        blob = _take_reference(digest, count)
+        if blob is None:
+            raise RuntimeError(f'Blob {digest} was created and released while this upload stored it.')
+        if blob.file.name != name:
+            blob_storage.delete(name)
+        return blob
+
+
+def acquire(uploaded_file, digest=None, staged=None):
+    """Return the blob holding ``uploaded_file``'s bytes, taking one reference on it.
+
+    Pass what ``stage`` returned. Without it, bytes that are not stored yet
+    are written here, inside the caller's transaction.
+    """
+    digest = digest or file_digest(uploaded_file)
+    with transaction.atomic():
+        return _acquire(uploaded_file, digest, staged, 1)
+
+
+def acquire_many(files_by_digest, counts, staged):
+    """Take ``counts[digest]`` references on the blob for each digest, in a handful of queries.
+
+    ``files_by_digest`` maps each digest to one file with those bytes, and
+    ``staged`` is what ``stage_many`` returned for it. Returns ``{digest: StoredBlob}``.
+    """
+    counts = Counter(counts)
+    with transaction.atomic():
+        existing = set(StoredBlob.objects.filter(digest__in=counts).values_list('digest', flat=True))
+        if existing:
+            StoredBlob.objects.filter(digest__in=existing).update(
+                ref_count=F('ref_count') + Case(*[When(digest=d, then=Value(counts[d])) for d in existing])
+            )
+        missing = counts.keys() - existing
+        if any(staged.get(digest) is None for digest in missing):
+            # Released since stage_many(); take the one-at-a-time path that can write them.
+            for digest in missing:
+                _acquire(files_by_digest[digest], digest, staged.get(digest), counts[digest])
+        else:
+            new_blobs = [
+                StoredBlob(
+                    digest=digest, file=_publish(digest, staged[digest]), ref_count=counts[digest],
+                    size=staged[digest]['size'], encoding=staged[digest]['encoding'],
+                    stored_size=staged[digest]['stored_size'],
+                )
+                for digest in missing
+            ]
+            try:
+                with transaction.atomic():
+                    StoredBlob.objects.bulk_create(new_blobs)
+            except IntegrityError:
+                # Raced with a concurrent upload of some of the same bytes; fall back to one at a time.
+                for blob in new_blobs:
+                    _acquire(files_by_digest[blob.digest], blob.digest, staged[blob.digest], counts[blob.digest])
+        return {blob.digest: blob for blob in StoredBlob.objects.filter(digest__in=counts)}
+
+
+def release(blob_id):
+    """Drop one reference on a blob, deleting it from storage once nothing points at it."""
+    with transaction.atomic():
+        StoredBlob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') - 1)
+        blob = StoredBlob.objects.filter(pk=blob_id, ref_count=0).first()
+        if blob is None:
+            return
+        digest, name = blob.digest, blob.file.name
+        blob.delete()
+
+    def delete_file():
+        # The same bytes may have been uploaded again since. _publish renames a new
+        # file into place inside the transaction that inserts its row, so check for
+        # the row and unlink while holding the write lock too: otherwise an upload
+        # could publish between our check and the unlink and lose its file.
+        with transaction.atomic():
+            if not StoredBlob.objects.filter(digest=digest).exists():
+                blob_storage.delete(name)
+
+    transaction.on_commit(delete_file)
+
+
+def store_upload(user, uploaded_file, **fields):
+    """Create an ``UploadedFile`` for ``user`` backed by a shared blob."""
+    digest = file_digest(uploaded_file)
+    staged = stage(uploaded_file, digest)
+    try:
+        with transaction.atomic():
+            blob = acquire(uploaded_file, digest, staged)
+            return UploadedFile.objects.create(
+                user=user,
+                blob=blob,
+                file=blob.file.name,
+                name=uploaded_file.name,
+                size=blob.size,
+                **fields
+            )
+    finally:
+        discard(staged)
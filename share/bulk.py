@@ -0,0 +1,77 @@
+"""Multi-file uploads: concurrent validation, one transaction, one INSERT.
+
+Each file is validated and hashed in a bounded thread pool. Hashing and
+sniffing are mostly I/O and C code that releases the GIL. New blobs are
+written before the transaction opens; inside it, accepted files take
+their blob references in a few set-based queries, and all their
+``UploadedFile`` rows are written with one ``bulk_create`` in a single
+transaction. A bad file is reported in its own result and does not fail
+the rest of the batch.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import blobs, stats
+from .forms import validate_upload
+from .models import StorageStats, UploadedFile
+from .signals import uploads_bulk_created
+
+
+def _check(uploaded_file):
+    try:
+        content_type = validate_upload(uploaded_file)
+        digest = blobs.file_digest(uploaded_file)
+    except ValidationError as e:
+        return None, None, e.messages[0]
+    return content_type, digest, None
+
+
+def store_many(user, files):
+    """Store every valid file in ``files`` for ``user``; returns one result dict per file, in order."""
+    with ThreadPoolExecutor(max_workers=max(1, min(settings.SHARE_BULK_UPLOAD_WORKERS, len(files)))) as pool:
+        checked = list(pool.map(_check, files))
+
+    quota = stats.quota_bytes()
+    used = StorageStats.objects.filter(user=user).values_list('bytes_used', flat=True).first() or 0
+    results, accepted = [], []
+    for uploaded_file, (content_type, digest, error) in zip(files, checked):
+        if error is None and quota is not None and used + uploaded_file.size > quota:
+            error = 'Upload would exceed your storage quota.'
+        if error is not None:
+            results.append({'name': uploaded_file.name, 'ok': False, 'error': error})
+            continue
+        used += uploaded_file.size
+        accepted.append((uploaded_file, content_type, digest))
+        results.append({'name': uploaded_file.name, 'ok': True})
+
+    if accepted:
+        files_by_digest = {digest: uploaded_file for uploaded_file, _, digest in accepted}
+        # Written before the transaction, so the write lock is only held for the inserts.
+        staged = blobs.stage_many(files_by_digest)
+        try:
+            with transaction.atomic():
+                stored = blobs.acquire_many(files_by_digest, [digest for _, _, digest in accepted], staged)
+                uploads = UploadedFile.objects.bulk_create([
+                    UploadedFile(
+                        user=user,
+                        blob=stored[digest],
+                        file=stored[digest].file.name,
+                        name=uploaded_file.name,
+                        size=stored[digest].size,
+                        content_type=content_type,
+                    )
+                    for uploaded_file, content_type, digest in accepted
+                ])
+                uploads_bulk_created.send(sender=UploadedFile, user=user, uploads=uploads)
+        finally:
+            for fields in staged.values():
+                blobs.discard(fields)
+        created = iter(uploads)
+        for result in results:
+            if result['ok']:
+                upload = next(created)
+                result.update(id=upload.id, size=upload.size)
+    return results
@@ -0,0 +1,85 @@
+"""Per-user versioned caching for pages built from a user's files.
+
+Every cache key embeds the user's current version, which is stored under
+its own key. Changing any of the user's ``UploadedFile`` rows replaces the
+version, after the transaction commits. Entries under the old version are
+then never read again and simply expire, so nothing has to find and
+delete them.
+
+A bump writes a new random version instead of calling ``incr()``.
+``incr()`` is a non-atomic get-and-set in the file-based backend, and two
+processes bumping at once could otherwise both write the same "next"
+number.
+"""
+import hashlib
+import secrets
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+def _version_key(user_id):
+    return f'share:user:{user_id}:version'
+
+
+def version(user_id):
+    """Return the user's cache version, creating one if the cache has none."""
+    current = cache.get(_version_key(user_id))
+    if current is None:
+        cache.add(_version_key(user_id), secrets.randbits(63), timeout=None)
+        current = cache.get(_version_key(user_id))
+    return current
+
+
+async def aversion(user_id):
+    current = await cache.aget(_version_key(user_id))
+    if current is None:
+        await cache.aadd(_version_key(user_id), secrets.randbits(63), timeout=None)
+        current = await cache.aget(_version_key(user_id))
+    return current
+
+
+def bump(user_id):
+    """Invalidate everything cached for the user once the current transaction commits."""
+    # Bumping before commit would let a concurrent request cache the old rows under the new version.
+    transaction.on_commit(lambda: cache.set(_version_key(user_id), secrets.randbits(63), timeout=None))
+
+
+def make_key(user_id, name, *parts, user_version=None):
+    if user_version is None:
+        user_version = version(user_id)
+    digest = hashlib.md5(repr(parts).encode(), usedforsecurity=False).hexdigest()
+    return f'share:user:{user_id}:{user_version}:{name}:{digest}'
+
+
+def get_or_compute(user_id, name, parts, compute, user_version=None):
+    """Return the cached value for ``(name, parts)``, computing and storing it on a miss.
+
+    The version is read before ``compute()`` runs. A change that commits in
+    between then only caches the fresh result under a version that is
+    already out of date.
+    """
+    key = make_key(user_id, name, *parts, user_version=user_version)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, settings.SHARE_CACHE_TIMEOUT)
+    return value
+
+
+async def aget_or_compute(user_id, name, parts, compute, user_version=None):
+    """Async ``get_or_compute``; ``compute`` is a coroutine function."""
+    if user_version is None:
+        user_version = await aversion(user_id)
+    key = make_key(user_id, name, *parts, user_version=user_version)
+    value = await cache.aget(key)
+    if value is None:
+        value = await compute()
+        await cache.aset(key, value, settings.SHARE_CACHE_TIMEOUT)
+    return value
+
+
+def fragment_context(user_version):
+    """Template variables for ``{% cache cache_timeout name user.id cache_version ... %}`` fragments."""
+    return {'cache_version': user_version, 'cache_timeout': settings.SHARE_CACHE_TIMEOUT}
@@ -0,0 +1,176 @@
+"""Resumable chunked uploads (a small subset of the tus protocol).
+
+A client creates an ``UploadSession`` with the total length, PATCHes bytes
+at the current offset until the session is complete, then finalizes it
+into an ``UploadedFile``. Request bodies are copied to the partial file in
+fixed-size reads, so memory use per upload does not grow with file size.
+
+A PATCH holds an exclusive ``flock`` on the partial file while it checks
+the offset, writes and records the new offset, so two PATCHes at the same
+offset cannot both write; the second gets ``UploadLocked`` (423). The
+file's type is checked from its first bytes as they arrive, and again on
+finalizing, so even an empty file is checked.
+"""
+import base64
+import binascii
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Windows (development only): concurrent PATCHes to one session are not serialized.
+    fcntl = None
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db.models import F
+from django.utils import timezone
+
+from . import blobs, sniff, stats
+from .forms import ALLOWED_CONTENT_TYPES, ALLOWED_EXTENSIONS, MAX_UPLOAD_SIZE_BYTES, MAX_UPLOAD_SIZE_MB
+from .models import UploadSession
+
+READ_SIZE = 64 * 1024
+
+
+class OffsetMismatch(Exception):
+    pass
+
+
+class UploadLocked(Exception):
+    """Another request is writing to this session right now."""
+
+
+class PartialFile(File):
+    # Exposing temporary_file_path() lets FileSystemStorage move the
+    # finished partial file into place instead of copying it.
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def parse_metadata(header):
+    """Decode a tus ``Upload-Metadata`` header (``key base64value, ...``)."""
+    metadata = {}
+    for pair in filter(None, (p.strip() for p in header.split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode() if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise ValidationError(f'Invalid Upload-Metadata value for "{key}".')
+    return metadata
+
+
+def validate_declared_upload(filename, length, content_type=None):
+    if not filename:
+        raise ValidationError('A filename is required.')
+    if length < 0:
+        raise ValidationError('Upload-Length must not be negative.')
+    if length > MAX_UPLOAD_SIZE_BYTES:
+        raise ValidationError(f'File size exceeds maximum limit of {MAX_UPLOAD_SIZE_MB} MB.', code='too_large')
+    if not any(filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
+        raise ValidationError('Invalid file extension.')
+    if content_type and content_type not in ALLOWED_CONTENT_TYPES:
+        raise ValidationError(f'Unsupported file type ({content_type}).')
+
+
+def create_session(user, filename, length, content_type=None):
+    filename = os.path.basename(filename or '')
+    validate_declared_upload(filename, length, content_type)
+    stats.check_quota(user, length)
+    session = UploadSession.objects.create(user=user, filename=filename, length=length)
+    os.makedirs(os.path.dirname(session.path), exist_ok=True)
+    open(session.path, 'wb').close()
+    return session
+
+
+def _try_lock(fh):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def append_chunk(session, stream, offset):
+    """Append the body of ``stream`` at ``offset`` and return the new offset.
+
+    Bytes received before a dropped connection are kept, so the client can
+    resume from the offset reported by the next HEAD request.
+    """
+    if offset != session.offset:
+        raise OffsetMismatch(session.offset)
+
+    with open(session.path, 'r+b') as fh:
+        # Released when the file is closed, after the new offset is saved.
+        if not _try_lock(fh):
+            raise UploadLocked()
+        # A PATCH that held the lock before us may have moved the offset.
+        session.offset = UploadSession.objects.values_list('offset', flat=True).get(pk=session.pk)
+        if offset != session.offset:
+            raise OffsetMismatch(session.offset)
+
+        written = 0
+        try:
+            fh.seek(offset)
+            # Discard anything left past the committed offset by an earlier failed PATCH.
+            fh.truncate()
+            while True:
+                chunk = stream.read(READ_SIZE)
+                if not chunk:
+                    break
+                if not session.content_type:
+                    _sniff(session, fh, offset + written, chunk)
+                if offset + written + len(chunk) > session.length:
+                    fh.truncate(offset)
+                    written = 0
+                    raise ValidationError('Chunk runs past the declared Upload-Length.', code='too_large')
+                fh.write(chunk)
+                written += len(chunk)
+        finally:
+            if written:
+                fh.flush()
+                # update() skips auto_now; the purge command finds idle sessions by updated_at.
+                UploadSession.objects.filter(pk=session.pk, offset=offset).update(
+                    offset=F('offset') + written, updated_at=timezone.now()
+                )
+    session.offset = offset + written
+    return session.offset
+
+
+def _sniff(session, fh, position, chunk):
+    # Check the type as soon as the first SNIFF_BYTES (or the whole file) are in hand,
+    # before the chunk that completes them is written.
+    if position + len(chunk) < min(sniff.SNIFF_BYTES, session.length):
+        return
+    fh.seek(0)
+    head = fh.read(position) + chunk[:sniff.SNIFF_BYTES]
+    fh.seek(position)
+    session.content_type = sniff.check(head, session.filename)
+    UploadSession.objects.filter(pk=session.pk).update(content_type=session.content_type, updated_at=timezone.now())
+
+
+def finalize(session):
+    """Turn a complete session into an ``UploadedFile`` and discard the session."""
+    if not session.is_complete:
+        raise ValidationError(f'Upload is incomplete ({session.offset} of {session.length} bytes).')
+    # Checked again here: other uploads may have finished since the session was created.
+    stats.check_quota(session.user, session.length)
+    with open(session.path, 'rb') as fh:
+        # Sniffing during PATCH never sees a zero-length file, so check every file here.
+        session.content_type = sniff.check(fh.read(sniff.SNIFF_BYTES), session.filename)
+        fh.seek(0)
+        uploaded = blobs.store_upload(
+            session.user, PartialFile(fh, name=session.filename), content_type=session.content_type
+        )
+    discard(session)
+    return uploaded
+
+
+def discard(session):
+    try:
+        os.remove(session.path)
+    except FileNotFoundError:
+        pass
+    session.delete()
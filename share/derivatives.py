@@ -0,0 +1,92 @@
+"""Preview renderers that run inside the preview process pool.
+
+This module imports nothing from Django, so spawned worker processes
+start quickly and never touch settings or database connections. Each
+renderer writes to a temporary path, and ``render`` moves the result into
+place atomically. A failed render leaves an empty file behind, which
+tells later requests that this content has no preview.
+
+A source stored gzipped (see ``storage``) is decompressed as it is read.
+"""
+import gzip
+import os
+import shutil
+import subprocess
+
+
+def _open(source, encoding):
+    return gzip.open(source, 'rb') if encoding == 'gzip' else open(source, 'rb')
+
+
+def _thumbnail(source, dest, options, encoding):
+    from PIL import Image
+
+    size = (options['size'], options['size'])
+    with _open(source, encoding) as fh, Image.open(fh) as image:
+        # Lets the JPEG decoder downscale while decoding instead of decoding every pixel.
+        image.draft('RGB', size)
+        image.thumbnail(size)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(dest, 'JPEG', quality=80, optimize=True)
+    return True
+
+
+def _pdf_first_page(source, dest, options, encoding):
+    prefix = dest + '.page'
+    if encoding:
+        # pdftoppm needs a seekable file, so a compressed source is expanded first.
+        plain = dest + '.pdf'
+        with _open(source, encoding) as src, open(plain, 'wb') as out:
+            shutil.copyfileobj(src, out)
+        source = plain
+    try:
+        subprocess.run(
+            [options['pdftoppm'], '-f', '1', '-l', '1', '-singlefile', '-png',
+             '-scale-to', str(options['size']), source, prefix],
+            check=True, capture_output=True, timeout=options['timeout'],
+        )
+    finally:
+        if encoding:
+            os.remove(source)
+    os.replace(prefix + '.png', dest)
+    return True
+
+
+def _text_snippet(source, dest, options, encoding):
+    with _open(source, encoding) as fh:
+        head = fh.read(options['text_bytes'])
+    text = head.decode('utf-8', errors='replace').rstrip('\ufffd')
+    lines = text.splitlines()[:options['text_lines']]
+    with open(dest, 'w', encoding='utf-8') as fh:
+        fh.write('\n'.join(lines))
+    return True
+
+
+RENDERERS = {
+    'thumb': _thumbnail,
+    'pdf': _pdf_first_page,
+    'text': _text_snippet,
+}
+
+
+def render(kind, source, dest, options, encoding=''):
+    """Render the ``kind`` preview of ``source`` to ``dest``. Return whether it succeeded.
+
+    ``encoding`` is the stored file's content coding: ``''`` or ``'gzip'``.
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = f'{dest}.{os.getpid()}.tmp'
+    try:
+        ok = RENDERERS[kind](source, tmp, options, encoding)
+    except Exception:
+        ok = False
+    if not ok:
+        open(tmp, 'wb').close()
+    os.replace(tmp, dest)
+    return ok
@@ -0,0 +1,261 @@
+"""Serving uploaded files: validators, conditional GET, byte ranges and offload.
+
+``serve_upload`` is used after the caller has done its permission check.
+It answers ``If-None-Match``/``If-Modified-Since`` with 304, honours
+single and multiple ``Range`` requests (206, ``multipart/byteranges``),
+and can hand the transfer to the front-end server with ``X-Sendfile`` or
+``X-Accel-Redirect`` so no worker streams the bytes itself.
+
+A blob stored gzipped (see ``storage``) is sent as stored, with
+``Content-Encoding: gzip``, to clients that accept it and ask for the
+whole file. Everyone else gets the original bytes, decompressed as they
+stream. These blobs are never offloaded, since the front-end server
+would send the compressed bytes without the header.
+"""
+import mimetypes
+import os
+import re
+import secrets
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+from . import storage
+
+STREAM_CHUNK_SIZE = 64 * 1024
+# More ranges than this are answered with the full body (RFC 9110 allows it),
+# which stops clients from asking for thousands of tiny overlapping parts.
+MAX_RANGES = 16
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+OFFLOAD_HEADERS = ('X-Sendfile', 'X-Accel-Redirect')
+# With an offloaded response the front-end server evaluates these itself.
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since', 'If-Range', 'Range')
+
+
+def upload_etag(upload, encoding=''):
+    if upload.blob_id:
+        # Each representation needs its own validator, or caches would mix them up.
+        return quote_etag(f'{upload.blob.digest}-{encoding}' if encoding else upload.blob.digest)
+    stat = os.stat(upload.file.path)
+    return quote_etag(f'{stat.st_size:x}-{int(stat.st_mtime):x}')
+
+
+def content_type_for(upload):
+    if upload.content_type:
+        return upload.content_type
+    # Legacy rows were never sniffed.
+    content_type, _ = mimetypes.guess_type(upload.display_name)
+    return content_type or 'application/octet-stream'
+
+
+def accepts_gzip(request):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            quality = params.strip().lower().removeprefix('q=')
+            try:
+                return not params or float(quality) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def parse_range_header(header, size):
+    """Return a list of inclusive ``(start, end)`` pairs, ``[]`` if unsatisfiable, or
+    ``None`` if the header should be ignored and the full body sent."""
+    if size == 0:
+        return None
+    units, _, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not spec:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        match = RANGE_RE.match(part)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # Suffix range: the last N bytes.
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+            if start >= size:
+                continue
+        ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and int(last_modified) <= date
+
+
+def _read_range(fh, start, end):
+    fh.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = fh.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _stream_range(fh, start, end):
+    try:
+        yield from _read_range(fh, start, end)
+    finally:
+        fh.close()
+
+
+def _stream_multipart(fh, parts, boundary):
+    try:
+        for header, (start, end) in parts:
+            yield header
+            yield from _read_range(fh, start, end)
+        yield f'\r\n--{boundary}--\r\n'.encode()
+    finally:
+        fh.close()
+
+
+async def _iterate_in_thread(iterator):
+    # Each read runs in a worker thread so a slow disk never blocks the event loop.
+    next_chunk = sync_to_async(next, thread_sensitive=False)
+    try:
+        while (chunk := await next_chunk(iterator, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(iterator.close, thread_sensitive=False)()
+
+
+def _offload_response(upload):
+    mode = settings.SHARE_SENDFILE
+    response = HttpResponse()
+    if mode == 'x-sendfile':
+        response['X-Sendfile'] = upload.file.path
+    elif mode == 'x-accel-redirect':
+        # A URI: nginx percent-decodes it, so names with '%', '?' or '#' must be quoted.
+        response['X-Accel-Redirect'] = settings.SHARE_SENDFILE_URL_PREFIX.rstrip('/') + '/' + quote(upload.file.name)
+    else:
+        raise ValueError(f'Unknown SHARE_SENDFILE mode: {mode!r}')
+    return response
+
+
+def counts_as_download(request, response):
+    """Whether ``response`` to ``request`` starts a transfer worth logging.
+
+    HEAD requests, 304s and resumed ranges don't. A range from byte 0 does,
+    since download managers fetch whole files that way. An offloaded
+    response is always a 200 here, but the front-end server may still turn
+    it into a 304 or a 206, so only unconditional requests count.
+    """
+    if request.method != 'GET':
+        return False
+    if any(header in response for header in OFFLOAD_HEADERS):
+        return not any(header in request.headers for header in CONDITIONAL_HEADERS)
+    return response.status_code == 200 or (
+        response.status_code == 206 and response.get('Content-Range', '').startswith('bytes 0-')
+    )
+
+
+def serve_upload(request, upload, as_attachment=True, asynchronous=False):
+    """Build the response for downloading ``upload`` once access has been granted.
+
+    With ``asynchronous=True`` the body is an async iterator, as ASGI needs to stream
+    without buffering the whole file.
+    """
+    def streaming(iterator, **kwargs):
+        return StreamingHttpResponse(_iterate_in_thread(iterator) if asynchronous else iterator, **kwargs)
+
+    gzipped = storage.is_gzipped(upload)
+    # The stored bytes are only sent when the whole file is wanted: a range
+    # would be meaningless against the compressed representation.
+    send_stored = gzipped and accepts_gzip(request) and 'Range' not in request.headers
+    etag = upload_etag(upload, storage.GZIP if send_stored else '')
+    last_modified = int(upload.uploaded_at.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        if gzipped:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+    content_type = content_type_for(upload)
+    size = upload.size or upload.file.size
+
+    if settings.SHARE_SENDFILE and not gzipped:
+        # The front-end server handles Range itself when it serves the file.
+        response = _offload_response(upload)
+        response['Content-Type'] = content_type
+    elif send_stored:
+        stored_size = upload.blob.stored_size
+        fh = upload.file.storage.open(upload.file.name, 'rb')
+        response = streaming(_stream_range(fh, 0, stored_size - 1), content_type=content_type)
+        response['Content-Length'] = stored_size
+        response['Content-Encoding'] = storage.GZIP
+    else:
+        ranges = None
+        if 'Range' in request.headers and _if_range_matches(request, etag, last_modified):
+            ranges = parse_range_header(request.headers['Range'], size)
+
+        if ranges == []:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        if ranges is None and not asynchronous and not gzipped:
+            response = FileResponse(upload.file.storage.open(upload.file.name, 'rb'), content_type=content_type)
+        elif ranges is None:
+            fh = storage.open_original(upload)
+            response = streaming(_stream_range(fh, 0, size - 1), content_type=content_type)
+            response['Content-Length'] = size
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            fh = storage.open_original(upload)
+            response = streaming(_stream_range(fh, start, end), status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = end - start + 1
+        else:
+            boundary = secrets.token_hex(16)
+            parts = [
+                (
+                    f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode(),
+                    (start, end),
+                )
+                for start, end in ranges
+            ]
+            length = sum(len(header) + end - start + 1 for header, (start, end) in parts)
+            length += len(f'\r\n--{boundary}--\r\n')
+            fh = storage.open_original(upload)
+            response = streaming(
+                _stream_multipart(fh, parts, boundary),
+                status=206,
+                content_type=f'multipart/byteranges; boundary={boundary}',
+            )
+            response['Content-Length'] = length
+
+    if gzipped:
+        response['Vary'] = 'Accept-Encoding'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Content-Disposition'] = content_disposition_header(as_attachment, upload.display_name)
+    return response
@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from .models import UploadedFile
+from . import sniff
 
 # File Upload Constants
 ALLOWED_CONTENT_TYPES = [
@@ -19,12 +20,29 @@ ALLOWED_CONTENT_TYPES = [
     'application/vnd.openxmlformats-officedocument.presentationml.presentation',
 ]
 
+ALLOWED_EXTENSIONS = ['.pdf', '.jpg', '.jpeg', '.png', '.txt',
+                      '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx']
+
 MAX_UPLOAD_SIZE_MB = 10
 MAX_UPLOAD_SIZE_BYTES = MAX_UPLOAD_SIZE_MB * 1024 * 1024
 
 
+def validate_upload(file):
+    """Check an uploaded file's size, extension and contents; returns the detected Content-Type."""
+    if file.size > MAX_UPLOAD_SIZE_BYTES:
+        raise ValidationError(
+            f'File size exceeds maximum limit of {MAX_UPLOAD_SIZE_MB} MB. '
+            f'Your file: {file.size/1024/1024:.2f} MB'
+        )
+    if not any(file.name.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
+        raise ValidationError('Invalid file extension.')
+    # Trust the bytes, not the browser-supplied content_type.
+    return sniff.check_upload(file)
+
+
 class UploadFileForm(forms.ModelForm):
     title = forms.CharField(
+        required=False,
         max_length=255,
         label="File Title",
         widget=forms.TextInput(attrs={
@@ -54,20 +72,7 @@ class UploadFileForm(forms.ModelForm):
     def clean_file(self):
         file = self.cleaned_data.get('file')
         if file:
-            if file.size > MAX_UPLOAD_SIZE_BYTES:
-                raise ValidationError(
-                    f'File size exceeds maximum limit of {MAX_UPLOAD_SIZE_MB} MB. '
-                    f'Your file: {file.size/1024/1024:.2f} MB'
-                )
-            if file.content_type not in ALLOWED_CONTENT_TYPES:
-                raise ValidationError(
-                    f'Unsupported file type ({file.content_type}). '
-                    'Allowed types: PDF, Word, Excel, PowerPoint, images, and text files.'
-                )
-            valid_extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.txt',
-                                '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx']
-            if not any(file.name.lower().endswith(ext) for ext in valid_extensions):
-                raise ValidationError('Invalid file extension.')
+            file.detected_type = validate_upload(file)
         return file
 
 
@@ -0,0 +1,22 @@
+"""Where uploaded files live in storage.
+
+Every upload is stored once as a content-addressed blob (see ``blobs``),
+spread over two levels of 256 directories (``blobs/ab/cd/<digest>``) so
+no directory grows without bound. ``UploadedFile.file`` only mirrors its
+blob's name; nothing is saved through the field itself.
+
+Rows from before content-addressed storage still point at their own file,
+often in the old flat ``uploads/`` directory. ``dedupe_uploads`` is the
+migration path that moves them into blobs.
+"""
+UPLOAD_PREFIX = 'uploads'
+
+
+def shard(key):
+    """``'abcdef…'`` -> ``'ab/cd/abcdef…'``."""
+    return f'{key[:2]}/{key[2:4]}/{key}'
+
+
+def upload_to(instance, filename):
+    # Only migration 0012 refers to this; UploadedFile.file is never saved through.
+    return f'{UPLOAD_PREFIX}/{filename}'
@@ -0,0 +1,192 @@
+"""Expiring share links for uploaded files.
+
+A link is ``/s/<token>``. The token is the file id, the expiry, the
+permissions and a random link id (``jti``), signed with
+``django.core.signing`` under ``SECRET_KEY``. Verifying one needs no
+database access. The signature proves the token was issued here, and the
+expiry is inside it. Links are recorded as ``ShareLink`` rows only so
+owners can list and revoke them.
+
+Revoked link ids that have not expired yet are kept as one set in the
+default cache. The set is rebuilt from ``ShareLink`` when it is missing,
+and at least every ``REVOCATION_REFRESH`` seconds, so processes that
+don't share a cache pick up a revocation within that time.
+
+``ShareLinkMiddleware`` answers ``/s/`` requests before the session, CSRF
+and auth middleware run. Serving a link costs the cache lookup plus the
+query for the file. The download goes through
+``downloads.serve_upload``, so conditional GETs, ranges, compressed
+blobs and offload all work as for ``download_file``.
+
+Configured through ``settings.SHARE_LINKS``:
+
+- ``DEFAULT_AGE`` / ``MAX_AGE``: link lifetime in seconds
+- ``REVOCATION_REFRESH``: seconds the cached revocation set is trusted
+"""
+import secrets
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotAllowed
+from django.urls import ResolverMatch
+from django.utils import timezone
+
+from . import downloads, throttle
+from .models import ShareLink, UploadedFile
+
+DEFAULTS = {
+    'DEFAULT_AGE': 7 * 24 * 60 * 60,
+    'MAX_AGE': 30 * 24 * 60 * 60,
+    'REVOCATION_REFRESH': 60,
+}
+
+SALT = 'share.links'
+URL_PREFIX = '/s/'
+# 'download' serves the file as an attachment; 'inline' lets the browser display it instead.
+PERMISSIONS = {'download': 'd', 'inline': 'i'}
+REVOKED_KEY = 'share:links:revoked'
+
+
+class InvalidLink(Exception):
+    """The token is forged, malformed, expired or revoked; ``status`` is the HTTP status to answer."""
+
+    def __init__(self, reason, status):
+        super().__init__(reason)
+        self.status = status
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SHARE_LINKS', {})}
+
+
+def _signer():
+    # Not timestamped: the expiry is in the payload, and the same link always
+    # has the same token, so it can be shown again from its ShareLink row.
+    return signing.Signer(salt=SALT)
+
+
+def token_for(link):
+    return _signer().sign_object(
+        {
+            'f': link.file_id,
+            'e': int(link.expires_at.timestamp()),
+            'p': ''.join(PERMISSIONS[name] for name in link.permissions.split(',') if name),
+            'j': link.jti,
+        },
+        compress=True,
+    )
+
+
+def path_for(link):
+    return URL_PREFIX + token_for(link)
+
+
+def create(upload, user, seconds=None, permissions=('download',)):
+    """Issue a link to ``upload`` that stays valid for ``seconds``, capped at ``MAX_AGE``."""
+    config = get_config()
+    seconds = min(seconds or config['DEFAULT_AGE'], config['MAX_AGE'])
+    unknown = set(permissions) - set(PERMISSIONS)
+    if unknown:
+        raise ValueError(f'Unknown share link permission(s): {", ".join(sorted(unknown))}')
+    return ShareLink.objects.create(
+        jti=secrets.token_hex(16),
+        file=upload,
+        created_by=user,
+        permissions=','.join(sorted(set(permissions))),
+        # Whole seconds, as stored in the token.
+        expires_at=(timezone.now() + timedelta(seconds=seconds)).replace(microsecond=0),
+    )
+
+
+def revoked():
+    """Return the ids of revoked links that have not expired yet."""
+    jtis = cache.get(REVOKED_KEY)
+    if jtis is None:
+        jtis = frozenset(
+            ShareLink.objects.filter(revoked_at__isnull=False, expires_at__gt=timezone.now())
+            .values_list('jti', flat=True)
+        )
+        cache.set(REVOKED_KEY, jtis, get_config()['REVOCATION_REFRESH'])
+    return jtis
+
+
+def revoke(link):
+    link.revoked_at = timezone.now()
+    link.save(update_fields=['revoked_at'])
+    # Rebuilt from the table by the next request.
+    transaction.on_commit(lambda: cache.delete(REVOKED_KEY))
+
+
+def verify(token):
+    """Return ``(file_id, permissions)`` for a valid token, or raise ``InvalidLink``."""
+    try:
+        payload = _signer().unsign_object(token)
+        file_id, expires, flags, jti = payload['f'], payload['e'], payload['p'], payload['j']
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise InvalidLink('not valid', 404)
+    if datetime.fromtimestamp(expires, dt_timezone.utc) <= timezone.now():
+        raise InvalidLink('expired', 410)
+    if jti in revoked():
+        raise InvalidLink('revoked', 410)
+    return file_id, {name for name, flag in PERMISSIONS.items() if flag in flags}
+
+
+def serve(request, token, asynchronous=False):
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    wait = throttle.check(request, 'link')
+    if wait:
+        return throttle.too_many_requests(wait)
+    try:
+        file_id, permissions = verify(token)
+    except InvalidLink as e:
+        return HttpResponse(f'This share link is {e}.\n', status=e.status, content_type='text/plain; charset=utf-8')
+    upload = UploadedFile.objects.select_related('blob').filter(pk=file_id).first()
+    if upload is None:
+        return HttpResponse('This file is no longer available.\n', status=410, content_type='text/plain; charset=utf-8')
+
+    response = downloads.serve_upload(
+        request, upload, as_attachment='inline' not in permissions, asynchronous=asynchronous,
+    )
+    # Revalidate every time (a revoked link must stop working), and keep the token out of Referer headers.
+    response['Cache-Control'] = 'private, no-cache'
+    response['Referrer-Policy'] = 'no-referrer'
+    response['X-Robots-Tag'] = 'noindex'
+    return response
+
+
+class ShareLinkMiddleware:
+    """Serves ``/s/<token>`` without running the middleware below it (sessions, CSRF, auth)."""
+
+    # Async-capable, so ASGI requests that are not share links pass straight through.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not request.path_info.startswith(URL_PREFIX):
+            return self.get_response(request)
+        return serve(request, self.token(request))
+
+    async def __acall__(self, request):
+        if not request.path_info.startswith(URL_PREFIX):
+            return await self.get_response(request)
+        # The cache, the query and opening the file block; the body then streams asynchronously.
+        return await sync_to_async(serve)(request, self.token(request), asynchronous=True)
+
+    def token(self, request):
+        token = request.path_info[len(URL_PREFIX):].rstrip('/')
+        # Lets the metrics middleware label these requests.
+        request.resolver_match = ResolverMatch(serve, (), {'token': token}, url_name='share_link', app_names=['share'])
+        return token
@@ -0,0 +1,122 @@
+"""Buffered, batched writes of ``DownloadLog`` rows.
+
+Downloads are the hottest path in the app, so instead of one INSERT (and
+one SQLite write lock) per download, entries are queued in memory and
+written with ``bulk_create`` by a background thread when ``BATCH_SIZE``
+entries are pending, every ``FLUSH_INTERVAL`` seconds, and at process exit.
+
+Configured through ``settings.SHARE_DOWNLOAD_LOG``:
+
+- ``MODE``: ``'buffered'``, ``'sync'`` (write immediately; use in tests) or ``'off'``
+- ``MAX_PENDING``: hard bound on queued entries
+- ``OVERFLOW``: ``'drop'`` new entries when full, or ``'block'`` the request for up
+  to ``BLOCK_TIMEOUT`` seconds while a flush makes room (then drop)
+"""
+import atexit
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import DownloadLog, UploadedFile
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MODE': 'buffered',
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 5.0,
+    'MAX_PENDING': 10000,
+    'OVERFLOW': 'drop',
+    'BLOCK_TIMEOUT': 1.0,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SHARE_DOWNLOAD_LOG', {})}
+
+
+class DownloadLogBuffer:
+    def __init__(self):
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._has_room = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._thread = None
+        self._registered_atexit = False
+        self.dropped = 0
+
+    def record(self, user_id, file_id):
+        config = get_config()
+        if config['MODE'] == 'off':
+            return
+        entry = DownloadLog(user_id=user_id, file_id=file_id, timestamp=timezone.now())
+        if config['MODE'] == 'sync':
+            entry.save()
+            return
+
+        self._ensure_started()
+        with self._lock:
+            if len(self._pending) >= config['MAX_PENDING'] and config['OVERFLOW'] == 'block':
+                self._wake.set()
+                self._has_room.wait_for(lambda: len(self._pending) < config['MAX_PENDING'], config['BLOCK_TIMEOUT'])
+            if len(self._pending) >= config['MAX_PENDING']:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logger.warning('Download log buffer full; %d entries dropped so far.', self.dropped)
+                return
+            self._pending.append(entry)
+            if len(self._pending) >= config['BATCH_SIZE']:
+                self._wake.set()
+
+    def flush(self):
+        """Write every pending entry; returns the number of rows inserted."""
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+            self._has_room.notify_all()
+        if not batch:
+            return 0
+        # Files deleted since their download was queued would fail the FK check for the whole batch.
+        live = set(UploadedFile.objects.filter(id__in={e.file_id for e in batch}).values_list('id', flat=True))
+        batch = [e for e in batch if e.file_id in live]
+        try:
+            DownloadLog.objects.bulk_create(batch, batch_size=get_config()['BATCH_SIZE'])
+        except Exception:
+            logger.exception('Failed to write %d download log entries.', len(batch))
+            return 0
+        return len(batch)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='download-log-flusher', daemon=True)
+            self._thread.start()
+            if not self._registered_atexit:
+                atexit.register(self.flush)
+                self._registered_atexit = True
+
+    def _run(self):
+        while True:
+            self._wake.wait(get_config()['FLUSH_INTERVAL'])
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Download log flush failed.')
+            finally:
+                # This thread owns its own connection; don't hold it between flushes.
+                connection.close()
+
+
+buffer = DownloadLogBuffer()
+
+
+def record_download(user, upload):
+    buffer.record(user.id, upload.id)
@@ -0,0 +1,90 @@
+from collections import Counter
+from contextlib import ExitStack
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from share import blobs, cache, stats
+from share.models import UploadedFile
+
+
+# This is the migration path for rows from before content-addressed storage.
+# Each batch is hashed and staged outside any transaction, then takes its blob
+# references and rewrites its rows in one short transaction. Committed batches
+# are never revisited, so an interrupted run resumes where it stopped.
+class Command(BaseCommand):
+    help = (
+        'Move uploads that predate content-addressed storage (including the flat uploads/ '
+        'directory) into shared blobs, one transaction per batch.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be moved.')
+        parser.add_argument('--batch-size', type=int, default=100, help='Uploads moved per transaction.')
+
+    def handle(self, *args, **options):
+        moved = missing = 0
+        last_pk = 0
+        while True:
+            # Moved rows drop out of the filter; the pk bound steps past the missing ones.
+            batch = list(
+                UploadedFile.objects.filter(blob__isnull=True, pk__gt=last_pk).order_by('pk')[:options['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            present = []
+            for upload in batch:
+                if upload.file.storage.exists(upload.file.name):
+                    present.append(upload)
+                else:
+                    missing += 1
+                    self.stderr.write(f'Missing on disk: {upload.file.name} (id={upload.pk})')
+            if present and not options['dry_run']:
+                self.move(present)
+            moved += len(present)
+
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {moved} upload(s) into blob storage, {missing} missing.'))
+
+    def move(self, uploads):
+        old_files = {upload.file.name: upload.file.storage for upload in uploads}
+        with ExitStack() as stack:
+            files_by_digest, digests = {}, []
+            for upload in uploads:
+                fh = stack.enter_context(upload.file.storage.open(upload.file.name, 'rb'))
+                content = File(fh, name=upload.file.name)
+                digest = blobs.file_digest(content)
+                files_by_digest.setdefault(digest, content)
+                digests.append(digest)
+            staged = blobs.stage_many(files_by_digest)
+            try:
+                with transaction.atomic():
+                    stored = blobs.acquire_many(files_by_digest, digests, staged)
+                    deltas = Counter()
+                    for upload, digest in zip(uploads, digests):
+                        blob = stored[digest]
+                        # Legacy rows often recorded size 0; post_save only counts creations.
+                        deltas[upload.user_id] += blob.size - upload.size
+                        upload.name = upload.display_name
+                        upload.blob = blob
+                        upload.file = blob.file.name
+                        upload.size = blob.size
+                    # bulk_update skips post_save, so do its bookkeeping here.
+                    UploadedFile.objects.bulk_update(uploads, ['blob', 'file', 'name', 'size'])
+                    for user_id, delta in deltas.items():
+                        stats.adjust(user_id, 0, delta)
+                        cache.bump(user_id)
+            finally:
+                for fields in staged.values():
+                    blobs.discard(fields)
+
+        # Several legacy rows can share one file; it goes with the last of them.
+        blob_files = {blob.file.name for blob in stored.values()}
+        still_used = set(
+            UploadedFile.objects.filter(blob__isnull=True, file__in=old_files).values_list('file', flat=True)
+        )
+        for name, storage in old_files.items():
+            if name not in blob_files and name not in still_used:
+                storage.delete(name)
@@ -0,0 +1,131 @@
+import os
+import time
+from itertools import islice
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.template.defaultfilters import filesizeformat
+
+
+def walk(path):
+    """Yield the file entries under ``path`` depth-first, one directory listing open per level."""
+    try:
+        listing = os.scandir(path)
+    except FileNotFoundError:
+        return
+    with listing:
+        for entry in listing:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def file_fields():
+    """Every (model, field name) pair that can reference a stored file."""
+    return [
+        (model, field.name)
+        for model in apps.get_models()
+        for field in model._meta.concrete_fields
+        if isinstance(field, models.FileField)
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Delete files under MEDIA_ROOT and stray upload directories that no database row references.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted.')
+        parser.add_argument(
+            '--grace', type=int, default=settings.SHARE_GC_GRACE_PERIOD,
+            help='Skip files modified within this many seconds (uploads still being committed).',
+        )
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='Most deletions per second (0 = no limit).',
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Paths checked per query.')
+        parser.add_argument(
+            '--root', action='append', default=[],
+            help='Extra directory to collect; names are resolved relative to its parent. Repeatable.',
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.interval = 1 / options['rate'] if options['rate'] > 0 else 0
+        self.next_delete_at = 0
+        self.fields = file_fields()
+        cutoff = time.time() - options['grace']
+
+        # (directory to walk, directory that stored names are relative to)
+        roots = [(settings.MEDIA_ROOT, settings.MEDIA_ROOT)]
+        for root in [*settings.SHARE_GC_EXTRA_ROOTS, *options['root']]:
+            root = os.path.abspath(root)
+            roots.append((root, os.path.dirname(root)))
+
+        scanned = recent = kept = orphans = orphan_bytes = deleted = 0
+        for root, base in roots:
+            entries = walk(root)
+            while batch := list(islice(entries, options['batch_size'])):
+                candidates = {}
+                for entry in batch:
+                    scanned += 1
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    if stat.st_mtime > cutoff:
+                        recent += 1
+                        continue
+                    name = os.path.relpath(entry.path, base).replace(os.sep, '/')
+                    candidates[name] = (entry.path, stat.st_size)
+
+                referenced = self.referenced(candidates)
+                kept += len(referenced)
+                for name, (path, size) in candidates.items():
+                    if name in referenced:
+                        continue
+                    orphans += 1
+                    orphan_bytes += size
+                    if options['verbosity'] >= 2:
+                        self.stdout.write(f'{"Would delete" if self.dry_run else "Deleting"} {path} ({size} bytes)')
+                    if not self.dry_run and self.delete(path):
+                        deleted += 1
+
+        self.stdout.write(
+            f'Scanned {scanned} file(s): {kept} referenced, {recent} inside the grace period, '
+            f'{orphans} orphaned ({filesizeformat(orphan_bytes)} reclaimable).'
+        )
+        if self.dry_run:
+            self.stdout.write(self.style.WARNING('Dry run: nothing was deleted.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} orphaned file(s).'))
+
+    def referenced(self, candidates):
+        """Return the subset of the names in ``candidates`` that some row still points at."""
+        found = set()
+        names = list(candidates)
+        for model, field in self.fields:
+            remaining = [name for name in names if name not in found]
+            if not remaining:
+                break
+            found.update(
+                model._default_manager.filter(**{f'{field}__in': remaining}).values_list(field, flat=True)
+            )
+        return found
+
+    def delete(self, path):
+        if self.interval:
+            delay = self.next_delete_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.next_delete_at = time.monotonic() + self.interval
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
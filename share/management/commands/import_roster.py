@@ -0,0 +1,197 @@
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth import password_validation
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from share import outbox
+from share.forms import RegisterForm
+
+COLUMNS = ('username', 'email', 'first_name', 'last_name')
+EMAIL_SUBJECT = 'Activate your account'
+
+
+class Command(BaseCommand):
+    help = (
+        'Create inactive student accounts from a CSV roster (username, email, first_name, last_name '
+        'and an optional password column) and queue their activation emails.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('roster', help='CSV file with a header row.')
+        parser.add_argument(
+            '--domain', default='localhost:8000', help='Host name used in the activation links.',
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows validated and inserted per transaction.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1, help='Processes hashing passwords in parallel.',
+        )
+        parser.add_argument(
+            '--state', help='Progress file for resuming (default: <roster>.state.json).',
+        )
+        parser.add_argument('--restart', action='store_true', help='Ignore saved progress and start from the top.')
+        parser.add_argument('--errors', help='Also write rejected rows, with the reason, to this CSV file.')
+        parser.add_argument('--dry-run', action='store_true', help='Validate and check conflicts only.')
+
+    def handle(self, *args, **options):
+        state_path = options['state'] or options['roster'] + '.state.json'
+        state = {'rows': 0, 'created': 0, 'rejected': 0}
+        if not options['restart'] and not options['dry_run'] and os.path.exists(state_path):
+            with open(state_path) as fh:
+                state = json.load(fh)
+            self.stdout.write(f"Resuming after row {state['rows']}.")
+
+        # The same fields, validators and lowercasing as self-registration.
+        fields = RegisterForm().fields
+        self.seen_usernames, self.seen_emails = set(), set()
+        self.error_writer = None
+
+        with open(options['roster'], newline='', encoding='utf-8-sig') as fh, \
+                ProcessPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            reader = csv.DictReader(fh)
+            missing = [column for column in COLUMNS if column not in (reader.fieldnames or [])]
+            if missing:
+                raise CommandError(f"The roster has no {', '.join(missing)} column(s).")
+            error_file = self.open_error_file(options['errors'], reader.fieldnames, append=state['rows'] > 0)
+
+            # Rows committed by an earlier run are skipped without being validated again.
+            rows = islice(((reader.line_num, row) for row in reader), state['rows'], None)
+            try:
+                while batch := list(islice(rows, options['batch_size'])):
+                    accepted = self.validate(batch, fields)
+                    created = self.import_batch(accepted, pool, options) if not options['dry_run'] else len(accepted)
+                    state['rows'] += len(batch)
+                    state['created'] += created
+                    state['rejected'] += len(batch) - len(accepted)
+                    if not options['dry_run']:
+                        self.save_state(state_path, state)
+                    self.stdout.write(f"Processed {state['rows']} row(s)...")
+            finally:
+                if error_file is not None:
+                    error_file.close()
+
+        if options['dry_run']:
+            summary = f"Would create {state['created']} account(s)"
+        else:
+            summary = f"Created {state['created']} account(s) and queued their activation emails"
+        self.stdout.write(self.style.SUCCESS(f"{summary}; rejected {state['rejected']} row(s)."))
+
+    def validate(self, batch, fields):
+        """Return ``(line, cleaned, password)`` for each acceptable row; report the rest."""
+        candidates = []
+        for line, row in batch:
+            cleaned, problems = {}, []
+            for name in COLUMNS:
+                try:
+                    cleaned[name] = fields[name].clean((row.get(name) or '').strip())
+                except ValidationError as e:
+                    problems.append(f"{name}: {' '.join(e.messages)}")
+            if problems:
+                self.reject(line, row, '; '.join(problems))
+                continue
+            cleaned['username'] = cleaned['username'].lower()
+            cleaned['email'] = cleaned['email'].lower()
+            if cleaned['username'] in self.seen_usernames or cleaned['email'] in self.seen_emails:
+                self.reject(line, row, 'duplicate of an earlier row in the roster')
+                continue
+            self.seen_usernames.add(cleaned['username'])
+            self.seen_emails.add(cleaned['email'])
+            password = row.get('password') or ''
+            if password:
+                try:
+                    password_validation.validate_password(password, User(**cleaned))
+                except ValidationError as e:
+                    self.reject(line, row, f"password: {' '.join(e.messages)}")
+                    continue
+            candidates.append((line, row, cleaned, password))
+
+        # One query for the whole batch instead of an exists() per row.
+        taken = User.objects.filter(
+            Q(username__in=[c[2]['username'] for c in candidates]) | Q(email__in=[c[2]['email'] for c in candidates])
+        ).values_list('username', 'email')
+        taken_usernames = {username for username, _ in taken}
+        taken_emails = {email.lower() for _, email in taken}
+
+        accepted = []
+        for line, row, cleaned, password in candidates:
+            if cleaned['username'] in taken_usernames:
+                self.reject(line, row, 'username is already registered')
+            elif cleaned['email'] in taken_emails:
+                self.reject(line, row, 'email is already registered')
+            else:
+                accepted.append((line, cleaned, password))
+        return accepted
+
+    def import_batch(self, accepted, pool, options):
+        if not accepted:
+            return 0
+        # PBKDF2 is deliberately slow; spread it over every core. Rows without a
+        # password get an unusable one and choose their own through the emailed link.
+        given = [password for _, _, password in accepted if password]
+        hashes = iter(pool.map(make_password, given, chunksize=16))
+        users = [
+            User(**cleaned, password=next(hashes) if password else make_password(None), is_active=False)
+            for _, cleaned, password in accepted
+        ]
+        with transaction.atomic():
+            created = User.objects.bulk_create(users)
+            if any(user.pk is None for user in created):
+                # Backends that can't return ids from a bulk insert (e.g. MySQL).
+                ids = dict(User.objects.filter(username__in=[u.username for u in created]).values_list('username', 'id'))
+                for user in created:
+                    user.pk = ids[user.username]
+            outbox.enqueue_many(
+                self.activation_email(options['domain'], user, set_password=not password)
+                for user, (_, _, password) in zip(created, accepted)
+            )
+        return len(created)
+
+    def activation_email(self, domain, user, set_password):
+        # Only a one-time token goes into the outbox, never a credential: the
+        # set-password link stops working once used, the activation link once
+        # the account is active.
+        body = render_to_string('share/roster_activation_email.html', {
+            'user': user,
+            'domain': domain,
+            'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+            'token': default_token_generator.make_token(user),
+            'set_password': set_password,
+            'valid_days': settings.PASSWORD_RESET_TIMEOUT // 86400,
+        })
+        return EMAIL_SUBJECT, body, [user.email]
+
+    def open_error_file(self, path, fieldnames, append):
+        if not path:
+            return None
+        exists = append and os.path.exists(path)
+        error_file = open(path, 'a' if exists else 'w', newline='', encoding='utf-8')
+        self.error_writer = csv.DictWriter(error_file, [*fieldnames, 'line', 'error'], extrasaction='ignore')
+        if not exists:
+            self.error_writer.writeheader()
+        return error_file
+
+    def reject(self, line, row, reason):
+        self.stderr.write(f'Line {line}: {reason}')
+        if self.error_writer is not None:
+            self.error_writer.writerow({**row, 'line': line, 'error': reason})
+
+    def save_state(self, path, state):
+        # Written after the batch commits. If the process dies in between, the rerun
+        # reports that batch's rows as already registered and moves on.
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(state, fh)
+        os.replace(tmp, path)
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from share import search
+
+
+class Command(BaseCommand):
+    help = 'Extract the text of newly uploaded documents into the full-text search index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Files indexed per transaction.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new uploads instead of exiting when drained.')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds to sleep between polls with --loop.')
+
+    def handle(self, *args, **options):
+        if not search.enabled():
+            raise CommandError('Full-text search needs SQLite (FTS5).')
+        total = 0
+        try:
+            while True:
+                done = search.index_pending(options['batch_size'])
+                total += done
+                if done:
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Indexed the text of {total} file(s).'))
@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from share import chunked
+from share.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Delete resumable upload sessions (and their partial files) that have been idle too long.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=settings.SHARE_CHUNKED_UPLOAD_MAX_AGE,
+            help='Idle time in seconds after which a session is purged.',
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=options['max_age'])
+        purged = 0
+        for session in UploadSession.objects.filter(updated_at__lt=cutoff).iterator():
+            chunked.discard(session)
+            purged += 1
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} idle upload session(s).'))
@@ -0,0 +1,46 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from share import search
+from share.models import SearchIndexJob, UploadedFile
+
+
+class Command(BaseCommand):
+    help = 'Re-extract text from every upload and rebuild the full-text search index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Processes extracting document text in parallel.',
+        )
+        parser.add_argument('--batch-size', type=int, default=200, help='Files written per transaction.')
+
+    def handle(self, *args, **options):
+        if not search.enabled():
+            raise CommandError('Full-text search needs SQLite (FTS5).')
+
+        uploads = (
+            UploadedFile.objects.select_related('blob')
+            .only('id', 'user_id', 'name', 'file', 'blob__encoding')
+            .order_by('pk')
+            .iterator(chunk_size=2000)
+        )
+        jobs = (search.job(upload) for upload in uploads)
+        indexed = 0
+        # Rows are replaced in place, so search keeps working while the rebuild runs.
+        with ProcessPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            while batch := list(islice(jobs, options['batch_size'])):
+                rows = list(pool.map(search.document, batch, chunksize=8))
+                with transaction.atomic():
+                    search.write(rows)
+                    SearchIndexJob.objects.filter(upload_id__in=[row[0] for row in rows]).delete()
+                indexed += len(rows)
+                self.stdout.write(f'Indexed {indexed} file(s)...')
+
+        removed = search.remove_orphans()
+        search.optimize()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} file(s), removed {removed} stale index row(s).'))
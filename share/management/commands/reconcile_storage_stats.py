@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from share import cache
+from share.models import StorageStats, UploadedFile
+
+
+class Command(BaseCommand):
+    help = 'Rebuild per-user storage counters from the UploadedFile table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backfill-sizes', action='store_true',
+            help='Stat legacy files recorded with size 0 and store their real size first.',
+        )
+
+    def handle(self, *args, **options):
+        if options['backfill_sizes']:
+            self.backfill_sizes()
+
+        with transaction.atomic():
+            current = {s.user_id: (s.file_count, s.bytes_used) for s in StorageStats.objects.all()}
+            rows = [
+                StorageStats(user_id=t['user'], file_count=t['file_count'], bytes_used=t['bytes_used'] or 0)
+                for t in UploadedFile.objects.order_by().values('user').annotate(
+                    file_count=Count('id'), bytes_used=Sum('size'))
+            ]
+            drifted = [r.user_id for r in rows if current.pop(r.user_id, None) != (r.file_count, r.bytes_used)]
+            StorageStats.objects.bulk_create(
+                rows, update_conflicts=True, unique_fields=['user'],
+                update_fields=['file_count', 'bytes_used'], batch_size=500,
+            )
+            # Users whose last file is gone.
+            StorageStats.objects.filter(user_id__in=list(current)).delete()
+            # Cached dashboards show the counters.
+            for user_id in [*drifted, *current]:
+                cache.bump(user_id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Reconciled {len(rows)} user(s): {len(drifted)} corrected, {len(current)} emptied.'))
+
+    def backfill_sizes(self):
+        fixed = 0
+        for upload in UploadedFile.objects.filter(size=0, blob__isnull=True).iterator():
+            try:
+                size = upload.file.size
+            except OSError:
+                self.stderr.write(f'Missing on disk: {upload.file.name} (id={upload.pk})')
+                continue
+            UploadedFile.objects.filter(pk=upload.pk).update(size=size)
+            cache.bump(upload.user_id)
+            fixed += 1
+        self.stdout.write(f'Backfilled sizes for {fixed} legacy upload(s).')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from share import rollups
+
+
+class Command(BaseCommand):
+    help = 'Incrementally aggregate new DownloadLog rows into the daily rollup tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50000, help='Log ids aggregated per transaction.')
+
+    def handle(self, *args, **options):
+        total = 0
+        while (aggregated := rollups.advance(options['batch_size'])) is not None:
+            total += aggregated
+        self.stdout.write(self.style.SUCCESS(f'Aggregated {total} new download log row(s).'))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from share import outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued outbox emails in batches over a single mail backend connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--max-attempts', type=int, default=5, help='Give up on a message after this many failures.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling for new messages instead of exiting when drained.')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds to sleep between polls with --loop.')
+
+    def handle(self, *args, **options):
+        connection = get_connection()
+        total_sent = total_failed = 0
+        try:
+            connection.open()
+            while True:
+                sent, failed = outbox.deliver_batch(connection, options['batch_size'], options['max_attempts'])
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+        self.stdout.write(self.style.SUCCESS(f'Sent {total_sent} email(s); {total_failed} failed attempt(s).'))
@@ -0,0 +1,303 @@
+"""Per-request instrumentation, exposed in the Prometheus text format.
+
+``MetricsMiddleware`` times every request and counts its SQL through a
+``connection.execute_wrapper`` on each database alias. The time spent in
+SQL is the part of a slow view the database accounts for; the rest is
+Python, templates and the filesystem. Bytes sent by streaming responses
+(downloads, ZIPs) are counted as they leave, and uploaded file sizes when
+a request carries files. Everything is labelled with the resolved view
+name, so label sets stay bounded.
+
+The ``metrics`` view renders the registry for ``/metrics``. Values are
+per process: with several worker processes, scrape each one (or run a
+single process).
+
+Configured through ``settings.SHARE_METRICS``:
+
+- ``ENABLED``: record anything at all
+- ``ALLOWED_IPS``: client addresses that may scrape ``/metrics`` without
+  logging in, resolved through ``SHARE_THROTTLE['TRUSTED_PROXIES']`` like
+  the throttle's; logged-in staff always may
+- ``TOKEN``: if set, a scraper sending ``Authorization: Bearer <TOKEN>``
+  may too
+- ``SLOW_REQUEST_SECONDS``: log requests slower than this (``None``
+  disables it) to the ``share.metrics`` logger, along with their
+  ``SLOW_REQUEST_TOP_QUERIES`` slowest statements
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.utils.crypto import constant_time_compare
+
+from . import throttle
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+    'TOKEN': None,
+    'SLOW_REQUEST_SECONDS': None,
+    'SLOW_REQUEST_TOP_QUERIES': 5,
+}
+
+PREFIX = 'securecampus_'
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SHARE_METRICS', {})}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = PREFIX + name, documentation, tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames = PREFIX + name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._lock = threading.Lock()
+        # labels -> [per-bucket counts (not cumulative), sum, count]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._values.items()}
+        for labels, (counts, total, count) in sorted(values.items()):
+            for bound, cumulative in zip(self.buckets, itertools.accumulate(counts)):
+                yield f'{self.name}_bucket', _labels(self.labelnames, labels, [('le', _number(bound))]), cumulative
+            yield f'{self.name}_sum', _labels(self.labelnames, labels), total
+            yield f'{self.name}_count', _labels(self.labelnames, labels), count
+
+
+requests_total = Counter(
+    'http_requests_total', 'Requests handled, by view, method and status.', ['view', 'method', 'status'],
+)
+request_seconds = Histogram(
+    'http_request_duration_seconds', 'Time to build the response, by view.', ['view'],
+)
+request_queries = Histogram(
+    'http_request_queries', 'SQL statements executed per request, by view.', ['view'], QUERY_BUCKETS,
+)
+request_query_seconds = Histogram(
+    'http_request_query_duration_seconds', 'Time spent in SQL per request, by view.', ['view'],
+)
+response_streamed_bytes = Counter(
+    'http_response_streamed_bytes_total', 'Bytes sent by streaming responses (downloads), by view.', ['view'],
+)
+upload_bytes = Histogram(
+    'upload_size_bytes', 'Sizes of files received in requests, by view.', ['view'], SIZE_BUCKETS,
+)
+REGISTRY = [requests_total, request_seconds, request_queries, request_query_seconds, response_streamed_bytes, upload_bytes]
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+def may_scrape(request):
+    """Return whether ``request`` may read the metrics."""
+    config = get_config()
+    if config['TOKEN'] and constant_time_compare(
+        request.headers.get('Authorization', ''), f'Bearer {config["TOKEN"]}'
+    ):
+        return True
+    if request.user.is_staff:
+        return True
+    throttle_config = throttle.get_config()
+    ip = throttle.client_ip(request, throttle_config)
+    if ip == request.META.get('REMOTE_ADDR') and throttle_config['FORWARDED_FOR_HEADER'] in request.META:
+        # Forwarded by a proxy that is not trusted: REMOTE_ADDR is the proxy, and the client is unknown.
+        return False
+    return ip in config['ALLOWED_IPS']
+
+
+class _QueryTimer:
+    """``execute_wrapper`` that counts and times statements, keeping the slowest few."""
+
+    def __init__(self, keep):
+        self.count = 0
+        self.seconds = 0.0
+        self.keep = keep
+        self.slowest = []
+        self._order = itertools.count()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if self.keep:
+                entry = (elapsed, next(self._order), sql)
+                if len(self.slowest) < self.keep:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+
+
+def _counted(content, labels):
+    sent = 0
+    try:
+        for chunk in content:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        response_streamed_bytes.inc(labels, sent)
+
+
+async def _acounted(content, labels):
+    sent = 0
+    try:
+        async for chunk in content:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        response_streamed_bytes.inc(labels, sent)
+
+
+def _timer(config):
+    keep = config['SLOW_REQUEST_TOP_QUERIES'] if config['SLOW_REQUEST_SECONDS'] is not None else 0
+    return _QueryTimer(keep=keep)
+
+
+def _wrapped(timer):
+    stack = ExitStack()
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(timer))
+    return stack
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+class MetricsMiddleware:
+    # Async-capable, so ASGI requests (the async views) never hop through a thread here.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        config = get_config()
+        if not config['ENABLED']:
+            return self.get_response(request)
+        timer = _timer(config)
+        started = time.perf_counter()
+        with _wrapped(timer):
+            response = self.get_response(request)
+        return self.record(request, response, config, timer, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        config = get_config()
+        if not config['ENABLED']:
+            return await self.get_response(request)
+        timer = _timer(config)
+        started = time.perf_counter()
+        # Connections are context-local, so the wrappers follow the view's ORM calls into its threads.
+        with _wrapped(timer):
+            response = await self.get_response(request)
+        return self.record(request, response, config, timer, time.perf_counter() - started)
+
+    def record(self, request, response, config, timer, elapsed):
+        threshold = config['SLOW_REQUEST_SECONDS']
+        view = _view_name(request)
+        method = request.method if request.method in METHODS else 'OTHER'
+        requests_total.inc((view, method, str(response.status_code)))
+        request_seconds.observe(elapsed, (view,))
+        request_queries.observe(timer.count, (view,))
+        request_query_seconds.observe(timer.seconds, (view,))
+        # Only look at files a view has already parsed; touching request.FILES would read the body.
+        if '_files' in request.__dict__:
+            for _, files in request.FILES.lists():
+                for uploaded in files:
+                    upload_bytes.observe(uploaded.size, (view,))
+        if getattr(response, 'file_to_stream', None) is not None and response.has_header('Content-Length'):
+            # The WSGI server may send the file itself (wsgi.file_wrapper) without
+            # iterating streaming_content, so count the declared length.
+            response_streamed_bytes.inc((view,), int(response['Content-Length']))
+        elif response.streaming:
+            if response.is_async:
+                response.streaming_content = _acounted(response.streaming_content, (view,))
+            else:
+                response.streaming_content = _counted(response.streaming_content, (view,))
+
+        if threshold is not None and elapsed >= threshold:
+            slowest = sorted(timer.slowest, reverse=True)
+            logger.warning(
+                'Slow request: %s %s (%s) took %.3fs, %d queries in %.3fs. Slowest queries:\n%s',
+                request.method, request.path, view, elapsed, timer.count, timer.seconds,
+                '\n'.join(f'  {seconds * 1000:.1f} ms  {sql[:500]}' for seconds, _, sql in slowest) or '  (none)',
+            )
+        return response
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0002_remove_uploadedfile_title_alter_uploadedfile_user_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(max_length=255, upload_to='blobs/')),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file',
+            field=models.FileField(max_length=255, upload_to='uploads/'),
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='uploads', to='share.storedblob'),
+        ),
+    ]
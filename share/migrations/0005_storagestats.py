@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_storage_stats(apps, schema_editor):
+    UploadedFile = apps.get_model('share', 'UploadedFile')
+    StorageStats = apps.get_model('share', 'StorageStats')
+    StorageStats.objects.bulk_create([
+        StorageStats(user_id=t['user'], file_count=t['file_count'], bytes_used=t['bytes_used'] or 0)
+        for t in UploadedFile.objects.order_by().values('user').annotate(
+            file_count=Count('id'), bytes_used=Sum('size'))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('share', '0004_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes_used', models.BigIntegerField(default=0)),
+                ('file_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_storage_stats, migrations.RunPython.noop),
+    ]
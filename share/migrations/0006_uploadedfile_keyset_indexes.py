@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:07
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_names(apps, schema_editor):
+    # Legacy rows have no stored name; sorting by name needs one.
+    UploadedFile = apps.get_model('share', 'UploadedFile')
+    for upload in UploadedFile.objects.filter(name='').only('id', 'file').iterator():
+        UploadedFile.objects.filter(pk=upload.pk).update(name=os.path.basename(upload.file.name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0005_storagestats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'uploaded_at', 'id'], name='share_upl_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'name', 'id'], name='share_upl_user_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'size', 'id'], name='share_upl_user_size_idx'),
+        ),
+        migrations.RunPython(backfill_names, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:08
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0006_uploadedfile_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='downloadlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0007_downloadlog_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyFileDownloads',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('downloads', models.PositiveIntegerField(default=0)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_downloads', to='share.uploadedfile')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='share_dfd_date_idx'), models.Index(fields=['owner', 'date'], name='share_dfd_owner_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'file'), name='share_daily_file_downloads_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyUserDownloads',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('downloads', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_downloads', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], name='share_dud_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'user'), name='share_daily_user_downloads_uniq')],
+            },
+        ),
+    ]
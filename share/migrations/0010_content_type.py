@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0009_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
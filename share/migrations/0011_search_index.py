@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    # FTS5 is SQLite-only; search falls back to name matching on other databases.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE share_search USING fts5("
+        "user_id UNINDEXED, name, body, tokenize='unicode61 remove_diacritics 2')"
+    )
+    # Names are indexed straight away; rebuild_search_index fills in document text.
+    schema_editor.execute(
+        "INSERT INTO share_search(rowid, user_id, name, body) "
+        "SELECT id, user_id, COALESCE(NULLIF(name, ''), file), '' FROM share_uploadedfile"
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS share_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0010_content_type'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:27
+
+import share.layout
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0011_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file',
+            field=models.FileField(max_length=255, upload_to=share.layout.upload_to),
+        ),
+    ]
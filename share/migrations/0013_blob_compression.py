@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:28
+
+import share.storage
+from django.db import migrations, models
+from django.db.models import F
+
+
+def existing_blobs_are_raw(apps, schema_editor):
+    StoredBlob = apps.get_model('share', 'StoredBlob')
+    StoredBlob.objects.update(stored_size=F('size'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0012_sharded_upload_layout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedblob',
+            name='encoding',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='storedblob',
+            name='stored_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='storedblob',
+            name='file',
+            field=models.FileField(max_length=255, storage=share.storage.get_blob_storage, upload_to='blobs/'),
+        ),
+        migrations.RunPython(existing_blobs_are_raw, migrations.RunPython.noop),
+    ]
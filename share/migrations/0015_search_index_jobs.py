@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0014_share_links'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchIndexJob',
+            fields=[
+                ('upload', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='share.uploadedfile')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0015_search_index_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file',
+            field=models.FileField(max_length=255, upload_to='uploads/'),
+        ),
+    ]
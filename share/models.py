@@ -1,18 +1,214 @@
+import os
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
+from . import previews
+from .storage import get_blob_storage
+
+
+class StoredBlob(models.Model):
+    # One physical file per distinct content digest, shared by every
+    # UploadedFile row with the same bytes.
+    digest = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='blobs/', max_length=255, storage=get_blob_storage)
+    # Size and digest are of the original bytes; stored_size is what is on disk.
+    size = models.BigIntegerField()
+    encoding = models.CharField(max_length=10, blank=True)
+    stored_size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
+
 class UploadedFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='main_uploaded_files')
-    file = models.FileField(upload_to='uploads/')
+    blob = models.ForeignKey(StoredBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='uploads')
+    # Mirrors blob.file.name; see share/layout.py.
+    file = models.FileField(upload_to='uploads/', max_length=255)
+    name = models.CharField(max_length=255, blank=True)
+    size = models.BigIntegerField(default=0)
+    # Sniffed from the file's first bytes at upload time.
+    content_type = models.CharField(max_length=100, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Keyset pagination walks (user, sort key, id) for each sort order.
+        indexes = [
+            models.Index(fields=['user', 'uploaded_at', 'id'], name='share_upl_user_date_idx'),
+            models.Index(fields=['user', 'name', 'id'], name='share_upl_user_name_idx'),
+            models.Index(fields=['user', 'size', 'id'], name='share_upl_user_size_idx'),
+        ]
+
     def _str_(self):
         return self.file.name
 
+    @property
+    def display_name(self):
+        # Blob-backed rows live under their digest, so the original name is kept separately.
+        return self.name or os.path.basename(self.file.name)
+
+    @property
+    def preview_kind(self):
+        return previews.preview_kind(self)
+
+class StorageStats(models.Model):
+    # Denormalized per-user totals, kept in step with UploadedFile by signals.
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='storage_stats')
+    bytes_used = models.BigIntegerField(default=0)
+    file_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.file_count} files, {self.bytes_used} bytes"
+
+    @property
+    def mb_used(self):
+        return self.bytes_used / (1024 * 1024)
+
 class DownloadLog(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the download happens, not when a buffered batch is flushed.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
 
     def _str_(self):
-        return f"{self.user.username} downloaded {self.file.file.name} on {self.timestamp}"
\ No newline at end of file
+        return f"{self.user.username} downloaded {self.file.file.name} on {self.timestamp}"
+
+
+class ShareLink(models.Model):
+    # Issued share links, kept so owners can list and revoke them. Serving a
+    # link never reads this table; see share/links.py.
+    jti = models.CharField(max_length=32, unique=True)
+    file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='share_links')
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    # Comma-separated names from links.PERMISSIONS.
+    permissions = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    revoked_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], name='share_link_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.jti} for file {self.file_id} until {self.expires_at}"
+
+
+class UploadSession(models.Model):
+    # A resumable upload in progress; bytes are appended to a partial file on disk.
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    content_type = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.length})"
+
+    @property
+    def path(self):
+        return os.path.join(settings.SHARE_CHUNKED_UPLOAD_DIR, f'{self.id}.part')
+
+    @property
+    def is_complete(self):
+        return self.offset == self.length
+
+
+class DailyFileDownloads(models.Model):
+    # Materialized by the rollup_downloads command; reports read only these tables.
+    date = models.DateField()
+    file = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='daily_downloads')
+    # Denormalized uploader so per-owner activity needs no join through UploadedFile.
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    downloads = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'file'], name='share_daily_file_downloads_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['date'], name='share_dfd_date_idx'),
+            models.Index(fields=['owner', 'date'], name='share_dfd_owner_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} file {self.file_id}: {self.downloads}"
+
+
+class DailyUserDownloads(models.Model):
+    date = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_downloads')
+    downloads = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'user'], name='share_daily_user_downloads_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['date'], name='share_dud_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} user {self.user_id}: {self.downloads}"
+
+
+class RollupWatermark(models.Model):
+    # Highest source row id already folded into a rollup.
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
+
+
+class SearchIndexJob(models.Model):
+    # An upload whose document text the index_documents worker has yet to extract;
+    # its name is searchable from the moment it commits.
+    upload = models.OneToOneField(UploadedFile, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"index text of {self.upload_id}"
+
+
+class OutboxEmail(models.Model):
+    # Transactional outbox: rows are written with the change that triggers them
+    # and delivered later by the send_outbox worker.
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='share_outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.to)} ({self.status})"
@@ -0,0 +1,103 @@
+"""Transactional email outbox.
+
+Views call ``enqueue`` inside the same transaction as the change that
+needs an email, so the request never waits on SMTP and an email is never
+queued for a rolled-back change. The ``send_outbox`` worker calls
+``deliver_batch`` to send due messages over one reused backend connection,
+retrying failures with exponential backoff.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+# How long a claimed batch is hidden from other workers.
+CLAIM_LEASE = timedelta(minutes=5)
+BACKOFF_BASE = timedelta(seconds=30)
+BACKOFF_MAX = timedelta(hours=6)
+
+
+def enqueue(subject, body, to, from_email=None):
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(to),
+    )
+
+
+def enqueue_many(messages, batch_size=500):
+    """Queue ``(subject, body, to)`` tuples with a single bulk insert per batch."""
+    return OutboxEmail.objects.bulk_create(
+        [
+            OutboxEmail(subject=subject, body=body, from_email=settings.DEFAULT_FROM_EMAIL, to=list(to))
+            for subject, body, to in messages
+        ],
+        batch_size=batch_size,
+    )
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+
+def claim_batch(batch_size):
+    """Reserve up to ``batch_size`` due messages for this worker and return them."""
+    now = timezone.now()
+    ids = list(
+        OutboxEmail.objects.filter(status=OutboxEmail.PENDING, next_attempt_at__lte=now)
+        .order_by('next_attempt_at', 'id')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+    # Push the claimed rows into the future; the exact lease timestamp identifies our claim.
+    lease = now + CLAIM_LEASE
+    OutboxEmail.objects.filter(id__in=ids, status=OutboxEmail.PENDING, next_attempt_at__lte=now).update(
+        next_attempt_at=lease
+    )
+    return list(OutboxEmail.objects.filter(id__in=ids, next_attempt_at=lease).order_by('id'))
+
+
+def _reconnect(connection):
+    # A broken SMTP session should not fail the rest of the batch.
+    connection.close()
+    try:
+        connection.open()
+    except Exception:
+        logger.warning('Could not reopen the mail connection.', exc_info=True)
+
+
+def deliver_batch(connection, batch_size=50, max_attempts=5):
+    """Send one batch of due messages over ``connection``; returns ``(sent, failed)``."""
+    batch = claim_batch(batch_size)
+    sent = failed = 0
+    for email in batch:
+        message = EmailMessage(email.subject, email.body, email.from_email, email.to, connection=connection)
+        email.attempts += 1
+        try:
+            message.send()
+        except Exception as e:
+            logger.warning('Sending outbox email %s failed (attempt %d): %s', email.pk, email.attempts, e)
+            email.last_error = str(e)
+            if email.attempts >= max_attempts:
+                email.status = OutboxEmail.FAILED
+            else:
+                email.next_attempt_at = timezone.now() + backoff(email.attempts)
+            failed += 1
+            _reconnect(connection)
+        else:
+            email.status = OutboxEmail.SENT
+            email.sent_at = timezone.now()
+            email.last_error = ''
+            sent += 1
+    OutboxEmail.objects.bulk_update(
+        batch, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at'], batch_size=500
+    )
+    return sent, failed
@@ -0,0 +1,94 @@
+"""Keyset (cursor) pagination for a user's file list.
+
+Pages are fetched with ``WHERE (key, id) < (last_key, last_id)`` against
+the ``(user, key, id)`` indexes on ``UploadedFile``, so every page costs the
+same no matter how deep the client has scrolled. Cursors are signed so
+clients cannot forge arbitrary filter values.
+"""
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import Q
+
+CURSOR_SALT = 'share.pagination.cursor'
+
+# sort parameter -> (model field, descending)
+SORTS = {
+    '-uploaded_at': ('uploaded_at', True),
+    'uploaded_at': ('uploaded_at', False),
+    'name': ('name', False),
+    '-name': ('name', True),
+    'size': ('size', False),
+    '-size': ('size', True),
+}
+DEFAULT_SORT = '-uploaded_at'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _encode(sort, obj):
+    value = getattr(obj, SORTS[sort][0])
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return signing.dumps({'s': sort, 'v': value, 'id': obj.pk}, salt=CURSOR_SALT, compress=True)
+
+
+def _decode(cursor, sort):
+    try:
+        data = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise InvalidCursor('Malformed or tampered cursor.')
+    if data.get('s') != sort:
+        raise InvalidCursor('Cursor was issued for a different sort order.')
+    value = data['v']
+    if SORTS[sort][0] == 'uploaded_at':
+        value = datetime.fromisoformat(value)
+    return value, data['id']
+
+
+def _seek(queryset, field, descending, value, pk):
+    op = 'lt' if descending else 'gt'
+    return queryset.filter(Q(**{f'{field}__{op}': value}) | Q(**{field: value, f'id__{op}': pk}))
+
+
+def _plan(queryset, sort, after, before):
+    """Return ``(sort, ordered queryset, backwards)`` for the requested page."""
+    if sort not in SORTS:
+        sort = DEFAULT_SORT
+    field, descending = SORTS[sort]
+    if before:
+        # Walk backwards from the cursor; the page is flipped back into display order afterwards.
+        value, pk = _decode(before, sort)
+        qs = _seek(queryset, field, not descending, value, pk)
+        return sort, qs.order_by(*(f'-{f}' if not descending else f for f in (field, 'id'))), True
+    if after:
+        value, pk = _decode(after, sort)
+        queryset = _seek(queryset, field, descending, value, pk)
+    return sort, queryset.order_by(*(f'-{f}' if descending else f for f in (field, 'id'))), False
+
+
+def _assemble(sort, rows, limit, after, backwards):
+    more = len(rows) > limit
+    items = rows[:limit]
+    if backwards:
+        items.reverse()
+        has_next, has_previous = True, more
+    else:
+        has_next, has_previous = more, bool(after)
+    next_cursor = _encode(sort, items[-1]) if items and has_next else None
+    previous_cursor = _encode(sort, items[0]) if items and has_previous else None
+    return items, next_cursor, previous_cursor
+
+
+def paginate(queryset, sort=DEFAULT_SORT, after=None, before=None, limit=25):
+    """Return ``(items, next_cursor, previous_cursor)`` for one page of ``queryset``."""
+    sort, qs, backwards = _plan(queryset, sort, after, before)
+    return _assemble(sort, list(qs[:limit + 1]), limit, after, backwards)
+
+
+async def apaginate(queryset, sort=DEFAULT_SORT, after=None, before=None, limit=25):
+    """Async-ORM version of ``paginate``."""
+    sort, qs, backwards = _plan(queryset, sort, after, before)
+    return _assemble(sort, [obj async for obj in qs[:limit + 1]], limit, after, backwards)
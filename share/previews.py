@@ -0,0 +1,212 @@
+"""Preview derivatives generated on first request and cached on disk.
+
+Images get a JPEG thumbnail, PDFs a PNG render of their first page (only
+when poppler's ``pdftoppm`` is installed), and text files a snippet of
+their first lines. Decoding runs in a process pool (see ``derivatives``),
+so request threads only wait on a future. Concurrent requests for the
+same preview share one render.
+
+Derivatives are stored under ``SHARE_PREVIEW_DIR`` by content digest, so
+identical files share previews and a preview never goes stale. Every hit
+touches the file's mtime. When the directory grows past
+``SHARE_PREVIEW_CACHE_BYTES``, the least recently used files are
+deleted.
+"""
+import hashlib
+import importlib.util
+import mimetypes
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from django.conf import settings
+
+from . import derivatives, storage
+
+KINDS = {
+    'image/png': 'thumb',
+    'image/jpeg': 'thumb',
+    'application/pdf': 'pdf',
+    'text/plain': 'text',
+}
+CONTENT_TYPES = {
+    'thumb': 'image/jpeg',
+    'pdf': 'image/png',
+    'text': 'text/plain; charset=utf-8',
+}
+EXTENSIONS = {'thumb': 'jpg', 'pdf': 'png', 'text': 'txt'}
+
+# Eviction deletes down to this fraction of the limit, so it doesn't rerun on every new preview.
+EVICT_TO = 0.9
+
+_lock = threading.Lock()
+_executor = None
+_pending = {}
+_cache_bytes = None
+
+
+class PreviewPending(Exception):
+    """The preview is still rendering after ``SHARE_PREVIEW_TIMEOUT`` seconds."""
+
+
+@lru_cache
+def _available(kind):
+    if kind == 'thumb':
+        return importlib.util.find_spec('PIL') is not None
+    if kind == 'pdf':
+        return shutil.which(settings.SHARE_PREVIEW_PDFTOPPM) is not None
+    return True
+
+
+def preview_kind(upload):
+    """Return the kind of preview ``upload`` can have, or ``None``."""
+    content_type = upload.content_type or mimetypes.guess_type(upload.display_name)[0]
+    kind = KINDS.get(content_type)
+    return kind if kind and _available(kind) else None
+
+
+def cache_key(upload):
+    """Return the key ``upload``'s previews are stored under, or ``None`` if its file is missing."""
+    if upload.blob_id:
+        return upload.blob.digest
+    # Legacy files have no stored digest; their name, size and mtime identify the content.
+    try:
+        stat = os.stat(upload.file.path)
+    except FileNotFoundError:
+        return None
+    return hashlib.sha256(f'{upload.file.name}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+
+def path_for(key, kind):
+    return os.path.join(settings.SHARE_PREVIEW_DIR, key[:2], f'{key}.{kind}.{EXTENSIONS[kind]}')
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        # Spawned, not forked: forking a threaded server process can deadlock the child.
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.SHARE_PREVIEW_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _executor
+
+
+def _options():
+    return {
+        'size': settings.SHARE_PREVIEW_SIZE,
+        'pdftoppm': settings.SHARE_PREVIEW_PDFTOPPM,
+        'timeout': settings.SHARE_PREVIEW_TIMEOUT,
+        'text_bytes': 4096,
+        'text_lines': 40,
+    }
+
+
+def _submit(kind, source, dest, encoding=''):
+    global _executor
+    with _lock:
+        future = _pending.get(dest)
+        if future is None:
+            try:
+                future = _pool().submit(derivatives.render, kind, source, dest, _options(), encoding)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool.
+                _executor = None
+                future = _pool().submit(derivatives.render, kind, source, dest, _options(), encoding)
+            _pending[dest] = future
+            future.add_done_callback(lambda f: _pending.pop(dest, None))
+    return future
+
+
+def get(upload, kind=None):
+    """Return the path of ``upload``'s preview, rendering it first if needed.
+
+    Returns ``None`` if the file has no preview. Raises ``PreviewPending``
+    if rendering takes longer than ``SHARE_PREVIEW_TIMEOUT``. The render
+    keeps going, and a later request picks up the result.
+    """
+    kind = kind or preview_kind(upload)
+    key = cache_key(upload)
+    if kind is None or key is None:
+        return None
+    path = path_for(key, kind)
+    try:
+        os.utime(path)
+        return path if os.path.getsize(path) else None
+    except FileNotFoundError:
+        pass
+
+    future = _submit(kind, upload.file.path, path, storage.upload_encoding(upload))
+    try:
+        ok = future.result(timeout=settings.SHARE_PREVIEW_TIMEOUT)
+    except TimeoutError:
+        raise PreviewPending(path)
+    except BrokenProcessPool:
+        return None
+    _account(path)
+    return path if ok else None
+
+
+def _account(path):
+    global _cache_bytes
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return
+    with _lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(size for _, size, _ in _entries())
+        else:
+            _cache_bytes += size
+        over = _cache_bytes > settings.SHARE_PREVIEW_CACHE_BYTES
+    if over:
+        evict()
+
+
+def _entries():
+    root = settings.SHARE_PREVIEW_DIR
+    if not os.path.isdir(root):
+        return
+    with os.scandir(root) as shards:
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            with os.scandir(shard.path) as files:
+                for entry in files:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+
+def evict(limit=None):
+    """Delete least recently used previews until the cache is below ``EVICT_TO`` of ``limit``.
+
+    Returns the number of files removed.
+    """
+    global _cache_bytes
+    limit = settings.SHARE_PREVIEW_CACHE_BYTES if limit is None else limit
+    entries = sorted(_entries())
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    if total > limit:
+        target = limit * EVICT_TO
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+    with _lock:
+        _cache_bytes = total
+    return removed
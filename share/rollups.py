@@ -0,0 +1,102 @@
+"""Daily download rollups built incrementally from ``DownloadLog``.
+
+``advance`` folds the ``DownloadLog`` rows above the stored watermark into
+``DailyFileDownloads`` and ``DailyUserDownloads``, and moves the watermark
+in the same transaction. A batch is therefore either fully counted or
+not counted at all: re-running is idempotent and never rescans history.
+The report helpers read only the rollup tables.
+"""
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDate
+
+from .models import DailyFileDownloads, DailyUserDownloads, DownloadLog, RollupWatermark
+
+WATERMARK = 'download_logs'
+
+
+def _merge(model, key_fields, counts):
+    """Add ``counts`` ({key tuple: n}) onto existing rollup rows, creating missing ones."""
+    if not counts:
+        return
+    dates = {key[0] for key in counts}
+    others = {key[1] for key in counts}
+    existing = {
+        tuple(getattr(row, f) for f in key_fields): row
+        for row in model.objects.filter(**{'date__in': dates, f'{key_fields[1]}__in': others})
+    }
+    to_update, to_create = [], []
+    for key, (n, extra) in counts.items():
+        row = existing.get(key)
+        if row is not None:
+            row.downloads += n
+            to_update.append(row)
+        else:
+            to_create.append(model(**dict(zip(key_fields, key)), downloads=n, **extra))
+    model.objects.bulk_update(to_update, ['downloads'], batch_size=500)
+    model.objects.bulk_create(to_create, batch_size=500)
+
+
+def advance(batch_size=50000):
+    """Fold at most ``batch_size`` new log ids into the rollups.
+
+    Returns the number of log rows aggregated, or ``None`` once caught up.
+    """
+    with transaction.atomic():
+        mark, _ = RollupWatermark.objects.select_for_update().get_or_create(name=WATERMARK)
+        upper = DownloadLog.objects.filter(
+            id__gt=mark.last_id, id__lte=mark.last_id + batch_size
+        ).aggregate(upper=Max('id'))['upper']
+        if upper is None:
+            # Skip over a gap in ids (deleted logs) if there is anything beyond it.
+            upper = DownloadLog.objects.filter(id__gt=mark.last_id).aggregate(upper=Max('id'))['upper']
+            if upper is None:
+                return None
+            upper = min(upper, mark.last_id + batch_size)
+            mark.last_id = upper
+            mark.save(update_fields=['last_id', 'updated_at'])
+            return 0
+
+        logs = DownloadLog.objects.filter(id__gt=mark.last_id, id__lte=upper).annotate(day=TruncDate('timestamp'))
+        per_file = {
+            (row['day'], row['file']): (row['n'], {'owner_id': row['file__user']})
+            for row in logs.values('day', 'file', 'file__user').annotate(n=Count('id')).order_by()
+        }
+        per_user = {
+            (row['day'], row['user']): (row['n'], {})
+            for row in logs.values('day', 'user').annotate(n=Count('id')).order_by()
+        }
+        _merge(DailyFileDownloads, ('date', 'file_id'), per_file)
+        _merge(DailyUserDownloads, ('date', 'user_id'), per_user)
+
+        mark.last_id = upper
+        mark.save(update_fields=['last_id', 'updated_at'])
+        return sum(n for n, _ in per_file.values())
+
+
+def top_files(since, limit=10):
+    return (
+        DailyFileDownloads.objects.filter(date__gte=since)
+        .values('file_id', 'file__name', 'owner__username')
+        .annotate(total=Sum('downloads'))
+        .order_by('-total')[:limit]
+    )
+
+
+def owner_activity(since, limit=20):
+    # The app has no course model; a lecturer's uploads stand in for their course material.
+    return (
+        DailyFileDownloads.objects.filter(date__gte=since)
+        .values('owner__username')
+        .annotate(total=Sum('downloads'), files=Count('file', distinct=True))
+        .order_by('-total')[:limit]
+    )
+
+
+def downloads_over_time(since):
+    return (
+        DailyUserDownloads.objects.filter(date__gte=since)
+        .values('date')
+        .annotate(total=Sum('downloads'), users=Count('user'))
+        .order_by('date')
+    )
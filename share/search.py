@@ -0,0 +1,253 @@
+"""Full-text search over file names and document text, using SQLite FTS5.
+
+The ``share_search`` virtual table (created by migration 0011) has one row
+per ``UploadedFile``, using the same rowid. Each row holds the file's name
+and the text extracted from ``.txt``, ``.docx`` and ``.pdf`` uploads.
+Signals keep it current. The upload's transaction inserts a row with just
+the name, plus a ``SearchIndexJob`` if the file has text to extract, and
+the deleting transaction removes the row. Extraction (up to
+``MAX_PDF_PAGES`` of a PDF) never runs in a request: the
+``index_documents`` worker fills in the text. ``rebuild_search_index``
+rebuilds the whole index from scratch.
+
+Results are ranked with bm25, and a match in the name weighs more than
+one in the body. On databases other than SQLite, search falls back to
+matching names only.
+"""
+import os
+import re
+import zipfile
+from xml.etree import ElementTree
+
+from django.db import connections, router, transaction
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from . import storage
+from .models import SearchIndexJob, UploadedFile
+
+TABLE = 'share_search'
+# Stop extracting once this much text is in hand; ranking barely changes past it.
+MAX_TEXT_CHARS = 200_000
+MAX_PDF_PAGES = 50
+# bm25 weights for (user_id, name, body).
+WEIGHTS = (0.0, 10.0, 1.0)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+DOCX_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+# Private-use markers around snippet matches, swapped for <mark> after escaping.
+MARK_START, MARK_END = '\ue000', '\ue001'
+
+
+def enabled(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+# TEXT EXTRACTION
+
+def _text_from_txt(fh):
+    return fh.read(MAX_TEXT_CHARS * 4).decode('utf-8', errors='replace')[:MAX_TEXT_CHARS]
+
+
+def _text_from_docx(fh):
+    parts, length = [], 0
+    with zipfile.ZipFile(fh) as archive, archive.open('word/document.xml') as document:
+        # iterparse streams the XML, so a huge document is never held as a tree.
+        for _, element in ElementTree.iterparse(document):
+            if element.tag == DOCX_NS + 't' and element.text:
+                parts.append(element.text)
+                length += len(element.text)
+            elif element.tag == DOCX_NS + 'p':
+                parts.append('\n')
+                element.clear()
+            if length >= MAX_TEXT_CHARS:
+                break
+    return ''.join(parts)[:MAX_TEXT_CHARS]
+
+
+def _text_from_pdf(fh):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        # Optional dependency: without pypdf, PDFs are searchable by name only.
+        return ''
+    parts, length = [], 0
+    for page in PdfReader(fh).pages[:MAX_PDF_PAGES]:
+        text = page.extract_text() or ''
+        parts.append(text)
+        length += len(text)
+        if length >= MAX_TEXT_CHARS:
+            break
+    return '\n'.join(parts)[:MAX_TEXT_CHARS]
+
+
+EXTRACTORS = {
+    '.txt': _text_from_txt,
+    '.docx': _text_from_docx,
+    '.pdf': _text_from_pdf,
+}
+
+
+def extract_text(path, filename, encoding=''):
+    """Return the searchable text of the file at ``path``, or ``''``.
+
+    ``encoding`` is how the file is stored (see ``storage``); gzipped files are read decompressed.
+    """
+    extractor = EXTRACTORS.get(os.path.splitext(filename.lower())[1])
+    if extractor is None:
+        return ''
+    try:
+        with storage.open_path(path, encoding) as fh:
+            return extractor(fh)
+    except Exception:
+        # A corrupt document is still findable by its name.
+        return ''
+
+
+def job(upload):
+    """Return the picklable ``(rowid, user_id, name, path, encoding)`` that ``document`` indexes."""
+    try:
+        path = upload.file.path
+    except (ValueError, NotImplementedError):
+        path = None
+    return upload.id, upload.user_id, upload.display_name, path, storage.upload_encoding(upload)
+
+
+def document(job):
+    """Return the ``(rowid, user_id, name, body)`` index row for a ``job``.
+
+    It needs no database access, so the rebuild command can run it in worker processes.
+    """
+    pk, user_id, name, path, encoding = job
+    body = extract_text(path, name, encoding) if path and os.path.exists(path) else ''
+    return pk, user_id, name, body
+
+
+# INDEX MAINTENANCE
+
+def write(rows, using='default'):
+    """Insert or replace index rows (tuples from ``document``)."""
+    if not enabled(using) or not rows:
+        return
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(row[0],) for row in rows])
+        cursor.executemany(f'INSERT INTO {TABLE}(rowid, user_id, name, body) VALUES (%s, %s, %s, %s)', rows)
+
+
+def has_text(name):
+    return os.path.splitext(name.lower())[1] in EXTRACTORS
+
+
+def index_names(uploads):
+    """Index new uploads by name and queue the ones with text for ``index_pending``.
+
+    Call it in the transaction that creates them; it does no file I/O.
+    """
+    if not enabled():
+        return
+    uploads = list(uploads)
+    write([(upload.id, upload.user_id, upload.display_name, '') for upload in uploads])
+    SearchIndexJob.objects.bulk_create(
+        [SearchIndexJob(upload=upload) for upload in uploads if has_text(upload.display_name)]
+    )
+
+
+def index_pending(batch_size=50):
+    """Extract the text of up to ``batch_size`` queued uploads; return how many jobs were done."""
+    pending = list(
+        SearchIndexJob.objects.select_related('upload__blob').order_by('created_at', 'upload_id')[:batch_size]
+    )
+    if not pending:
+        return 0
+    # Reading the files happens outside the transaction, which holds SQLite's write lock.
+    rows = [document(job(entry.upload)) for entry in pending]
+    ids = [entry.upload_id for entry in pending]
+    with transaction.atomic():
+        # An upload deleted meanwhile has had its row removed; don't bring it back.
+        live = set(UploadedFile.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        write([row for row in rows if row[0] in live])
+        SearchIndexJob.objects.filter(upload_id__in=ids).delete()
+    return len(pending)
+
+
+def remove(upload_ids, using='default'):
+    if not enabled(using) or not upload_ids:
+        return
+    with connections[using].cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(pk,) for pk in upload_ids])
+
+
+def remove_orphans(using='default'):
+    """Drop index rows whose file no longer exists; return how many."""
+    if not enabled(using):
+        return 0
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {TABLE} WHERE rowid NOT IN (SELECT id FROM {UploadedFile._meta.db_table})'
+        )
+        return cursor.rowcount
+
+
+def optimize(using='default'):
+    if enabled(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')")
+
+
+# QUERYING
+
+def match_expression(query):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix."""
+    words = WORD_RE.findall(query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _highlight(snippet):
+    return mark_safe(escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def search(user, query, offset=0, limit=20):
+    """Return ``(uploads, has_more)`` for one page of ``user``'s best matches for ``query``.
+
+    Staff see every user's files; everyone else only their own. Each
+    upload gets a ``snippet`` attribute with the matches wrapped in
+    ``<mark>``.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return [], False
+    using = router.db_for_read(UploadedFile)
+    if not enabled(using):
+        qs = UploadedFile.objects.using(using).filter(name__icontains=query.strip()).order_by('-uploaded_at')
+        if not user.is_staff:
+            qs = qs.filter(user=user)
+        uploads = list(qs[offset:offset + limit + 1])
+        for upload in uploads:
+            upload.snippet = ''
+        return uploads[:limit], len(uploads) > limit
+
+    sql = (
+        f"SELECT rowid, snippet({TABLE}, -1, %s, %s, '…', 16) FROM {TABLE} "
+        f"WHERE {TABLE} MATCH %s {'' if user.is_staff else 'AND user_id = %s'} "
+        f"ORDER BY bm25({TABLE}, {', '.join(map(str, WEIGHTS))}) LIMIT %s OFFSET %s"
+    )
+    params = [MARK_START, MARK_END, expression]
+    if not user.is_staff:
+        params.append(user.id)
+    params += [limit + 1, offset]
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        hits = cursor.fetchall()
+
+    found = UploadedFile.objects.using(using).select_related('user').in_bulk([pk for pk, _ in hits[:limit]])
+    uploads = []
+    for pk, snippet in hits[:limit]:
+        upload = found.get(pk)
+        if upload is not None:
+            upload.snippet = _highlight(snippet)
+            uploads.append(upload)
+    return uploads, len(hits) > limit
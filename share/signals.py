@@ -0,0 +1,51 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from . import auth, blobs, cache, search, stats
+from .models import UploadedFile
+
+# Sent after UploadedFile.objects.bulk_create(), which skips post_save.
+# Arguments: user, uploads (the created instances).
+uploads_bulk_created = Signal()
+
+
+@receiver(post_save, sender=UploadedFile)
+def count_upload(sender, instance, created, **kwargs):
+    if created:
+        stats.adjust(instance.user_id, 1, instance.size)
+        search.index_names([instance])
+    cache.bump(instance.user_id)
+
+
+@receiver(uploads_bulk_created)
+def count_bulk_uploads(sender, user, uploads, **kwargs):
+    stats.adjust(user.id, len(uploads), sum(u.size for u in uploads))
+    search.index_names(uploads)
+    cache.bump(user.id)
+
+
+@receiver(post_delete, sender=UploadedFile)
+def release_blob(sender, instance, **kwargs):
+    stats.adjust(instance.user_id, -1, -instance.size)
+    search.remove([instance.pk])
+    cache.bump(instance.user_id)
+    if instance.blob_id:
+        blobs.release(instance.blob_id)
+    elif instance.file.name:
+        # Legacy uploads own their file outright.
+        name, storage = instance.file.name, instance.file.storage
+
+        def delete_file():
+            if not UploadedFile.objects.filter(file=name).exists():
+                storage.delete(name)
+
+        transaction.on_commit(delete_file)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Password changes, deactivation and activation must apply on the next request.
+    auth.invalidate(instance.pk)
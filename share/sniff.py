@@ -0,0 +1,105 @@
+"""Server-side file type detection from the first bytes of an upload.
+
+Only the first ``SNIFF_BYTES`` of a file are inspected. They are matched
+against one precompiled signature pattern, and the result must agree with
+the file's extension. The detected type is stored on ``UploadedFile`` so
+downloads can send it without sniffing again.
+"""
+import os
+import re
+
+from django.core.exceptions import ValidationError
+
+SNIFF_BYTES = 8 * 1024
+
+OLE2 = 'application/x-ole-storage'
+ZIP = 'application/zip'
+
+# One alternation, anchored at the start of the file; the named group says which signature hit.
+SIGNATURES = re.compile(
+    rb'(?P<pdf>%PDF-)'
+    rb'|(?P<png>\x89PNG\r\n\x1a\n)'
+    rb'|(?P<jpeg>\xff\xd8\xff)'
+    rb'|(?P<ole2>\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1)'
+    rb'|(?P<zip>PK\x03\x04)',
+)
+SIGNATURE_TYPES = {
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'ole2': OLE2,
+    'zip': ZIP,
+}
+
+# OOXML packages are zips whose part names start with these folders.
+OOXML_PARTS = {
+    '.docx': b'word/',
+    '.xlsx': b'xl/',
+    '.pptx': b'ppt/',
+}
+
+# extension -> (container type the bytes must match, Content-Type to store)
+EXPECTED = {
+    '.pdf': ('application/pdf', 'application/pdf'),
+    '.png': ('image/png', 'image/png'),
+    '.jpg': ('image/jpeg', 'image/jpeg'),
+    '.jpeg': ('image/jpeg', 'image/jpeg'),
+    '.txt': ('text/plain', 'text/plain'),
+    '.doc': (OLE2, 'application/msword'),
+    '.xls': (OLE2, 'application/vnd.ms-excel'),
+    '.ppt': (OLE2, 'application/vnd.ms-powerpoint'),
+    '.docx': (ZIP, 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    '.xlsx': (ZIP, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    '.pptx': (ZIP, 'application/vnd.openxmlformats-officedocument.presentationml.presentation'),
+}
+
+
+def _looks_like_text(head):
+    if b'\x00' in head:
+        return False
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sniffed chunk is fine.
+        return e.start >= len(head) - 3
+    return True
+
+
+def detect(head):
+    """Return the container type of ``head`` (the first bytes of a file), or ``None``."""
+    match = SIGNATURES.match(head)
+    if match:
+        return SIGNATURE_TYPES[match.lastgroup]
+    if _looks_like_text(head):
+        return 'text/plain'
+    return None
+
+
+def check(head, filename):
+    """Return the Content-Type to store for ``filename``, or raise ``ValidationError``
+    if its first bytes don't match its extension."""
+    ext = os.path.splitext(filename.lower())[1]
+    if ext not in EXPECTED:
+        raise ValidationError('Invalid file extension.', code='unsupported_type')
+    container, content_type = EXPECTED[ext]
+    detected = detect(head[:SNIFF_BYTES])
+    if detected == container and container == ZIP:
+        # [Content_Types].xml and the main part's folder appear in the first local headers.
+        if b'[Content_Types].xml' not in head or OOXML_PARTS[ext] not in head:
+            detected = ZIP + ' (not an Office document)'
+    if detected != container:
+        raise ValidationError(
+            f'File contents ({detected or "unknown type"}) do not match the {ext} extension.',
+            code='unsupported_type',
+        )
+    return content_type
+
+
+def check_upload(uploaded_file):
+    """Like ``check`` for a Django ``UploadedFile``, reusing the head captured by the upload handler."""
+    head = getattr(uploaded_file, 'head', None)
+    if head is None:
+        uploaded_file.seek(0)
+        head = uploaded_file.read(SNIFF_BYTES)
+        uploaded_file.seek(0)
+    return check(head, uploaded_file.name)
@@ -0,0 +1,65 @@
+"""Per-user storage counters and upload quotas.
+
+``StorageStats`` is adjusted with F-expressions whenever an ``UploadedFile``
+is created or deleted, so reading a user's usage is a single primary-key
+lookup. ``reconcile_storage_stats`` rebuilds the counters from the
+``UploadedFile`` table if they ever drift.
+"""
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import StorageStats
+
+
+def for_user(user):
+    """Return the user's counters, or unsaved zeroed counters if they have none yet."""
+    return StorageStats.objects.filter(user=user).first() or StorageStats(user=user)
+
+
+async def afor_user(user):
+    return await StorageStats.objects.filter(user=user).afirst() or StorageStats(user=user)
+
+
+def adjust(user_id, files, size):
+    updated = StorageStats.objects.filter(user_id=user_id).update(
+        file_count=F('file_count') + files,
+        bytes_used=F('bytes_used') + size,
+    )
+    if updated or files <= 0:
+        # Never create a row on delete: the user itself may be going away.
+        return
+    try:
+        with transaction.atomic():
+            StorageStats.objects.create(user_id=user_id, file_count=files, bytes_used=size)
+    except IntegrityError:
+        adjust(user_id, files, size)
+
+
+def quota_bytes():
+    return getattr(settings, 'SHARE_USER_QUOTA_BYTES', None)
+
+
+def check_quota(user, size):
+    """Raise ``ValidationError`` if storing ``size`` more bytes would put ``user`` over quota."""
+    quota = quota_bytes()
+    if quota is not None:
+        used = StorageStats.objects.filter(user=user).values_list('bytes_used', flat=True).first() or 0
+        _enforce(quota, used, size)
+
+
+async def acheck_quota(user, size):
+    quota = quota_bytes()
+    if quota is not None:
+        used = await StorageStats.objects.filter(user=user).values_list('bytes_used', flat=True).afirst() or 0
+        _enforce(quota, used, size)
+
+
+def _enforce(quota, used, size):
+    if used + size > quota:
+        raise ValidationError(
+            f'Upload would exceed your storage quota of {quota / 1024 / 1024:.0f} MB '
+            f'({used / 1024 / 1024:.2f} MB used).',
+            code='quota_exceeded',
+        )
@@ -0,0 +1,127 @@
+"""Blob storage that gzips compressible files as they are saved.
+
+``CompressingStorage`` is a ``FileSystemStorage``. A file whose first
+bytes sniff as plain text or a legacy OLE2 Office document is compressed
+chunk by chunk while it is written, and stored under its name plus
+``.gz``. Types that are already compressed (JPEG, PNG, OOXML/ZIP, PDF)
+are written as-is, and so is any file that would save less than
+``MIN_SAVING``. The stored name says how a file is encoded;
+``StoredBlob.encoding`` and ``stored_size`` record the same fact for
+readers.
+
+Use ``open_original`` to read an upload's original bytes, whatever its
+encoding.
+"""
+import gzip
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.functional import LazyObject
+
+from . import sniff
+
+GZIP = 'gzip'
+SUFFIX = '.gz'
+COMPRESSIBLE_TYPES = {'text/plain', sniff.OLE2}
+
+
+def encoding_for(name):
+    return GZIP if name.endswith(SUFFIX) else ''
+
+
+def _head(content):
+    head = getattr(content, 'head', None)
+    if head is None:
+        content.seek(0)
+        head = content.read(sniff.SNIFF_BYTES)
+        content.seek(0)
+    return head
+
+
+class CompressingStorage(FileSystemStorage):
+    def should_compress(self, content):
+        options = settings.SHARE_BLOB_COMPRESSION
+        if not options['ENABLED'] or content.size < options['MIN_SIZE']:
+            return False
+        return sniff.detect(_head(content)[:sniff.SNIFF_BYTES]) in COMPRESSIBLE_TYPES
+
+    def _save(self, name, content):
+        if not self.should_compress(content):
+            return super()._save(name, content)
+
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        tmp_path = f'{full_path}.{uuid.uuid4().hex}.tmp'
+        content.seek(0)
+        try:
+            with open(tmp_path, 'wb') as raw:
+                # mtime=0 and no filename: the same bytes always compress to the same file.
+                with gzip.GzipFile(
+                    filename='', fileobj=raw, mode='wb',
+                    compresslevel=settings.SHARE_BLOB_COMPRESSION['LEVEL'], mtime=0,
+                ) as compressed:
+                    for chunk in content.chunks():
+                        compressed.write(chunk)
+            saving = 1 - os.path.getsize(tmp_path) / content.size
+            if saving < settings.SHARE_BLOB_COMPRESSION['MIN_SAVING']:
+                os.remove(tmp_path)
+                content.seek(0)
+                return super()._save(name, content)
+            name = self.get_available_name(name + SUFFIX)
+            os.replace(tmp_path, self.path(name))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.file_permissions_mode is not None:
+            os.chmod(self.path(name), self.file_permissions_mode)
+        return name
+
+
+class _BlobStorage(LazyObject):
+    def _setup(self):
+        self._wrapped = CompressingStorage()
+
+
+blob_storage = _BlobStorage()
+
+
+def get_blob_storage():
+    # Callable form for FileField(storage=...), so migrations don't capture an instance.
+    return blob_storage
+
+
+class _GzipReader(gzip.GzipFile):
+    # GzipFile leaves a passed-in fileobj open; this one owns it.
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def upload_encoding(upload):
+    return upload.blob.encoding if upload.blob_id else ''
+
+
+def is_gzipped(upload):
+    return upload_encoding(upload) == GZIP
+
+
+def open_path(path, encoding=''):
+    """Open the file at ``path`` for reading its original bytes. Needs no Django setup."""
+    if encoding == GZIP:
+        return _GzipReader(fileobj=open(path, 'rb'), mode='rb')
+    return open(path, 'rb')
+
+
+def open_original(upload):
+    """Open ``upload``'s original bytes for reading, decompressing if the blob is stored gzipped."""
+    fh = upload.file.storage.open(upload.file.name, 'rb')
+    if is_gzipped(upload):
+        return _GzipReader(fileobj=fh, mode='rb')
+    return fh
@@ -1,3 +1,1318 @@
-from django.test import TestCase
+import base64
+import gzip
+import fcntl
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.core import signing
+from django.core.management import call_command
+from django.core.handlers.asgi import ASGIHandler
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from django.http.multipartparser import MultiPartParser
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from config.dbrouter import read_replica
+
+from . import auth, blobs, bulk, chunked, downloads, links, logbuffer, metrics, outbox, pagination, previews, rollups, search, sniff, stats, storage, throttle
+from . import cache as page_cache
+from .models import DailyFileDownloads, DailyUserDownloads, DownloadLog, OutboxEmail, SearchIndexJob, StorageStats, StoredBlob, UploadedFile, UploadSession
+from .storage import blob_storage
+
+
+class MediaRootMixin:
+    """Point MEDIA_ROOT at a fresh temporary directory for each test."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'correct horse battery')
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'correct horse battery')
+
+    @override_settings(SHARE_THROTTLE={'RATES': {'upload': {'user': (1, 3600)}}})
+    def test_rejected_upload_reads_no_body(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        throttle.take(throttle._key('upload', 'user', self.user.pk), 1, 3600)
+        upload = SimpleUploadedFile('notes.txt', b'x' * 300000, 'text/plain')
+        with mock.patch.object(MultiPartParser, 'parse', autospec=True, side_effect=MultiPartParser.parse) as parse:
+            response = client.post('/share/upload/', {'file': upload})
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(response.has_header('Retry-After'))
+        parse.assert_not_called()
+
+    @override_settings(SHARE_THROTTLE={'RATES': {'upload': {'user': (1, 3600)}}})
+    def test_allowed_upload_reaches_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        client.cookies['csrftoken'] = 'a' * 32
+        upload = SimpleUploadedFile('notes.txt', b'x' * 1000, 'text/plain')
+        with mock.patch.object(MultiPartParser, 'parse', autospec=True, side_effect=MultiPartParser.parse) as parse:
+            response = client.post('/share/upload/', {'file': upload})
+        self.assertEqual(response.status_code, 403)
+        parse.assert_called()
+
+    @override_settings(SHARE_THROTTLE={'RATES': {'login': {'user': (2, 300)}}})
+    def test_login_is_limited_per_username(self):
+        form = 'application/x-www-form-urlencoded'
+        for _ in range(2):
+            response = self.client.post('/login/', 'username=Alice&password=wrong', content_type=form)
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post('/login/', 'username=alice&password=wrong', content_type=form)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.client.post('/login/', 'username=bob&password=wrong', content_type=form).status_code, 200)
+        # Viewing the form is never limited.
+        self.assertEqual(self.client.get('/login/').status_code, 200)
+
+    def test_window_slides(self):
+        key = throttle._key('test', 'ip', '192.0.2.1')
+        self.assertEqual(throttle.take(key, 2, 10, now=100.0), 0)
+        self.assertEqual(throttle.take(key, 2, 10, now=101.0), 0)
+        self.assertAlmostEqual(throttle.take(key, 2, 10, now=101.0), 14.0)
+        # Rejections are not counted, and the whole of the previous window still overlaps.
+        self.assertAlmostEqual(throttle.take(key, 2, 10, now=110.0), 5.0)
+        self.assertEqual(throttle.take(key, 2, 10, now=115.0), 0)
+        self.assertAlmostEqual(throttle.take(key, 2, 10, now=115.0), 5.0)
+
+    def test_concurrent_requests_are_all_counted_and_none_refused(self):
+        key = throttle._key('test', 'ip', '192.0.2.2')
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            waits = list(pool.map(lambda _: throttle.take(key, 40, 60, now=120.0), range(40)))
+        self.assertEqual(waits, [0] * 40)
+        self.assertGreater(throttle.take(key, 40, 60, now=120.0), 0)
+
+    def test_client_ip_trusts_only_configured_proxies(self):
+        factory = RequestFactory()
+        request = factory.get('/', REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR='203.0.113.9, 198.51.100.7')
+        config = {**throttle.DEFAULTS, 'TRUSTED_PROXIES': []}
+        self.assertEqual(throttle.client_ip(request, config), '127.0.0.1')
+        config['TRUSTED_PROXIES'] = ['127.0.0.1']
+        # The left-most entry is whatever the client sent; the proxy appended the real address.
+        self.assertEqual(throttle.client_ip(request, config), '198.51.100.7')
+        config['TRUSTED_PROXIES'] = ['127.0.0.1', '198.51.100.0/24']
+        self.assertEqual(throttle.client_ip(request, config), '203.0.113.9')
+        spoofed = factory.get('/', REMOTE_ADDR='203.0.113.50', HTTP_X_FORWARDED_FOR='10.0.0.1')
+        self.assertEqual(throttle.client_ip(spoofed, config), '203.0.113.50')
+
+
+class SharedCacheCheckTests(TestCase):
+    @override_settings(
+        SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+        AUTHENTICATION_BACKENDS=['share.auth.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend'],
+    )
+    def test_cached_mode_needs_a_shared_cache(self):
+        self.assertEqual({error.id for error in auth.check_shared_cache()}, {'share.E001', 'share.E002'})
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/x'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(auth.check_shared_cache(), [])
+
+    def test_default_settings_pass(self):
+        self.assertEqual(auth.check_shared_cache(), [])
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=['share.auth.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend'],
+    )
+    def test_verify_email_logs_in_with_several_backends(self):
+        user = User.objects.create_user('bob', 'bob@example.com', 'correct horse battery', is_active=False)
+        uid = urlsafe_base64_encode(force_bytes(user.pk))
+        response = self.client.get(f'/share/verify/{uid}/{default_token_generator.make_token(user)}/')
+        self.assertRedirects(response, '/share/dashboard/', fetch_redirect_response=False)
+        self.assertEqual(self.client.session['_auth_user_backend'], 'share.auth.CachedModelBackend')
+        self.assertTrue(User.objects.get(pk=user.pk).is_active)
+
+
+class ImportRosterTests(TestCase):
+    def import_roster(self, text):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'roster.csv')
+            with open(path, 'w', newline='') as fh:
+                fh.write(text)
+            call_command('import_roster', path, '--workers=1', '--domain=testserver', stdout=StringIO(), stderr=StringIO())
+
+    def test_emails_a_set_password_link_instead_of_a_password(self):
+        self.import_roster('username,email,first_name,last_name\nS100,s100@example.com,Ama,Owusu\n')
+        user = User.objects.get(username='s100')
+        self.assertFalse(user.is_active)
+        self.assertFalse(user.has_usable_password())
+
+        email = OutboxEmail.objects.get()
+        self.assertNotIn('password is', email.body)
+        link = re.search(r'http://testserver(/share/set-password/\S+)', email.body).group(1)
+
+        # The token moves into the session and the browser lands on a token-free URL.
+        form_url = self.client.get(link).url
+        new_password = 'a much better passphrase'
+        response = self.client.post(form_url, {'new_password1': new_password, 'new_password2': new_password})
+        self.assertRedirects(response, '/share/dashboard/', fetch_redirect_response=False)
+        user.refresh_from_db()
+        self.assertTrue(user.is_active)
+        self.assertTrue(user.check_password(new_password))
+
+        # One use only.
+        self.client.logout()
+        self.assertFalse(self.client.get(link).context['validlink'])
+
+    def test_given_passwords_are_hashed_and_not_emailed(self):
+        self.import_roster('username,email,first_name,last_name,password\nS101,s101@example.com,Kofi,Mensah,tr0ub4dor&3xyz\n')
+        user = User.objects.get(username='s101')
+        self.assertTrue(user.check_password('tr0ub4dor&3xyz'))
+        body = OutboxEmail.objects.get().body
+        self.assertNotIn('tr0ub4dor', body)
+        self.assertIn('/share/verify/', body)
+
+
+class BlobTests(MediaRootMixin, TestCase):
+    def test_same_bytes_share_one_blob(self):
+        first = blobs.store_upload(self.user, ContentFile(b'same bytes', name='a.txt'))
+        second = blobs.store_upload(self.user, ContentFile(b'same bytes', name='b.txt'))
+        self.assertEqual(first.blob_id, second.blob_id)
+        blob = StoredBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertTrue(blob_storage.exists(blob.file.name))
+        self.assertEqual(os.listdir(blob_storage.path(blobs.STAGING_PREFIX)), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(StoredBlob.objects.get().ref_count, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(blob_storage.exists(blob.file.name))
+
+    def test_bytes_are_written_outside_the_transaction(self):
+        depth = len(connection.atomic_blocks)
+        seen = []
+        save = blob_storage.save
+
+        def recording_save(*args, **kwargs):
+            seen.append(len(connection.atomic_blocks))
+            return save(*args, **kwargs)
+
+        with mock.patch.object(blob_storage, 'save', side_effect=recording_save):
+            blobs.store_upload(self.user, ContentFile(b'one', name='one.txt'))
+            bulk.store_many(self.user, [
+                ContentFile(b'two' * 100, name='two.txt'), ContentFile(b'three' * 100, name='three.txt'),
+            ])
+        self.assertEqual(seen, [depth] * 3)
+
+    def test_compressible_blob_is_stored_gzipped(self):
+        text = b'lorem ipsum dolor sit amet ' * 400
+        upload = blobs.store_upload(self.user, ContentFile(text, name='notes.txt'))
+        self.assertTrue(upload.blob.file.name.endswith('.gz'))
+        self.assertLess(upload.blob.stored_size, len(text))
+        with storage.open_original(upload) as fh:
+            self.assertEqual(fh.read(), text)
+
+    def test_release_and_reupload_interleave(self):
+        data = b'uploaded, deleted and uploaded again'
+        first = blobs.store_upload(self.user, ContentFile(data, name='a.txt'))
+        name = first.blob.file.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        self.assertFalse(StoredBlob.objects.exists())
+
+        # The same bytes arrive again before the released file is unlinked.
+        second = blobs.store_upload(self.user, ContentFile(data, name='b.txt'))
+        self.assertEqual(second.blob.file.name, name)
+        depth = len(connection.atomic_blocks)
+        seen = []
+        delete = blob_storage.delete
+
+        def recording_delete(*args, **kwargs):
+            seen.append(len(connection.atomic_blocks))
+            return delete(*args, **kwargs)
+
+        with mock.patch.object(blob_storage, 'delete', side_effect=recording_delete):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(seen, [])
+        with storage.open_original(second) as fh:
+            self.assertEqual(fh.read(), data)
+
+        # Released for good: the row check and the unlink share one write transaction.
+        with self.captureOnCommitCallbacks() as callbacks:
+            second.delete()
+        with mock.patch.object(blob_storage, 'delete', side_effect=recording_delete):
+            for callback in callbacks:
+                callback()
+        self.assertEqual(seen, [depth + 1])
+        self.assertFalse(blob_storage.exists(name))
+
+    def test_lost_race_raises_a_clear_error(self):
+        with mock.patch.object(StoredBlob.objects, 'create', side_effect=IntegrityError):
+            with self.assertRaisesMessage(RuntimeError, 'was created and released'):
+                blobs.store_upload(self.user, ContentFile(b'raced', name='raced.txt'))
+
+
+@override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+class AsgiMiddlewareTests(MediaRootMixin, TestCase):
+    def test_no_middleware_is_adapted(self):
+        # Django logs (at DEBUG) each sync-only middleware it wraps for an async handler.
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+    async def test_share_link_and_async_download_stream(self):
+        upload = await sync_to_async(blobs.store_upload)(self.user, ContentFile(b'async bytes', name='a.txt'))
+        link = await sync_to_async(links.create)(upload, self.user)
+        before = metrics.requests_total._values.get(('share_link', 'GET', '200'), 0)
+
+        response = await self.async_client.get(links.path_for(link))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b'async bytes')
+        self.assertEqual(metrics.requests_total._values[('share_link', 'GET', '200')], before + 1)
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/share/async/files/{upload.pk}/download/')
+        self.assertEqual(response.status_code, 200)
+
+
+class DedupeUploadsTests(MediaRootMixin, TestCase):
+    def legacy_upload(self, name, data):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return UploadedFile.objects.create(user=self.user, file=name)
+
+    def test_flat_legacy_files_move_into_blobs(self):
+        shared = [self.legacy_upload('uploads/report.txt', b'quarterly numbers') for _ in range(2)]
+        other = self.legacy_upload('uploads/notes.txt', b'quarterly numbers')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_uploads', stdout=StringIO(), stderr=StringIO())
+
+        rows = UploadedFile.objects.filter(pk__in=[u.pk for u in [*shared, other]])
+        self.assertEqual({row.blob_id for row in rows}, {StoredBlob.objects.get().pk})
+        self.assertEqual(StoredBlob.objects.get().ref_count, 3)
+        self.assertEqual(sorted(row.name for row in rows), ['notes.txt', 'report.txt', 'report.txt'])
+        # The shared file was only removed once no legacy row needed it.
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'uploads', 'report.txt')))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'uploads', 'notes.txt')))
+        self.assertEqual(os.listdir(blob_storage.path(blobs.STAGING_PREFIX)), [])
+
+    def test_storage_stats_follow_the_real_sizes(self):
+        self.legacy_upload('uploads/a.txt', b'a' * 100)
+        self.legacy_upload('uploads/b.txt', b'b' * 250)
+        self.assertEqual(stats.for_user(self.user).bytes_used, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_uploads', stdout=StringIO(), stderr=StringIO())
+        counters = stats.for_user(self.user)
+        self.assertEqual((counters.file_count, counters.bytes_used), (2, 350))
+
+    def test_batches_commit_separately_and_a_rerun_resumes(self):
+        first = self.legacy_upload('uploads/a.txt', b'alpha')
+        gone = UploadedFile.objects.create(user=self.user, file='uploads/gone.txt')
+        shared = [self.legacy_upload('uploads/c.txt', b'gamma') for _ in range(2)]
+        acquire_many = blobs.acquire_many
+        calls = []
+
+        def crash_on_second_batch(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('interrupted')
+            return acquire_many(*args)
+
+        with mock.patch.object(blobs, 'acquire_many', crash_on_second_batch):
+            with self.assertRaises(RuntimeError), self.captureOnCommitCallbacks(execute=True):
+                call_command('dedupe_uploads', '--batch-size', '2', stdout=StringIO(), stderr=StringIO())
+        # The first batch stayed committed; the failed one left nothing behind.
+        self.assertIsNotNone(UploadedFile.objects.get(pk=first.pk).blob_id)
+        self.assertFalse(UploadedFile.objects.filter(pk__in=[u.pk for u in shared], blob__isnull=False).exists())
+        self.assertEqual(os.listdir(blob_storage.path(blobs.STAGING_PREFIX)), [])
+
+        out, err = StringIO(), StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_uploads', '--batch-size', '2', stdout=out, stderr=err)
+        self.assertIn('Moved 2 upload(s) into blob storage, 1 missing.', out.getvalue())
+        self.assertIn(f'id={gone.pk}', err.getvalue())
+        rows = UploadedFile.objects.filter(pk__in=[u.pk for u in shared])
+        self.assertEqual(len({row.blob_id for row in rows}), 1)
+        self.assertEqual(rows[0].blob.ref_count, 2)
+        self.assertEqual(stats.for_user(self.user).bytes_used, 15)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'uploads', 'c.txt')))
+
+
+class ChunkedUploadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        chunk_dir = override_settings(SHARE_CHUNKED_UPLOAD_DIR=os.path.join(self.media_root, 'chunked'))
+        chunk_dir.enable()
+        self.addCleanup(chunk_dir.disable)
+        self.client.force_login(self.user)
+
+    def create(self, filename, length):
+        metadata = f'filename {base64.b64encode(filename.encode()).decode()}'
+        response = self.client.post('/share/uploads/', HTTP_UPLOAD_LENGTH=str(length), HTTP_UPLOAD_METADATA=metadata)
+        self.assertEqual(response.status_code, 201)
+        return UploadSession.objects.get(pk=response.json()['id'])
+
+    def patch(self, session, offset, data):
+        return self.client.patch(
+            f'/share/uploads/{session.pk}/', data,
+            content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_resumable_upload_round_trip(self):
+        session = self.create('notes.txt', 10)
+        self.assertEqual(self.patch(session, 0, b'hello')['Upload-Offset'], '5')
+        self.assertEqual(self.patch(session, 0, b'HELLO').status_code, 409)
+        self.assertEqual(self.patch(session, 5, b'world').status_code, 204)
+        response = self.client.post(f'/share/uploads/{session.pk}/finalize/')
+        self.assertEqual(response.status_code, 201)
+        with storage.open_original(UploadedFile.objects.get(pk=response.json()['id'])) as fh:
+            self.assertEqual(fh.read(), b'helloworld')
+
+    def test_concurrent_patch_is_refused_while_another_writes(self):
+        session = self.create('notes.txt', 10)
+        with open(session.path, 'r+b') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            self.assertEqual(self.patch(session, 0, b'hello').status_code, 423)
+        self.assertEqual(self.patch(session, 0, b'hello').status_code, 204)
+
+    def test_stale_offset_is_rechecked_under_the_lock(self):
+        session = self.create('notes.txt', 10)
+        stale = UploadSession.objects.get(pk=session.pk)
+        chunked.append_chunk(session, BytesIO(b'hello'), 0)
+        with self.assertRaises(chunked.OffsetMismatch):
+            chunked.append_chunk(stale, BytesIO(b'HELLO'), 0)
+        with open(session.path, 'rb') as fh:
+            self.assertEqual(fh.read(), b'hello')
+
+    def test_purge_keeps_sessions_that_are_still_receiving_chunks(self):
+        active, idle = self.create('notes.txt', 10), self.create('idle.txt', 10)
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        UploadSession.objects.update(created_at=an_hour_ago, updated_at=an_hour_ago)
+        self.assertEqual(self.patch(active, 0, b'hello').status_code, 204)
+
+        call_command('purge_upload_sessions', '--max-age', '60', stdout=StringIO())
+        self.assertEqual(list(UploadSession.objects.values_list('pk', flat=True)), [active.pk])
+        self.assertTrue(os.path.exists(active.path))
+        self.assertFalse(os.path.exists(idle.path))
+
+    def test_empty_file_is_type_checked(self):
+        session = self.create('evil.pdf', 0)
+        response = self.client.post(f'/share/uploads/{session.pk}/finalize/')
+        self.assertEqual(response.status_code, 415)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(UploadedFile.objects.exists())
+
+        session = self.create('empty.txt', 0)
+        response = self.client.post(f'/share/uploads/{session.pk}/finalize/')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(UploadedFile.objects.get().content_type, 'text/plain')
+
+
+class RangeHeaderTests(TestCase):
+    def test_parse_range_header(self):
+        cases = [
+            ('bytes=0-4', [(0, 4)]),
+            ('bytes=5-', [(5, 9)]),
+            ('bytes=-3', [(7, 9)]),
+            ('bytes=-30', [(0, 9)]),
+            ('bytes=0-100', [(0, 9)]),
+            ('bytes=0-1, 4-5', [(0, 1), (4, 5)]),
+            ('bytes=20-30', []),
+            ('bytes=-0', []),
+            ('bytes=5-2', None),
+            ('bytes=abc', None),
+            ('bytes=-', None),
+            ('items=0-1', None),
+        ]
+        for header, expected in cases:
+            with self.subTest(header=header):
+                self.assertEqual(downloads.parse_range_header(header, 10), expected)
+        self.assertIsNone(downloads.parse_range_header('bytes=0-0', 0))
+        too_many = 'bytes=' + ','.join(f'{i}-{i}' for i in range(downloads.MAX_RANGES + 1))
+        self.assertIsNone(downloads.parse_range_header(too_many, 100))
+
+
+@override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+class DownloadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.upload = blobs.store_upload(self.user, ContentFile(b'0123456789', name='digits.txt'), content_type='text/plain')
+        self.url = f'/share/files/{self.upload.pk}/download/'
+        self.client.force_login(self.user)
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_responses(self):
+        response = self.client.get(self.url)
+        self.assertEqual((response.status_code, self.body(response)), (200, b'0123456789'))
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual((response.status_code, self.body(response)), (206, b'234'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,8-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        self.assertEqual(len(self.body(response)), int(response['Content-Length']))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=50-60')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # A stale If-Range gets the whole file instead of the range.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_only_new_transfers_are_logged(self):
+        etag = self.client.head(self.url)['ETag']
+        self.assertEqual(DownloadLog.objects.count(), 0)
+        self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.client.get(self.url, HTTP_RANGE='bytes=5-')
+        self.assertEqual(DownloadLog.objects.count(), 0)
+        self.client.get(self.url, HTTP_RANGE='bytes=0-4')
+        self.client.get(self.url)
+        self.assertEqual(DownloadLog.objects.count(), 2)
+
+    @override_settings(SHARE_SENDFILE='x-accel-redirect', SHARE_SENDFILE_URL_PREFIX='/protected/')
+    def test_offloaded_downloads(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.upload.file.name}')
+        self.assertEqual(DownloadLog.objects.count(), 1)
+        # nginx may still answer these with a 304 or 206, so they are not logged.
+        self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Mon, 01 Jan 2001 00:00:00 GMT')
+        self.client.get(self.url, HTTP_RANGE='bytes=5-')
+        self.client.head(self.url)
+        self.assertEqual(DownloadLog.objects.count(), 1)
+
+        odd = SimpleNamespace(file=SimpleNamespace(name='uploads/50% off?#1.txt'))
+        header = downloads._offload_response(odd)['X-Accel-Redirect']
+        self.assertEqual(header, '/protected/uploads/50%25%20off%3F%231.txt')
+
+
+class PaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'correct horse battery')
+        # Repeated names and sizes make the id tiebreaker do real work.
+        for i in range(7):
+            UploadedFile.objects.create(user=self.user, file=f'uploads/{i}.txt', name=f'file{i % 3}.txt', size=i % 2)
+        self.queryset = UploadedFile.objects.filter(user=self.user)
+
+    def walk(self, sort, limit=3):
+        pages, after = [], None
+        while True:
+            items, next_cursor, _ = pagination.paginate(self.queryset, sort=sort, after=after, limit=limit)
+            pages.append([f.pk for f in items])
+            if not next_cursor:
+                return pages
+            after = next_cursor
+
+    def test_round_trip(self):
+        for sort, (field, descending) in pagination.SORTS.items():
+            with self.subTest(sort=sort):
+                ordering = [f'-{f}' if descending else f for f in (field, 'id')]
+                expected = list(self.queryset.order_by(*ordering).values_list('pk', flat=True))
+                pages = self.walk(sort)
+                self.assertEqual([pk for page in pages for pk in page], expected)
+
+                # Stepping back from the last page lands on the one before it.
+                first_of_last = self.queryset.get(pk=pages[-1][0])
+                items, next_cursor, previous_cursor = pagination.paginate(
+                    self.queryset, sort=sort, before=pagination._encode(sort, first_of_last), limit=3
+                )
+                self.assertEqual([f.pk for f in items], pages[-2])
+                self.assertIsNotNone(next_cursor)
+                self.assertIsNotNone(previous_cursor)
+
+    def test_rejects_tampered_cursors(self):
+        _, cursor, _ = pagination.paginate(self.queryset, sort='name', limit=3)
+        forged = signing.dumps({'s': 'name', 'v': 'file0.txt', 'id': 1}, salt='other', compress=True)
+        for bad in (cursor[:-2] + ('AA' if not cursor.endswith('AA') else 'BB'), forged, 'garbage'):
+            with self.subTest(cursor=bad), self.assertRaises(pagination.InvalidCursor):
+                pagination.paginate(self.queryset, sort='name', after=bad)
+        with self.assertRaises(pagination.InvalidCursor):
+            pagination.paginate(self.queryset, sort='-size', after=cursor)
+
+        self.client.force_login(self.user)
+        response = self.client.get('/share/api/files/', {'sort': 'name', 'after': forged})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/share/files/', {'sort': 'name', 'before': forged})
+        self.assertRedirects(response, '/share/files/', fetch_redirect_response=False)
+
+
+class DownloadLogBufferTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = [UploadedFile.objects.create(user=self.user, file=f'uploads/{i}.txt') for i in range(3)]
+        self.buffer = logbuffer.DownloadLogBuffer()
+        # Flushes are driven by the test rather than the background thread.
+        patcher = mock.patch.object(self.buffer, '_ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+    def test_sync_mode_writes_immediately(self):
+        self.buffer.record(self.user.id, self.files[0].id)
+        self.assertEqual(DownloadLog.objects.count(), 1)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.buffer._ensure_started.assert_not_called()
+
+    @override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'off'})
+    def test_off_mode_writes_nothing(self):
+        self.buffer.record(self.user.id, self.files[0].id)
+        self.assertEqual((DownloadLog.objects.count(), self.buffer.flush()), (0, 0))
+
+    @override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'buffered', 'BATCH_SIZE': 2})
+    def test_flush_writes_pending_entries(self):
+        self.buffer.record(self.user.id, self.files[0].id)
+        self.assertFalse(self.buffer._wake.is_set())
+        self.buffer.record(self.user.id, self.files[1].id)
+        self.assertTrue(self.buffer._wake.is_set())
+        self.buffer.record(self.user.id, self.files[2].id)
+        self.assertEqual(DownloadLog.objects.count(), 0)
+
+        # An entry for a file deleted before the flush is dropped, not the whole batch.
+        self.files[2].delete()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(
+            set(DownloadLog.objects.values_list('file_id', flat=True)), {self.files[0].id, self.files[1].id}
+        )
+        self.assertEqual(self.buffer.flush(), 0)
+
+    @override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'buffered', 'MAX_PENDING': 2, 'OVERFLOW': 'drop'})
+    def test_drops_when_full(self):
+        with self.assertLogs('share.logbuffer', 'WARNING'):
+            for upload in self.files:
+                self.buffer.record(self.user.id, upload.id)
+        self.assertEqual(self.buffer.dropped, 1)
+        self.assertEqual(self.buffer.flush(), 2)
+
+    @override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+    def test_download_view_records_in_sync_mode(self):
+        upload = UploadedFile.objects.create(user=self.user, file=ContentFile(b'hello', name='hello.txt'), size=5)
+        self.client.force_login(self.user)
+        response = self.client.get(f'/share/files/{upload.pk}/download/')
+        self.assertEqual(b''.join(response.streaming_content), b'hello')
+        self.assertTrue(DownloadLog.objects.filter(user=self.user, file=upload).exists())
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class OutboxTests(TestCase):
+    def test_enqueue_and_deliver(self):
+        outbox.enqueue('Hello', 'Body', ['a@example.com'])
+        outbox.enqueue_many([('Bulk', 'Body', ['b@example.com']), ('Bulk', 'Body', ['c@example.com'])])
+        with transaction.atomic():
+            outbox.enqueue('Rolled back', 'Body', ['d@example.com'])
+            transaction.set_rollback(True)
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.PENDING).count(), 3)
+        self.assertEqual(mail.outbox, [])
+
+        out = StringIO()
+        call_command('send_outbox', '--batch-size', '2', stdout=out)
+        self.assertIn('Sent 3 email(s); 0 failed', out.getvalue())
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['a@example.com', 'b@example.com', 'c@example.com'])
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.SENT, sent_at__isnull=False).count(), 3)
+
+        # Sent messages are not picked up again.
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_failures_back_off_then_give_up(self):
+        email = outbox.enqueue('Hello', 'Body', ['a@example.com'])
+        connection = mail.get_connection()
+        with mock.patch.object(connection, 'send_messages', side_effect=OSError('refused')), \
+                self.assertLogs('share.outbox', 'WARNING'):
+            self.assertEqual(outbox.deliver_batch(connection), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts, email.last_error), (OutboxEmail.PENDING, 1, 'refused'))
+            # Not due again until the backoff has passed.
+            self.assertEqual(outbox.deliver_batch(connection), (0, 0))
+
+            OutboxEmail.objects.filter(pk=email.pk).update(next_attempt_at=email.created_at)
+            self.assertEqual(outbox.deliver_batch(connection, max_attempts=2), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, 2))
+        self.assertEqual(mail.outbox, [])
+
+
+@override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+class ShareLinkTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.upload = blobs.store_upload(self.user, ContentFile(b'shared bytes', name='notes.txt'), content_type='text/plain')
+        self.owner = Client()
+        self.owner.force_login(self.user)
+
+    def create(self, **data):
+        self.owner.post(f'/share/files/{self.upload.pk}/links/', data)
+        return self.upload.share_links.latest('id')
+
+    def test_serves_without_login(self):
+        link = self.create()
+        response = self.client.get(links.path_for(link))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'shared bytes')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+        self.assertEqual((response['Cache-Control'], response['Referrer-Policy']), ('private, no-cache', 'no-referrer'))
+        self.assertEqual(self.client.head(links.path_for(link)).status_code, 200)
+        self.assertEqual(self.client.post(links.path_for(link)).status_code, 405)
+
+    def test_scope(self):
+        link = self.create(inline='1')
+        self.assertEqual(link.permissions, 'download,inline')
+        response = self.client.get(links.path_for(link))
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+
+        # Requested lifetimes are capped at MAX_AGE.
+        with override_settings(SHARE_LINKS={'MAX_AGE': 3600}):
+            link = self.create(days='90')
+        self.assertLessEqual(link.expires_at, timezone.now() + timedelta(hours=1))
+        with self.assertRaises(ValueError):
+            links.create(self.upload, self.user, permissions=('upload',))
+
+    def test_expired_and_forged_tokens(self):
+        link = self.create()
+        link.expires_at = (timezone.now() - timedelta(seconds=1)).replace(microsecond=0)
+        self.assertEqual(self.client.get(links.path_for(link)).status_code, 410)
+
+        token = links.token_for(self.create())
+        other = blobs.store_upload(self.user, ContentFile(b'private', name='other.txt'))
+        payload = links._signer().unsign_object(token)
+        forged = signing.Signer(salt='elsewhere').sign_object({**payload, 'f': other.pk}, compress=True)
+        for bad in (forged, token[:-1], 'nonsense'):
+            with self.subTest(token=bad):
+                self.assertEqual(self.client.get(links.URL_PREFIX + bad).status_code, 404)
+
+        self.upload.delete()
+        self.assertEqual(self.client.get(links.URL_PREFIX + token).status_code, 410)
+
+    def test_revocation(self):
+        link = self.create()
+        path = links.path_for(link)
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+        stranger = User.objects.create_user('mallory', 'mallory@example.com', 'correct horse battery')
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.post(f'/share/links/{link.pk}/revoke/').status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.owner.post(f'/share/links/{link.pk}/revoke/')
+        self.assertEqual(self.client.get(path).status_code, 410)
+        # Other links to the same file keep working.
+        self.assertEqual(self.client.get(links.path_for(self.create())).status_code, 200)
+
+
+class MetricsTests(TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test "histogram".', ['view'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, ('home',))
+        counter = metrics.Counter('test_total', 'Test counter.', ['view'])
+        counter.inc(('a\\b\n"c"',), 2)
+        with mock.patch.object(metrics, 'REGISTRY', [histogram, counter]):
+            text = metrics.render()
+        self.assertEqual(text, '\n'.join([
+            '# HELP securecampus_test_seconds Test "histogram".',
+            '# TYPE securecampus_test_seconds histogram',
+            'securecampus_test_seconds_bucket{view="home",le="0.1"} 2',
+            'securecampus_test_seconds_bucket{view="home",le="1.0"} 3',
+            'securecampus_test_seconds_bucket{view="home",le="+Inf"} 4',
+            'securecampus_test_seconds_sum{view="home"} 3.65',
+            'securecampus_test_seconds_count{view="home"} 4',
+            '# HELP securecampus_test_total Test counter.',
+            '# TYPE securecampus_test_total counter',
+            'securecampus_test_total{view="a\\\\b\\n\\"c\\""} 2',
+        ]) + '\n')
+
+    def test_requests_are_recorded(self):
+        before = metrics.requests_total._values.get(('share:login', 'GET', '200'), 0)
+        self.client.get('/share/login/')
+        self.assertEqual(metrics.requests_total._values[('share:login', 'GET', '200')], before + 1)
+        self.assertIn('securecampus_http_requests_total{view="share:login",method="GET",status="200"}', metrics.render())
+
+    @override_settings(SHARE_METRICS={'TOKEN': 's3cret'})
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.9').status_code, 403)
+        self.assertEqual(
+            self.client.get('/metrics', REMOTE_ADDR='203.0.113.9', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200
+        )
+        self.assertEqual(
+            self.client.get('/metrics', REMOTE_ADDR='203.0.113.9', HTTP_AUTHORIZATION='Bearer guess').status_code, 403
+        )
+
+        # Behind a local proxy every request comes from 127.0.0.1.
+        proxied = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': '203.0.113.9'}
+        self.assertEqual(self.client.get('/metrics', **proxied).status_code, 403)
+        with override_settings(SHARE_THROTTLE={**settings.SHARE_THROTTLE, 'TRUSTED_PROXIES': ['127.0.0.1']}):
+            self.assertEqual(self.client.get('/metrics', **proxied).status_code, 403)
+            local = {'REMOTE_ADDR': '127.0.0.1', 'HTTP_X_FORWARDED_FOR': '::1'}
+            self.assertEqual(self.client.get('/metrics', **local).status_code, 200)
+
+        staff = User.objects.create_user('staff', 'staff@example.com', 'correct horse battery', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/metrics', **proxied).status_code, 200)
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+
+def make_zip(parts):
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in parts.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+DOCX = make_zip({'[Content_Types].xml': '<Types/>', 'word/document.xml': '<w:document/>'})
+
+
+class SniffTests(MediaRootMixin, TestCase):
+    def test_check(self):
+        self.assertEqual(sniff.check(PNG, 'photo.PNG'), 'image/png')
+        self.assertEqual(sniff.check(b'%PDF-1.7\n', 'paper.pdf'), 'application/pdf')
+        self.assertEqual(sniff.check(DOCX, 'essay.docx'), sniff.EXPECTED['.docx'][1])
+        self.assertEqual(sniff.check('naïve café'.encode(), 'notes.txt'), 'text/plain')
+
+        rejected = [
+            (PNG, 'paper.pdf'),
+            (make_zip({'notes.txt': 'hello'}), 'essay.docx'),
+            # The right container, but an Excel package renamed to .docx.
+            (make_zip({'[Content_Types].xml': '<Types/>', 'xl/workbook.xml': '<workbook/>'}), 'essay.docx'),
+            (b'MZ\x90\x00' + b'\x00' * 60, 'notes.txt'),
+            (b'#!/bin/sh\n', 'script.sh'),
+            (b'%PDF-1.7\n', 'noextension'),
+        ]
+        for head, name in rejected:
+            with self.subTest(name=name), self.assertRaises(ValidationError):
+                sniff.check(head, name)
+
+    def test_upload_stores_the_detected_type(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        upload = SimpleUploadedFile('photo.png', PNG, content_type='application/octet-stream')
+        self.assertRedirects(self.client.post('/share/upload/', {'file': upload}), '/share/files/', fetch_redirect_response=False)
+        self.assertEqual(UploadedFile.objects.get().content_type, 'image/png')
+
+        rejected = [
+            ('photo.pdf', PNG, 'do not match the .pdf extension'),
+            ('essay.docx', make_zip({'a.txt': 'x'}), 'not an Office document'),
+            ('run.exe', b'MZ', 'Invalid file extension.'),
+        ]
+        for name, data, error in rejected:
+            with self.subTest(name=name):
+                upload = SimpleUploadedFile(name, data, content_type='application/pdf')
+                response = self.client.post('/share/upload/', {'file': upload})
+                self.assertIn(error, [str(m) for m in response.context['messages']][-1])
+        self.assertEqual(UploadedFile.objects.count(), 1)
+
+        # Served with the stored type rather than one guessed from the name.
+        response = self.client.get(f'/share/files/{UploadedFile.objects.get().pk}/download/')
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+
+@override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+class ZipDownloadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_archive_round_trip(self):
+        text = b'lorem ipsum dolor sit amet ' * 400
+        files = [
+            blobs.store_upload(self.user, ContentFile(text, name='notes.txt'), content_type='text/plain'),
+            blobs.store_upload(self.user, ContentFile(b'second', name='notes.txt'), content_type='text/plain'),
+            blobs.store_upload(self.user, ContentFile(PNG, name='photo.png'), content_type='image/png'),
+        ]
+        self.assertEqual(files[0].blob.encoding, storage.GZIP)
+
+        response = self.client.get('/share/files/zip/', {'ids': [f.pk for f in files]})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['notes.txt', 'notes (2).txt', 'photo.png'])
+            # Gzipped blobs go into the archive as their original bytes.
+            self.assertEqual(archive.read('notes.txt'), text)
+            self.assertEqual(archive.read('notes (2).txt'), b'second')
+            self.assertEqual(archive.read('photo.png'), PNG)
+            self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(archive.getinfo('photo.png').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(DownloadLog.objects.count(), 3)
+
+    def test_other_users_files_are_refused(self):
+        mine = blobs.store_upload(self.user, ContentFile(b'mine', name='mine.txt'))
+        bob = User.objects.create_user('bob', 'bob@example.com', 'correct horse battery')
+        theirs = blobs.store_upload(bob, ContentFile(b'theirs', name='theirs.txt'))
+
+        response = self.client.get('/share/files/zip/', {'ids': [mine.pk, theirs.pk]})
+        self.assertRedirects(response, '/share/files/', fetch_redirect_response=False)
+        response = self.client.get('/share/files/zip/', {'ids': [mine.pk, 999999]})
+        self.assertRedirects(response, '/share/files/', fetch_redirect_response=False)
+        self.assertFalse(DownloadLog.objects.exists())
+
+        bob.is_staff = True
+        bob.save()
+        self.client.force_login(bob)
+        response = self.client.get('/share/files/zip/', {'ids': [mine.pk, theirs.pk]})
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), ['mine.txt', 'theirs.txt'])
+
+
+class StorageStatsTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def usage(self, user=None):
+        counters = stats.for_user(user or self.user)
+        return counters.file_count, counters.bytes_used
+
+    @override_settings(SHARE_USER_QUOTA_BYTES=20)
+    def test_quota_is_enforced_at_upload(self):
+        self.client.post('/share/upload/', {'file': SimpleUploadedFile('a.txt', b'x' * 15)})
+        self.assertEqual(self.usage(), (1, 15))
+
+        response = self.client.post('/share/upload/', {'file': SimpleUploadedFile('b.txt', b'y' * 10)})
+        self.assertRedirects(response, '/share/upload/', fetch_redirect_response=False)
+        self.assertEqual(self.usage(), (1, 15))
+
+        response = self.client.post('/share/uploads/', HTTP_UPLOAD_LENGTH='10', HTTP_UPLOAD_METADATA='filename Yi50eHQ=')
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(UploadSession.objects.exists())
+
+        self.client.post('/share/upload/', {'file': SimpleUploadedFile('c.txt', b'z' * 5)})
+        self.assertEqual(self.usage(), (2, 20))
+
+    def test_counters_follow_deletes(self):
+        first = blobs.store_upload(self.user, ContentFile(b'x' * 10, name='a.txt'))
+        blobs.store_upload(self.user, ContentFile(b'y' * 7, name='b.txt'))
+        self.assertEqual(self.usage(), (2, 17))
+        self.client.post(f'/share/files/{first.pk}/delete/')
+        self.assertEqual(self.usage(), (1, 7))
+
+        # Deleting the user cascades through its files without recreating its counters.
+        self.user.delete()
+        self.assertFalse(StorageStats.objects.exists())
+
+    def test_reconcile_repairs_drift(self):
+        blobs.store_upload(self.user, ContentFile(b'x' * 10, name='a.txt'))
+        bob = User.objects.create_user('bob', 'bob@example.com', 'correct horse battery')
+        StorageStats.objects.filter(user=self.user).update(file_count=5, bytes_used=999)
+        StorageStats.objects.create(user=bob, file_count=2, bytes_used=40)
+        version = page_cache.version(self.user.id)
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reconcile_storage_stats', stdout=out)
+        self.assertIn('Reconciled 1 user(s): 1 corrected, 1 emptied.', out.getvalue())
+        self.assertEqual(self.usage(), (1, 10))
+        self.assertFalse(StorageStats.objects.filter(user=bob).exists())
+        self.assertNotEqual(page_cache.version(self.user.id), version)
+
+
+@override_settings(SHARE_GC_EXTRA_ROOTS=[])
+class GcUploadsTests(MediaRootMixin, TestCase):
+    def write(self, name, data=b'data', age=7200, base=None):
+        path = os.path.join(base or self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+        return path
+
+    def test_only_old_unreferenced_files_are_deleted(self):
+        upload = blobs.store_upload(self.user, ContentFile(b'kept', name='kept.txt'))
+        shared = self.write(upload.blob.file.name, b'kept')
+        blob_only = self.write('blobs/aa/bb/blob-only')
+        StoredBlob.objects.create(digest='f' * 64, file='blobs/aa/bb/blob-only', size=4, ref_count=0)
+        legacy = self.write('uploads/alice/legacy.txt')
+        UploadedFile.objects.create(user=self.user, file='uploads/alice/legacy.txt', size=4)
+        old_orphan = self.write('uploads/alice/orphan.txt')
+        new_orphan = self.write('blobs/staging/in-flight', age=10)
+
+        out = StringIO()
+        call_command('gc_uploads', '--dry-run', '--grace', '3600', stdout=out)
+        self.assertIn('Scanned 5 file(s): 3 referenced, 1 inside the grace period, 1 orphaned', out.getvalue())
+        self.assertIn('Dry run: nothing was deleted.', out.getvalue())
+        self.assertTrue(os.path.exists(old_orphan))
+
+        out = StringIO()
+        call_command('gc_uploads', '--grace', '3600', '--batch-size', '2', stdout=out)
+        self.assertIn('Deleted 1 orphaned file(s).', out.getvalue())
+        self.assertFalse(os.path.exists(old_orphan))
+        for path in (shared, blob_only, legacy, new_orphan):
+            self.assertTrue(os.path.exists(path), path)
+
+    def test_extra_roots_resolve_names_from_their_parent(self):
+        parent = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, parent, ignore_errors=True)
+        referenced = self.write('uploads/old.txt', base=parent)
+        UploadedFile.objects.create(user=self.user, file='uploads/old.txt', size=4)
+        orphan = self.write('uploads/gone.txt', base=parent)
+
+        out = StringIO()
+        call_command('gc_uploads', '--grace', '3600', '--root', os.path.join(parent, 'uploads'), stdout=out)
+        self.assertIn('Deleted 1 orphaned file(s).', out.getvalue())
+        self.assertTrue(os.path.exists(referenced))
+        self.assertFalse(os.path.exists(orphan))
+
+
+class SearchTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.bob = User.objects.create_user('bob', 'bob@example.com', 'correct horse battery')
+
+    def names(self, user, query):
+        return sorted((f.user.username, f.display_name) for f in search.search(user, query)[0])
+
+    def test_text_is_extracted_by_the_worker(self):
+        docx = make_zip({
+            '[Content_Types].xml': '<Types/>',
+            'word/document.xml': (
+                f'<w:document xmlns:w="{search.DOCX_NS[1:-1]}"><w:body>'
+                '<w:p><w:r><w:t>Quarterly budget</w:t></w:r></w:p></w:body></w:document>'
+            ),
+        })
+        with mock.patch.object(search, 'extract_text', wraps=search.extract_text) as extract:
+            blobs.store_upload(self.user, ContentFile(docx, name='plan.docx'))
+            blobs.store_upload(self.user, ContentFile(PNG, name='photo.png'))
+            extract.assert_not_called()
+        # Searchable by name straight away; only the document waits for its text.
+        self.assertEqual(self.names(self.user, 'plan'), [('alice', 'plan.docx')])
+        self.assertEqual(self.names(self.user, 'quarterly'), [])
+        self.assertEqual(SearchIndexJob.objects.count(), 1)
+
+        out = StringIO()
+        call_command('index_documents', stdout=out)
+        self.assertIn('Indexed the text of 1 file(s).', out.getvalue())
+        self.assertEqual(self.names(self.user, 'quarterly budg'), [('alice', 'plan.docx')])
+        self.assertFalse(SearchIndexJob.objects.exists())
+
+    def test_users_only_find_their_own_files(self):
+        blobs.store_upload(self.user, ContentFile(b'shared secret notes', name='alice.txt'))
+        blobs.store_upload(self.bob, ContentFile(b'secret plans', name='bob.txt'))
+        search.index_pending()
+
+        self.assertEqual(self.names(self.user, 'secret'), [('alice', 'alice.txt')])
+        self.assertEqual(self.names(self.bob, 'secret'), [('bob', 'bob.txt')])
+        self.assertEqual(self.names(self.bob, 'shared'), [])
+        self.client.force_login(self.bob)
+        response = self.client.get('/share/api/search/', {'q': 'alice'})
+        self.assertEqual(response.json()['results'], [])
+
+        self.bob.is_staff = True
+        self.assertEqual(self.names(self.bob, 'secret'), [('alice', 'alice.txt'), ('bob', 'bob.txt')])
+
+    def test_index_follows_delete(self):
+        upload = blobs.store_upload(self.user, ContentFile(b'ephemeral words', name='gone.txt'))
+        document = search.document
+
+        def delete_while_extracting(job):
+            row = document(job)
+            upload.delete()
+            return row
+
+        # Deleted while the worker was reading it: the row must not come back.
+        with mock.patch.object(search, 'document', side_effect=delete_while_extracting):
+            self.assertEqual(search.index_pending(), 1)
+        self.assertEqual(self.names(self.user, 'ephemeral'), [])
+        self.assertEqual(self.names(self.user, 'gone'), [])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {search.TABLE}')
+            self.assertEqual(cursor.fetchone(), (0,))
+
+        kept = blobs.store_upload(self.user, ContentFile(b'durable words', name='kept.txt'))
+        search.index_pending()
+        self.assertEqual(self.names(self.user, 'durable'), [('alice', 'kept.txt')])
+        kept.delete()
+        self.assertEqual(self.names(self.user, 'durable'), [])
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(name, f'{name}@example.com', 'pw') for name in ('alice', 'bob')]
+        self.files = [
+            UploadedFile.objects.create(user=self.users[i % 2], file=f'uploads/{i}.txt') for i in range(3)
+        ]
+        self.start = timezone.now() - timedelta(days=3)
+
+    def log(self, count, offset=0):
+        DownloadLog.objects.bulk_create([
+            DownloadLog(
+                user=self.users[i % 2], file=self.files[i % 3],
+                timestamp=self.start + timedelta(hours=7 * (i + offset)),
+            )
+            for i in range(count)
+        ])
+
+    def assertMatchesLog(self):
+        logs = DownloadLog.objects.annotate(day=TruncDate('timestamp')).order_by()
+        per_file = {(r['day'], r['file']): r['n'] for r in logs.values('day', 'file').annotate(n=Count('id'))}
+        per_user = {(r['day'], r['user']): r['n'] for r in logs.values('day', 'user').annotate(n=Count('id'))}
+        self.assertEqual(
+            {(r.date, r.file_id): r.downloads for r in DailyFileDownloads.objects.all()}, per_file
+        )
+        self.assertEqual(
+            {(r.date, r.user_id): r.downloads for r in DailyUserDownloads.objects.all()}, per_user
+        )
+        owners = {f.pk: f.user_id for f in self.files}
+        for file_id, owner_id in DailyFileDownloads.objects.values_list('file_id', 'owner_id'):
+            self.assertEqual(owner_id, owners[file_id])
+
+    def rollup(self):
+        out = StringIO()
+        call_command('rollup_downloads', '--batch-size', '4', stdout=out)
+        return out.getvalue()
+
+    def test_rollups_match_a_direct_count(self):
+        self.log(10)
+        self.assertIn('Aggregated 10 new', self.rollup())
+        self.assertMatchesLog()
+
+        # Running again counts nothing twice.
+        self.assertIn('Aggregated 0 new', self.rollup())
+        self.assertMatchesLog()
+
+        # New rows, with a gap in the ids wider than a batch, are picked up from the watermark.
+        self.log(6, offset=10)
+        DownloadLog.objects.filter(pk__in=list(DownloadLog.objects.order_by('-pk').values_list('pk', flat=True)[:5])).delete()
+        self.log(3, offset=20)
+        self.assertIn('Aggregated 4 new', self.rollup())
+        self.assertMatchesLog()
+        self.assertIsNone(rollups.advance())
+
+
+class PageCacheTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def listed(self):
+        return [(f['name'], f['size']) for f in self.client.get('/share/api/files/').json()['results']]
+
+    def dashboard_count(self):
+        return self.client.get('/share/dashboard/').context['file_count']
+
+    def test_changes_invalidate_cached_pages(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = blobs.store_upload(self.user, ContentFile(b'one', name='one.txt'))
+        self.assertEqual(self.listed(), [('one.txt', 3)])
+        self.assertEqual(self.dashboard_count(), 1)
+
+        # Writes that skip the signals are not seen until something bumps the version...
+        UploadedFile.objects.filter(pk=first.pk).update(name='renamed.txt')
+        self.assertEqual(self.listed(), [('one.txt', 3)])
+        # ...which every signalled save and delete does once it commits.
+        with self.captureOnCommitCallbacks(execute=True):
+            second = blobs.store_upload(self.user, ContentFile(b'second', name='two.txt'))
+        self.assertEqual(self.listed(), [('two.txt', 6), ('renamed.txt', 3)])
+        self.assertEqual(self.dashboard_count(), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.listed(), [('renamed.txt', 3)])
+        self.assertEqual(self.dashboard_count(), 1)
+
+    def test_maintenance_commands_invalidate_cached_pages(self):
+        path = os.path.join(self.media_root, 'uploads', 'legacy.txt')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fh:
+            fh.write(b'legacy bytes')
+        with self.captureOnCommitCallbacks(execute=True):
+            UploadedFile.objects.create(user=self.user, file='uploads/legacy.txt')
+        self.assertEqual(self.listed(), [('legacy.txt', 0)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_uploads', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(self.listed(), [('legacy.txt', 12)])
+
+        self.assertEqual(self.dashboard_count(), 1)
+        # bulk_create sends no signals, so the counters and the cached dashboard both miss it.
+        UploadedFile.objects.bulk_create([UploadedFile(user=self.user, file='uploads/unsignalled.txt', size=5)])
+        self.assertEqual(self.dashboard_count(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reconcile_storage_stats', stdout=StringIO())
+        self.assertEqual(self.dashboard_count(), 2)
+
+
+@override_settings(SHARE_DOWNLOAD_LOG={'MODE': 'sync'})
+class CompressedDownloadTests(MediaRootMixin, TestCase):
+    text = b'lorem ipsum dolor sit amet ' * 400
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.upload = blobs.store_upload(self.user, ContentFile(self.text, name='notes.txt'), content_type='text/plain')
+        self.assertEqual(self.upload.blob.encoding, storage.GZIP)
+        self.url = f'/share/files/{self.upload.pk}/download/'
+        self.client.force_login(self.user)
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_gzip_clients_get_the_stored_bytes(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='br, gzip;q=0.8')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(int(response['Content-Length']), self.upload.blob.stored_size)
+        body = self.body(response)
+        self.assertEqual(len(body), self.upload.blob.stored_size)
+        self.assertEqual(gzip.decompress(body), self.text)
+        gzip_etag = response['ETag']
+        self.assertEqual(gzip_etag, f'"{self.upload.blob.digest}-gzip"')
+
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        # The compressed representation's validator doesn't match the original one.
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=gzip_etag).status_code, 200)
+
+    def test_other_clients_get_the_original_bytes(self):
+        for accept in ('', 'identity', 'gzip;q=0'):
+            with self.subTest(accept=accept):
+                response = self.client.get(self.url, HTTP_ACCEPT_ENCODING=accept)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertIn('Accept-Encoding', response['Vary'])
+                self.assertEqual(response['ETag'], f'"{self.upload.blob.digest}"')
+                self.assertEqual(int(response['Content-Length']), len(self.text))
+                self.assertEqual(self.body(response), self.text)
+
+    @override_settings(SHARE_SENDFILE='x-accel-redirect')
+    def test_ranges_are_served_from_the_original_bytes(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=6-16')
+        self.assertEqual(response.status_code, 206)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertEqual(response['Content-Range'], f'bytes 6-16/{len(self.text)}')
+        self.assertEqual(self.body(response), b'ipsum dolor')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(self.body(response), self.text[-5:])
+
+
+class PreviewTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        preview_dir = override_settings(SHARE_PREVIEW_DIR=os.path.join(self.media_root, 'previews'))
+        preview_dir.enable()
+        self.addCleanup(preview_dir.disable)
+        self.addCleanup(self.shutdown_pool)
+        self.client.force_login(self.user)
+        self.upload = blobs.store_upload(
+            self.user, ContentFile(b'first line\nsecond line\n', name='notes.txt'), content_type='text/plain',
+        )
+
+    def shutdown_pool(self):
+        if previews._executor is not None:
+            previews._executor.shutdown()
+            previews._executor = None
+
+    def test_detail_page_does_not_render_the_preview(self):
+        with mock.patch.object(previews, 'get') as get:
+            response = self.client.get(f'/share/files/{self.upload.pk}/')
+        get.assert_not_called()
+        self.assertContains(response, f'data-src="/share/files/{self.upload.pk}/preview/"')
+
+    def test_text_preview(self):
+        url = f'/share/files/{self.upload.pk}/preview/'
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(b''.join(response.streaming_content), b'first line\nsecond line')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        with mock.patch.object(previews, 'get', side_effect=previews.PreviewPending):
+            response = self.client.get(url)
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '2'))
+
+        bob = User.objects.create_user('bob', 'bob@example.com', 'correct horse battery')
+        self.client.force_login(bob)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_missing_legacy_file_is_not_found(self):
+        legacy = UploadedFile.objects.create(user=self.user, file='uploads/vanished.txt', content_type='text/plain')
+        self.assertIsNone(previews.cache_key(legacy))
+        self.assertEqual(self.client.get(f'/share/files/{legacy.pk}/preview/').status_code, 404)
+        self.assertEqual(self.client.get(f'/share/files/{legacy.pk}/').status_code, 200)
+
+
+# Not a TestCase: its wrapping transaction would keep every read on default.
+class ReadReplicaTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def test_reads_inside_read_replica_use_the_replica_connection(self):
+        self.assertEqual(UploadedFile.objects.all().db, 'default')
+        with read_replica(), CaptureQueriesContext(connections['replica']) as queries:
+            self.assertEqual(UploadedFile.objects.all().db, 'replica')
+            list(UploadedFile.objects.all())
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(UploadedFile.objects.all().db, 'default')
+
+    def test_reads_inside_a_transaction_stay_on_default(self):
+        with read_replica(), transaction.atomic():
+            self.assertEqual(UploadedFile.objects.all().db, 'default')
+
+    def test_writes_on_the_replica_connection_are_refused(self):
+        with read_replica():
+            # ORM writes still go to default...
+            User.objects.create_user('bob')
+            # ...and the replica connection itself is query_only.
+            with self.assertRaisesMessage(OperationalError, 'readonly'):
+                with connections['replica'].cursor() as cursor:
+                    cursor.execute('DELETE FROM auth_user')
+        self.assertTrue(User.objects.filter(username='bob').exists())
+
+    def test_routing_resets_after_an_exception(self):
+        with self.assertRaises(ValueError), read_replica():
+            raise ValueError
+        self.assertEqual(UploadedFile.objects.all().db, 'default')
+
+        @read_replica
+        def view(request):
+            self.assertEqual(UploadedFile.objects.all().db, 'replica')
+            raise ValueError
+
+        @read_replica
+        async def async_view(request):
+            self.assertEqual(UploadedFile.objects.all().db, 'replica')
+            raise ValueError
+
+        for func in (view, async_to_sync(async_view)):
+            with self.assertRaises(ValueError):
+                func(None)
+            self.assertEqual(UploadedFile.objects.all().db, 'default')
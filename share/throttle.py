@@ -0,0 +1,218 @@
+"""Sliding-window rate limits for login, upload and download.
+
+Every scope (``'login'``, ``'upload'``, ``'download'``, ``'link'``) has its own
+limits: one per client IP, and one per user. For logins, the user limit
+is keyed by the submitted username, which slows guessing against one
+account from many addresses. A request counts once against each of its
+limits, and is allowed while no more than ``limit`` requests fall in the
+last ``period`` seconds. That window is estimated from two fixed windows,
+the current one plus the previous one weighted by how much of it still
+overlaps.
+
+Counters live in the default cache, so every worker process sees the
+same state. Each request is one ``cache.add()`` and one ``cache.incr()``,
+which are atomic on Redis, memcached and the local-memory cache, so
+concurrent requests never wait on each other and never need a lock. With
+the per-process local-memory cache the limits apply per process.
+
+``throttle`` marks a view with its scope. ``ThrottleMiddleware`` checks
+the marked views in ``process_view``, ahead of ``CsrfViewMiddleware``,
+which would otherwise parse the request body to find the CSRF token. So
+a rejected request costs a couple of cache round trips: no password
+hashing, no multipart parsing and no file I/O. It gets a 429 with
+``Retry-After``. Without the middleware, the decorator checks the limits
+itself, after the other middleware has run.
+
+Clients are told apart by ``client_ip()``: ``REMOTE_ADDR``, or, when that
+is one of ``TRUSTED_PROXIES`` (nginx in front of Django), the nearest
+untrusted address in ``X-Forwarded-For``. A campus NAT still puts all
+of its users behind one address, so size the ip rates for that; the user
+limits stay per person.
+
+Configured through ``settings.SHARE_THROTTLE``:
+
+- ``ENABLED``: apply limits at all
+- ``RATES``: ``{scope: {'ip': (limit, period), 'user': (limit, period)}}``,
+  with ``period`` in seconds. Leave one out to not limit by it.
+- ``TRUSTED_PROXIES``: addresses or networks (``'10.0.0.0/8'``) whose
+  ``FORWARDED_FOR_HEADER`` is believed
+- ``FORWARDED_FOR_HEADER``: the ``request.META`` key holding the proxy
+  chain, ``'HTTP_X_FORWARDED_FOR'`` by default
+"""
+import functools
+import hashlib
+import ipaddress
+import math
+import time
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+DEFAULTS = {
+    'ENABLED': True,
+    'RATES': {},
+    'TRUSTED_PROXIES': [],
+    'FORWARDED_FOR_HEADER': 'HTTP_X_FORWARDED_FOR',
+}
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SHARE_THROTTLE', {})}
+
+
+def _key(scope, kind, ident):
+    # Hashed so usernames and IPv6 addresses make valid memcached keys.
+    digest = hashlib.sha256(str(ident).encode()).hexdigest()[:32]
+    return f'share:throttle:{scope}:{kind}:{digest}'
+
+
+def take(key, limit, period, now=None):
+    """Count one request against ``key``; return 0, or the seconds until one would be allowed."""
+    now = time.time() if now is None else now
+    window, elapsed = divmod(now, period)
+    current = f'{key}:{int(window)}'
+    # Kept for two periods: the next window still weighs this one.
+    cache.add(current, 0, math.ceil(2 * period))
+    try:
+        count = cache.incr(current)
+    except ValueError:
+        # Expired between add() and incr().
+        cache.add(current, 0, math.ceil(2 * period))
+        count = cache.incr(current)
+    previous = cache.get(f'{key}:{int(window) - 1}', 0)
+    if previous * (1 - elapsed / period) + count <= limit:
+        return 0
+    # Rejected requests are not counted, so retries don't keep everyone behind a NAT locked out.
+    cache.decr(current)
+    count -= 1
+    if count < limit and previous:
+        # Allowed once enough of the previous window has slid out.
+        return period * (1 - (limit - 1 - count) / previous) - elapsed
+    # Not before the next window, and then once enough of this one has slid out.
+    return period - elapsed + period * (1 - (limit - 1) / count)
+
+
+@functools.lru_cache(maxsize=8)
+def _networks(proxies):
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def _is_trusted(address, networks):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in networks)
+
+
+def client_ip(request, config=None):
+    """Return the address of the client, looking through ``TRUSTED_PROXIES``."""
+    config = config or get_config()
+    remote = request.META.get('REMOTE_ADDR', '')
+    networks = _networks(tuple(config['TRUSTED_PROXIES']))
+    if not networks or not _is_trusted(remote, networks):
+        return remote
+    # Each proxy appends the address it received the request from, so walk back
+    # from the right; anything left of the first untrusted hop is client-supplied.
+    chain = [hop.strip() for hop in request.META.get(config['FORWARDED_FOR_HEADER'], '').split(',') if hop.strip()]
+    for hop in reversed(chain):
+        if not _is_trusted(hop, networks):
+            return hop
+    return chain[0] if chain else remote
+
+
+def _identities(request, scope, config):
+    yield 'ip', client_ip(request, config)
+    # Share links are served before AuthenticationMiddleware, so there may be no request.user.
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        yield 'user', user.pk
+    elif scope == 'login' and request.method == 'POST':
+        if request.content_type != 'application/x-www-form-urlencoded':
+            # Multipart bodies are not parsed here (they may carry files); a browser's
+            # login form never sends one, so they all share a single limit.
+            yield 'user', request.content_type
+            return
+        # Urlencoded bodies are capped by DATA_UPLOAD_MAX_MEMORY_SIZE, so reading POST is cheap.
+        username = request.POST.get('username', '').strip().lower()
+        if username:
+            yield 'user', username
+
+
+def check(request, scope):
+    """Return the seconds ``request`` must wait under ``scope``'s limits, or 0."""
+    config = get_config()
+    if not config['ENABLED']:
+        return 0
+    rates = config['RATES'].get(scope, {})
+    wait = 0
+    for kind, ident in _identities(request, scope, config):
+        if kind in rates:
+            limit, period = rates[kind]
+            wait = max(wait, take(_key(scope, kind, ident), limit, period))
+    return wait
+
+
+def too_many_requests(wait):
+    seconds = max(1, math.ceil(wait))
+    response = HttpResponse(
+        f'Too many requests. Try again in {seconds} seconds.\n', status=429, content_type='text/plain; charset=utf-8',
+    )
+    response['Retry-After'] = seconds
+    return response
+
+
+def _applies(request, methods):
+    return methods is None or request.method in methods
+
+
+def throttle(scope, methods=None):
+    """Mark a view so requests over ``scope``'s limits get a 429.
+
+    With ``methods``, only requests using one of them are counted, e.g.
+    ``('POST',)`` so viewing the login form is never limited. The check
+    happens in ``ThrottleMiddleware`` when it is installed, and in the
+    wrapper otherwise.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if _applies(request, methods) and not getattr(request, '_throttle_checked', False):
+                    wait = await sync_to_async(check)(request, scope)
+                    if wait:
+                        return too_many_requests(wait)
+                return await view(request, *args, **kwargs)
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if _applies(request, methods) and not getattr(request, '_throttle_checked', False):
+                    wait = check(request, scope)
+                    if wait:
+                        return too_many_requests(wait)
+                return view(request, *args, **kwargs)
+        # Copied onto outer decorators (login_required, require_POST) by functools.wraps.
+        wrapper.throttle = (scope, methods)
+        return wrapper
+    return decorator
+
+
+class ThrottleMiddleware(MiddlewareMixin):
+    """Applies ``throttle`` limits before ``CsrfViewMiddleware`` reads the request body.
+
+    Must come before ``CsrfViewMiddleware`` in ``MIDDLEWARE``. ``process_view``
+    runs after every ``__call__``, so ``request.user`` is already available.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        marker = getattr(view_func, 'throttle', None)
+        if marker is None:
+            return None
+        scope, methods = marker
+        if not _applies(request, methods):
+            return None
+        request._throttle_checked = True
+        wait = check(request, scope)
+        return too_many_requests(wait) if wait else None
@@ -0,0 +1,43 @@
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+from .sniff import SNIFF_BYTES
+
+
+class HashingUploadHandlerMixin:
+    """Compute the SHA-256 of each file while its chunks stream in.
+
+    The digest is attached to the resulting file as ``sha256`` so that
+    content-addressed storage does not have to read the file a second time,
+    and the first bytes are kept as ``head`` for content-type sniffing.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.hasher = hashlib.sha256()
+        self.head = b''
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining = super().receive_data_chunk(raw_data, start)
+        if remaining is None:
+            # This handler consumed the chunk, so it owns the digest.
+            self.hasher.update(raw_data)
+            if len(self.head) < SNIFF_BYTES:
+                self.head += raw_data[:SNIFF_BYTES - len(self.head)]
+        return remaining
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.hasher.hexdigest()
+            file.head = self.head
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
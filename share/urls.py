@@ -1,6 +1,7 @@
 from django.urls import path
 from django.contrib.auth import views as auth_views
-from . import views
+from . import async_views, views
+from .throttle import throttle
 
 app_name = 'share'
 
@@ -8,13 +9,29 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('register/', views.register, name='register'),
     path('verify/<uidb64>/<token>/', views.verify_email, name='verify_email'),
-    path('login/', auth_views.LoginView.as_view(template_name='share/login.html'), name='login'),
+    path('set-password/<uidb64>/<token>/', views.SetPasswordView.as_view(), name='set_password'),
+    path('login/', throttle('login', methods=('POST',))(auth_views.LoginView.as_view(template_name='share/login.html')), name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('upload/', views.upload_file, name='upload_file'),
+    path('upload/bulk/', views.upload_files_bulk, name='upload_files_bulk'),
+    path('uploads/', views.upload_session_create, name='upload_session_create'),
+    path('uploads/<uuid:session_id>/', views.upload_session, name='upload_session'),
+    path('uploads/<uuid:session_id>/finalize/', views.upload_session_finalize, name='upload_session_finalize'),
     path('files/', views.file_list, name='file_list'),
+    path('files/zip/', views.download_zip, name='download_zip'),
+    path('api/files/', views.file_list_api, name='file_list_api'),
+    path('search/', views.search_files, name='search_files'),
+    path('api/search/', views.search_api, name='search_api'),
     path('files/<int:file_id>/', views.file_detail, name='file_detail'),
+    path('files/<int:file_id>/preview/', views.file_preview, name='file_preview'),
     path('files/<int:file_id>/delete/', views.delete_file, name='delete_file'),
     path('files/<int:file_id>/download/', views.download_file, name='download_file'),
+    path('files/<int:file_id>/links/', views.create_share_link, name='create_share_link'),
+    path('links/<int:link_id>/revoke/', views.revoke_share_link, name='revoke_share_link'),
+    path('async/upload/', async_views.upload_file, name='upload_file_async'),
+    path('async/files/', async_views.file_list, name='file_list_async'),
+    path('async/files/<int:file_id>/download/', async_views.download_file, name='download_file_async'),
     path('dashboard/', views.user_dashboard, name='dashboard'),
+    path('reports/downloads/', views.download_report, name='download_report'),
     path('email-sent/', views.email_sent, name='email_sent'),
 ]
@@ -1,18 +1,28 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse, reverse_lazy
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth import login, logout
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth import login, logout, views as auth_views
 from django.contrib import messages
 from django.contrib.sites.shortcuts import get_current_site
 from django.template.loader import render_to_string
-from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode, content_disposition_header, quote_etag
+from django.utils.cache import get_conditional_response
 from django.utils.encoding import force_bytes, force_str
 from django.contrib.auth.models import User
 from django.contrib.auth.tokens import default_token_generator
-from django.http import HttpResponse, FileResponse
-from django.core.mail import send_mail
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods, require_POST
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+from config.dbrouter import read_replica
 from .forms import UploadFileForm, RegisterForm
-from .models import UploadedFile
+from .models import ShareLink, UploadedFile, UploadSession
+from .throttle import throttle
+from . import blobs, bulk, cache, chunked, downloads, links, logbuffer, metrics, outbox, pagination, previews, rollups, search, stats, zipstream
 
 # HOME PAGE
 def home(request):
@@ -25,10 +35,11 @@ def register(request):
     if request.method == 'POST':
         form = RegisterForm(request.POST)
         if form.is_valid():
-            user = form.save(commit=False)
-            user.is_active = False
-            user.save()
-            send_verification_email(request, user)
+            with transaction.atomic():
+                user = form.save(commit=False)
+                user.is_active = False
+                user.save()
+                queue_verification_email(request, user)
             messages.success(request, 'Please check your email to complete registration')
             return redirect('share:email_sent')
     else:
@@ -36,16 +47,20 @@ def register(request):
     return render(request, 'share/register.html', {'form': form})
 
 # SEND EMAIL VERIFICATION
-def send_verification_email(request, user):
-    current_site = get_current_site(request)
+def verification_email(domain, user):
     mail_subject = 'Activate your account'
     message = render_to_string('share/email_verification_email.html', {
         'user': user,
-        'domain': current_site.domain,
+        'domain': domain,
         'uid': urlsafe_base64_encode(force_bytes(user.pk)),
         'token': default_token_generator.make_token(user),
     })
-    send_mail(mail_subject, message, settings.DEFAULT_FROM_EMAIL, [user.email])
+    return mail_subject, message
+
+def queue_verification_email(request, user):
+    # Delivered by the send_outbox worker, so registration never waits on SMTP.
+    mail_subject, message = verification_email(get_current_site(request).domain, user)
+    outbox.enqueue(mail_subject, message, [user.email])
 
 # VERIFY EMAIL
 def verify_email(request, uidb64, token):
@@ -58,13 +73,29 @@ def verify_email(request, uidb64, token):
     if user and default_token_generator.check_token(user, token):
         user.is_active = True
         user.save()
-        login(request, user)
+        # No authenticate() call here, so name the backend (several may be configured).
+        login(request, user, backend=settings.AUTHENTICATION_BACKENDS[0])
         messages.success(request, 'Account verified successfully!')
         return redirect('share:dashboard')
     messages.error(request, 'Invalid activation link')
     return redirect('home')
 
+# SET PASSWORD (one-time link sent by import_roster; choosing a password activates the account)
+class SetPasswordView(auth_views.PasswordResetConfirmView):
+    template_name = 'share/set_password.html'
+    success_url = reverse_lazy('share:dashboard')
+    post_reset_login = True
+
+    def form_valid(self, form):
+        # Proves the address works, like verify_email. The token hashes the old
+        # (unusable) password, so the link stops working once this saves.
+        form.user.is_active = True
+        self.post_reset_login_backend = settings.AUTHENTICATION_BACKENDS[0]
+        messages.success(self.request, 'Your password is set and your account is active.')
+        return super().form_valid(form)
+
 # LOGIN
+@throttle('login', methods=('POST',))
 def login_view(request):
     if request.method == 'POST':
         from django.contrib.auth import authenticate  # ✅ imported inside function
@@ -89,25 +120,299 @@ def logout_view(request):
 
 # FILE UPLOAD
 @login_required
+@throttle('upload', methods=('POST',))
 def upload_file(request):
-    if request.method == 'POST' and request.FILES.get('file'):
-        uploaded_file = request.FILES['file']
-        UploadedFile.objects.create(user=request.user, file=uploaded_file)
-        messages.success(request, '✅ File uploaded successfully.')
-        return redirect('share:file_list')
+    if request.method == 'POST':
+        form = UploadFileForm(request.POST, request.FILES)
+        if form.is_valid():
+            uploaded_file = form.cleaned_data['file']
+            try:
+                stats.check_quota(request.user, uploaded_file.size)
+            except ValidationError as e:
+                messages.error(request, e.messages[0])
+                return redirect('share:upload_file')
+            blobs.store_upload(request.user, uploaded_file, content_type=uploaded_file.detected_type)
+            messages.success(request, '✅ File uploaded successfully.')
+            return redirect('share:file_list')
+        for error in form.errors.get('file', []):
+            messages.error(request, error)
     return render(request, 'share/upload.html')
 
+# BULK (MULTI-FILE) UPLOAD
+@login_required
+@require_POST
+@throttle('upload')
+def upload_files_bulk(request):
+    files = request.FILES.getlist('files')
+    wants_json = 'application/json' in request.headers.get('Accept', '')
+    if not files or len(files) > settings.SHARE_BULK_UPLOAD_MAX_FILES:
+        error = f'Select between 1 and {settings.SHARE_BULK_UPLOAD_MAX_FILES} files to upload.'
+        if wants_json:
+            return JsonResponse({'error': error}, status=400)
+        messages.error(request, error)
+        return redirect('share:upload_file')
+
+    results = bulk.store_many(request.user, files)
+    uploaded = sum(1 for r in results if r['ok'])
+    if wants_json:
+        return JsonResponse({'results': results}, status=201 if uploaded else 400)
+    if uploaded:
+        messages.success(request, f'✅ {uploaded} of {len(results)} file(s) uploaded successfully.')
+    for result in results:
+        if not result['ok']:
+            messages.error(request, f"{result['name']}: {result['error']}")
+    return redirect('share:file_list' if uploaded == len(results) else 'share:upload_file')
+
+# RESUMABLE (CHUNKED) UPLOADS
+def _upload_session_headers(response, session):
+    response['Upload-Offset'] = session.offset
+    response['Upload-Length'] = session.length
+    response['Cache-Control'] = 'no-store'
+    return response
+
+@login_required
+@require_POST
+def upload_session_create(request):
+    try:
+        length = int(request.headers['Upload-Length'])
+        metadata = chunked.parse_metadata(request.headers.get('Upload-Metadata', ''))
+        session = chunked.create_session(
+            request.user,
+            metadata.get('filename') or request.POST.get('filename'),
+            length,
+            metadata.get('filetype'),
+        )
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'A numeric Upload-Length header is required.'}, status=400)
+    except ValidationError as e:
+        return JsonResponse({'error': e.messages}, status=413 if e.code in ('too_large', 'quota_exceeded') else 400)
+    url = reverse('share:upload_session', args=[session.id])
+    response = JsonResponse({'id': str(session.id), 'url': url, 'offset': 0, 'length': session.length}, status=201)
+    response['Location'] = url
+    return _upload_session_headers(response, session)
+
+@login_required
+@require_http_methods(['GET', 'HEAD', 'PATCH', 'DELETE'])
+def upload_session(request, session_id):
+    session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+    if request.method == 'DELETE':
+        chunked.discard(session)
+        return HttpResponse(status=204)
+    if request.method == 'PATCH':
+        if request.content_type != 'application/offset+octet-stream':
+            return JsonResponse({'error': 'Content-Type must be application/offset+octet-stream.'}, status=415)
+        try:
+            chunked.append_chunk(session, request, int(request.headers['Upload-Offset']))
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'A numeric Upload-Offset header is required.'}, status=400)
+        except chunked.UploadLocked:
+            return JsonResponse({'error': 'Another request is writing to this upload.'}, status=423)
+        except chunked.OffsetMismatch as e:
+            response = JsonResponse({'error': 'Upload-Offset does not match the current offset.', 'offset': e.args[0]}, status=409)
+            response['Upload-Offset'] = e.args[0]
+            return response
+        except ValidationError as e:
+            if e.code == 'unsupported_type':
+                # The first bytes decide the type, so this upload can never succeed.
+                chunked.discard(session)
+                return JsonResponse({'error': e.messages}, status=415)
+            return JsonResponse({'error': e.messages}, status=413 if e.code == 'too_large' else 400)
+        return _upload_session_headers(HttpResponse(status=204), session)
+    response = JsonResponse({'id': str(session.id), 'offset': session.offset, 'length': session.length})
+    return _upload_session_headers(response, session)
+
+@login_required
+@require_POST
+def upload_session_finalize(request, session_id):
+    session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+    try:
+        uploaded = chunked.finalize(session)
+    except ValidationError as e:
+        if e.code == 'unsupported_type':
+            chunked.discard(session)
+            return JsonResponse({'error': e.messages}, status=415)
+        return JsonResponse({'error': e.messages}, status=413 if e.code == 'quota_exceeded' else 409)
+    return JsonResponse({'id': uploaded.id, 'name': uploaded.display_name, 'size': uploaded.size}, status=201)
+
 # FILE LIST
+def _file_page(request, max_limit=100):
+    try:
+        limit = min(max(int(request.GET.get('limit', settings.SHARE_FILE_LIST_PAGE_SIZE)), 1), max_limit)
+    except ValueError:
+        limit = settings.SHARE_FILE_LIST_PAGE_SIZE
+    sort = request.GET.get('sort', pagination.DEFAULT_SORT)
+    after, before = request.GET.get('after'), request.GET.get('before')
+
+    def compute():
+        files, next_cursor, previous_cursor = pagination.paginate(
+            UploadedFile.objects.filter(user=request.user),
+            sort=sort,
+            after=after,
+            before=before,
+            limit=limit,
+        )
+        return {
+            'files': files,
+            'sort': sort if sort in pagination.SORTS else pagination.DEFAULT_SORT,
+            'next_cursor': next_cursor,
+            'previous_cursor': previous_cursor,
+            # Read from the denormalized counters rather than a COUNT(*).
+            'total': stats.for_user(request.user).file_count,
+        }
+
+    user_version = cache.version(request.user.id)
+    page = cache.get_or_compute(
+        request.user.id, 'file_page', (sort, after, before, limit), compute, user_version=user_version
+    )
+    return {**page, **cache.fragment_context(user_version)}
+
 @login_required
+@read_replica
 def file_list(request):
-    files = UploadedFile.objects.filter(user=request.user)
-    return render(request, 'share/file_list.html', {'files': files})
+    try:
+        context = _file_page(request)
+    except pagination.InvalidCursor:
+        return redirect('share:file_list')
+    return render(request, 'share/file_list.html', context)
+
+@login_required
+@read_replica
+def file_list_api(request):
+    try:
+        page = _file_page(request)
+    except pagination.InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'results': [
+            {
+                'id': f.id,
+                'name': f.display_name,
+                'size': f.size,
+                'uploaded_at': f.uploaded_at.isoformat(),
+                'download_url': reverse('share:download_file', args=[f.id]),
+            }
+            for f in page['files']
+        ],
+        'sort': page['sort'],
+        'next': page['next_cursor'],
+        'previous': page['previous_cursor'],
+        'total': page['total'],
+    })
+
+# SEARCH
+def _search_page(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    limit = settings.SHARE_SEARCH_PAGE_SIZE
+    results, has_next = search.search(request.user, query, offset=(page - 1) * limit, limit=limit)
+    return {
+        'query': query,
+        'results': results,
+        'page': page,
+        'has_next': has_next,
+        'has_previous': page > 1,
+    }
+
+@login_required
+@read_replica
+def search_files(request):
+    return render(request, 'share/search.html', _search_page(request))
+
+@login_required
+@read_replica
+def search_api(request):
+    page = _search_page(request)
+    return JsonResponse({
+        'results': [
+            {
+                'id': f.id,
+                'name': f.display_name,
+                'size': f.size,
+                'owner': f.user.username,
+                'uploaded_at': f.uploaded_at.isoformat(),
+                'snippet': f.snippet,
+                'download_url': reverse('share:download_file', args=[f.id]),
+            }
+            for f in page['results']
+        ],
+        'query': page['query'],
+        'page': page['page'],
+        'has_next': page['has_next'],
+    })
 
 # FILE DETAIL
 @login_required
 def file_detail(request, file_id):
+    file = get_object_or_404(UploadedFile.objects.select_related('blob'), id=file_id, user=request.user)
+    preview_kind = file.preview_kind
+    context = {
+        'file': file,
+        # Rendered by file_preview, which the page requests once it has loaded.
+        'preview_kind': preview_kind,
+        'share_links': [
+            (link, request.build_absolute_uri(links.path_for(link)))
+            for link in file.share_links.filter(revoked_at__isnull=True, expires_at__gt=timezone.now()).order_by('expires_at')
+        ],
+        'max_link_days': links.get_config()['MAX_AGE'] // 86400,
+    }
+    return render(request, 'share/file_detail.html', context)
+
+# SHARE LINKS (signed, expiring URLs that work without logging in; served by share.links)
+@login_required
+@require_POST
+def create_share_link(request, file_id):
     file = get_object_or_404(UploadedFile, id=file_id, user=request.user)
-    return render(request, 'share/file_detail.html', {'file': file})
+    try:
+        days = int(request.POST.get('days') or 0)
+    except ValueError:
+        days = 0
+    permissions = ('download', 'inline') if request.POST.get('inline') else ('download',)
+    link = links.create(file, request.user, seconds=days * 86400 if days > 0 else None, permissions=permissions)
+    messages.success(request, f"Share link created; it expires {link.expires_at:%Y-%m-%d %H:%M}.")
+    return redirect('share:file_detail', file_id=file.id)
+
+@login_required
+@require_POST
+def revoke_share_link(request, link_id):
+    link = get_object_or_404(ShareLink.objects.select_related('file'), id=link_id)
+    if request.user.id not in (link.file.user_id, link.created_by_id) and not request.user.is_staff:
+        raise Http404('No such share link.')
+    if link.revoked_at is None:
+        links.revoke(link)
+    messages.success(request, "Share link revoked")
+    return redirect('share:file_detail', file_id=link.file_id)
+
+# FILE PREVIEW (thumbnail, first PDF page or text snippet; rendered once, then served from disk)
+@login_required
+def file_preview(request, file_id):
+    file = get_object_or_404(UploadedFile.objects.select_related('blob'), id=file_id)
+    if request.user.id != file.user_id and not request.user.is_staff:
+        raise Http404('No preview available.')
+    kind = file.preview_kind
+    if kind is None:
+        raise Http404('No preview available.')
+    key = previews.cache_key(file)
+    if key is None:
+        raise Http404('No preview available.')
+    # A file's content never changes, so neither does its preview.
+    etag = quote_etag(f'{key}.{kind}')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            path = previews.get(file, kind)
+        except previews.PreviewPending:
+            response = HttpResponse('Preview is being generated.', status=503)
+            response['Retry-After'] = '2'
+            return response
+        if path is None:
+            raise Http404('No preview available.')
+        response = FileResponse(open(path, 'rb'), content_type=previews.CONTENT_TYPES[kind])
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 # DELETE FILE
 @login_required
@@ -121,26 +426,88 @@ def delete_file(request, file_id):
 
 # DOWNLOAD FILE
 @login_required
+@throttle('download')
 def download_file(request, file_id):
-    file = get_object_or_404(UploadedFile, id=file_id)
-    if request.user != file.user and not request.user.is_staff:
+    file = get_object_or_404(UploadedFile.objects.select_related('blob'), id=file_id)
+    if request.user.id != file.user_id and not request.user.is_staff:
+        messages.error(request, "Unauthorized access")
+        return redirect('share:file_list')
+    response = downloads.serve_upload(request, file)
+    if downloads.counts_as_download(request, response):
+        logbuffer.record_download(request.user, file)
+    return response
+
+# DOWNLOAD SELECTED FILES AS ZIP
+@login_required
+@throttle('download')
+def download_zip(request):
+    try:
+        ids = {int(i) for i in request.GET.getlist('ids')}
+    except ValueError:
+        ids = set()
+    if not ids or len(ids) > settings.SHARE_ZIP_MAX_FILES:
+        messages.error(request, f"Select between 1 and {settings.SHARE_ZIP_MAX_FILES} files to download.")
+        return redirect('share:file_list')
+    files = UploadedFile.objects.filter(id__in=ids)
+    if not request.user.is_staff:
+        files = files.filter(user=request.user)
+    # Same rule as download_file: every selected file must be the user's own unless they are staff.
+    if files.count() != len(ids):
         messages.error(request, "Unauthorized access")
         return redirect('share:file_list')
-    return FileResponse(file.file.open('rb'), as_attachment=True, filename=file.file.name)
+    response = StreamingHttpResponse(
+        zipstream.stream_zip(
+            files.select_related('blob').order_by('id').iterator(chunk_size=100),
+            on_entry=lambda upload: logbuffer.record_download(request.user, upload),
+        ),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = content_disposition_header(True, 'files.zip')
+    return response
 
 # DASHBOARD
 @login_required
+@read_replica
 def user_dashboard(request):
-    recent_files = UploadedFile.objects.filter(
-        user=request.user
-    ).order_by('-uploaded_at')[:5]
-    
+    def compute():
+        storage = stats.for_user(request.user)
+        return {
+            'recent_files': list(UploadedFile.objects.filter(user=request.user).order_by('-uploaded_at')[:5]),
+            'file_count': storage.file_count,
+            'storage_used': storage.mb_used,  # MB
+        }
+
+    user_version = cache.version(request.user.id)
+    quota = stats.quota_bytes()
     context = {
-        'recent_files': recent_files,
-        'file_count': UploadedFile.objects.filter(user=request.user).count(),
-        'storage_used': sum(f.file.size for f in recent_files) / (1024 * 1024)  # MB
+        **cache.get_or_compute(request.user.id, 'dashboard', (), compute, user_version=user_version),
+        **cache.fragment_context(user_version),
+        'storage_quota': quota / (1024 * 1024) if quota is not None else None,  # MB
     }
     return render(request, 'share/dashboard.html', context)
+# DOWNLOAD REPORTS (staff only, read from the daily rollups)
+@staff_member_required
+@read_replica
+def download_report(request):
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 365)
+    except ValueError:
+        days = 30
+    since = timezone.localdate() - timedelta(days=days - 1)
+    context = {
+        'days': days,
+        'top_files': rollups.top_files(since),
+        'owners': rollups.owner_activity(since),
+        'timeline': rollups.downloads_over_time(since),
+    }
+    return render(request, 'share/download_report.html', context)
+
+# PROMETHEUS METRICS (scrapers from ALLOWED_IPS or with the bearer TOKEN, or logged-in staff)
+def metrics_view(request):
+    if not metrics.may_scrape(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # EMAIL SENT PAGE
 def email_sent(request):
     return render(request, 'share/email_sent.html')